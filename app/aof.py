@@ -0,0 +1,274 @@
+import mmap
+import os
+import threading
+import time
+
+from app.config import Config
+from app.persistence import rdb_aux_fields, start_background_job, write_snapshot
+from app.rdb_loader import RdbLoader
+from app.redis_store import RedisStore
+from app.resp import RespParser, encode_command
+
+# bytes handed to the parser at a time while replaying
+AOF_LOAD_CHUNK = 1024 * 1024
+
+
+def aof_file_path(config: Config):
+    return os.path.join(config.get_value("dir"), config.get_value("appendfilename"))
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+class AppendOnlyFile:
+    # every write command is appended to buf in RESP form, flush() writes buf out
+    # and fsyncs according to appendfsync. the event loop flushes once per
+    # iteration before any reply goes out, so with "always" every command of the
+    # iteration shares one fsync. in threaded mode each client thread calls flush()
+    # before replying: the first one to get there becomes the leader and writes
+    # and syncs everything appended so far, the others wait for it instead of
+    # issuing their own fsync. with everysec the fsync runs on a thread of its
+    # own like redis' bio fsync, nobody waits for the disk and the lock isn't
+    # held meanwhile
+    def __init__(self, path, config: Config):
+        self.path = path
+        self.config = config
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        self.buf = bytearray()
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        # stream offsets: everything fed so far, and everything written out
+        self.appended = 0
+        self.flushed = 0
+        self.flushing = False
+        self.syncing = False
+        self.last_fsync = time.monotonic()
+        self.unsynced = False
+        self.last_write_ok = True
+        # commands fed while a rewrite runs, appended to the rewritten file
+        self.rewrite_buf = None
+        self.base_size = self.size
+
+    def feed(self, args):
+        data = encode_command(args)
+        with self.lock:
+            self.buf += data
+            self.appended += len(data)
+            if self.rewrite_buf is not None:
+                self.rewrite_buf += data
+
+    def flush(self):
+        with self.cond:
+            target = self.appended
+            while self.flushed < target:
+                if self.flushing:
+                    # a leader is already writing, our bytes may be in its batch
+                    self.cond.wait()
+                    continue
+                if not self._lead_flush():
+                    return
+            if self.unsynced and not self.syncing and self.config.get_value("appendfsync") == "everysec":
+                # data written without fsync is synced at most a second later
+                if time.monotonic() - self.last_fsync >= 1:
+                    self.syncing = True
+                    self.unsynced = False
+                    self.last_fsync = time.monotonic()
+                    threading.Thread(target=self._background_fsync, args=(self.fd,), daemon=True).start()
+
+    def _background_fsync(self, fd):
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            print(f"[AOF] Error syncing the append only file: {e}")
+        with self.cond:
+            self.syncing = False
+            self.cond.notify_all()
+
+    def _lead_flush(self):
+        # called with the lock held, releases it around the write and the fsync
+        data = self.buf
+        upto = self.appended
+        fd = self.fd
+        self.buf = bytearray()
+        self.flushing = True
+        policy = self.config.get_value("appendfsync")
+        ok = True
+        self.lock.release()
+        try:
+            _write_all(fd, data)
+            if policy == "always":
+                os.fsync(fd)
+        except OSError as e:
+            print(f"[AOF] Error writing to the append only file: {e}")
+            ok = False
+        finally:
+            self.lock.acquire()
+            self.flushing = False
+            self.last_write_ok = ok
+            if ok:
+                self.flushed = upto
+                self.size += len(data)
+                if policy == "always":
+                    self.last_fsync = time.monotonic()
+                else:
+                    self.unsynced = True
+            else:
+                # keep the data, the next flush tries again
+                self.buf[0:0] = data
+            self.cond.notify_all()
+        return ok
+
+    def start_rewrite(self):
+        with self.lock:
+            self.rewrite_buf = bytearray()
+
+    def abort_rewrite(self):
+        with self.lock:
+            self.rewrite_buf = None
+
+    def finish_rewrite(self, tmp_path):
+        # the rewritten file holds the snapshot, add what was written meanwhile
+        # and swap it in. every command still in buf is also in rewrite_buf, so
+        # once the new file is synced buf is done with
+        with self.cond:
+            # the old fd is closed below, no write or fsync may still use it
+            while self.flushing or self.syncing:
+                self.cond.wait()
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_APPEND)
+            try:
+                _write_all(fd, self.rewrite_buf)
+                os.fsync(fd)
+                os.replace(tmp_path, self.path)
+            except OSError:
+                os.close(fd)
+                self.rewrite_buf = None
+                raise
+            os.close(self.fd)
+            self.fd = fd
+            self.size = os.fstat(fd).st_size
+            self.base_size = self.size - len(self.rewrite_buf)
+            self.rewrite_buf = None
+            self.buf = bytearray()
+            self.flushed = self.appended
+            self.unsynced = False
+            self.last_fsync = time.monotonic()
+            self.cond.notify_all()
+
+
+def rewrite_append_only_file_background(store: RedisStore, config: Config):
+    # BGREWRITEAOF: the rewritten log starts with an rdb snapshot of the keyspace
+    # (like aof-use-rdb-preamble) followed by the commands that arrived during
+    # the rewrite
+    aof = store.aof
+    tmp_path = os.path.join(os.path.dirname(os.path.abspath(aof.path)), f"temp-rewriteaof-bg-{os.getpid()}.aof")
+    aux = rdb_aux_fields(store)
+    aux["aof-base"] = 1
+
+    def write(items):
+        write_snapshot(store, config, tmp_path, items, aux)
+
+    def on_done(ok):
+        store.aof_last_rewrite_ok = ok
+        if ok:
+            try:
+                aof.finish_rewrite(tmp_path)
+                print("[AOF] Background append only file rewrite terminated with success")
+                return
+            except OSError as e:
+                print(f"[AOF] Failed to install the rewritten append only file: {e}")
+                store.aof_last_rewrite_ok = False
+        else:
+            print("[AOF] Background append only file rewrite error")
+            aof.abort_rewrite()
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+    aof.start_rewrite()
+    store.aof_rewrite_scheduled = False
+    if start_background_job(store, "aofrw", write, on_done) is None:
+        aof.abort_rewrite()
+        store.aof_last_rewrite_ok = False
+        return False
+    return True
+
+
+def check_scheduled_rewrite(store: RedisStore, config: Config):
+    # a rewrite asked for while a BGSAVE was running starts once it is done
+    if store.aof is not None and store.aof_rewrite_scheduled and store.child_job is None:
+        rewrite_append_only_file_background(store, config)
+
+
+class ReplayClient:
+    # stands in for a connection when commands come from the log being replayed
+    # or from the master of a replica, replies are dropped
+    def __init__(self):
+        self.client_state = {
+            "multi": False,
+            "queued_commands": [],
+            "exec_abort": False,
+            "in_exec": False
+        }
+        self.errors = 0
+
+    def send(self, data: bytes):
+        if data.startswith(b"-"):
+            self.errors += 1
+
+    def sendall(self, data: bytes):
+        self.send(data)
+
+
+def load_append_only_file(path, store: RedisStore, executor, verify_checksum=True):
+    # replays the log through executor(client, args), the same command table live
+    # clients use. a rewritten log starts with an rdb preamble that is loaded
+    # first. an incomplete command at the end (a crash mid write) is cut off
+    start = time.perf_counter()
+    size = os.path.getsize(path)
+    offset = 0
+    with open(path, "rb") as f:
+        if f.read(5) == b"REDIS":
+            loader = RdbLoader(path, verify_checksum)
+            store.load_keys(loader.load())
+            offset = loader.end_offset
+
+    client = ReplayClient()
+    parser = RespParser()
+    replayed = 0
+    # commands since an unfinished MULTI, to cut the transaction off the log
+    in_multi = []
+    if size > offset:
+        store.loading = True
+        try:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for chunk_start in range(offset, size, AOF_LOAD_CHUNK):
+                    parser.feed(mapped[chunk_start:chunk_start + AOF_LOAD_CHUNK])
+                    for args in parser.parse():
+                        executor(client, args)
+                        replayed += 1
+                        if client.client_state["multi"]:
+                            in_multi.append(args)
+                        elif in_multi:
+                            in_multi = []
+                    if parser.error is not None:
+                        break
+        finally:
+            store.loading = False
+
+    valid_end = offset + parser.processed
+    if in_multi:
+        # the log is written by us, so every command has its canonical encoding
+        valid_end -= sum(len(encode_command(args)) for args in in_multi)
+        print("[AOF] The log ends inside MULTI, the unfinished transaction was discarded")
+    if valid_end < size:
+        print(f"[AOF] Truncating {size - valid_end} bytes of an incomplete or malformed command at the end of the log")
+        os.truncate(path, valid_end)
+    store.dirty = 0
+    elapsed = time.perf_counter() - start
+    print(f"[AOF] Replayed {replayed} commands ({client.errors} errors) from {size} bytes in {elapsed:.3f}s")
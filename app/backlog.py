@@ -0,0 +1,57 @@
+class ReplicationBacklog:
+  # the last `size` bytes of the replication stream in a circular buffer. offsets
+  # are redis' replication offsets: the stream's first byte is offset 1 and
+  # `offset` (master_repl_offset) is the last byte written, so the backlog holds
+  # offsets first_byte_offset() .. offset. a replica that reconnects asks for the
+  # byte after the last one it processed and gets the tail from there on
+  def __init__(self, size, offset=0):
+    self.size = size
+    self.buf = bytearray(size)
+    # where the next byte goes, and how many bytes of history are held
+    self.idx = 0
+    self.histlen = 0
+    self.offset = offset
+
+  def feed(self, data):
+    n = len(data)
+    self.offset += n
+    if n >= self.size:
+      # only the end of a huge write survives
+      self.buf[:] = data[n - self.size:]
+      self.idx = 0
+      self.histlen = self.size
+      return
+    end = self.idx + n
+    if end <= self.size:
+      self.buf[self.idx:end] = data
+    else:
+      split = self.size - self.idx
+      self.buf[self.idx:] = data[:split]
+      self.buf[:n - split] = data[split:]
+    self.idx = end % self.size
+    self.histlen = min(self.size, self.histlen + n)
+
+  def first_byte_offset(self):
+    return self.offset - self.histlen + 1
+
+  def covers(self, psync_offset):
+    # psync_offset is the next byte the replica wants, one past the end means
+    # it is already up to date
+    return self.first_byte_offset() <= psync_offset <= self.offset + 1
+
+  def read_from(self, psync_offset):
+    count = self.offset + 1 - psync_offset
+    if count <= 0:
+      return b""
+    start = (self.idx - count) % self.size
+    if start + count <= self.size:
+      return bytes(self.buf[start:start + count])
+    return bytes(self.buf[start:]) + bytes(self.buf[:self.idx])
+
+  def resize(self, size):
+    # keeps as much of the newest history as fits
+    if size == self.size:
+      return
+    tail = self.read_from(max(self.first_byte_offset(), self.offset + 1 - size))
+    self.__init__(size, self.offset - len(tail))
+    self.feed(tail)
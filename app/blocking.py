@@ -0,0 +1,55 @@
+import threading
+
+
+class BlockingRegistry:
+    # clients blocked on keys (XREAD BLOCK). a write to a key wakes only the
+    # waiters registered for that key. waiters are anything with a wake() method:
+    # the event loop registers its blocked clients, the threaded server a
+    # ThreadWaiter per blocked thread. the waiters of a key are the keys of a dict,
+    # which keeps them in the order they blocked (woken first come first served)
+    # and removes any of them in O(1)
+    def __init__(self):
+        self.waiters = {}
+        self.lock = threading.Lock()
+
+    def add(self, keys, waiter):
+        with self.lock:
+            for key in keys:
+                self.waiters.setdefault(key, {})[waiter] = None
+
+    def remove(self, keys, waiter):
+        with self.lock:
+            for key in keys:
+                waiting = self.waiters.get(key)
+                if not waiting:
+                    continue
+                waiting.pop(waiter, None)
+                if not waiting:
+                    del self.waiters[key]
+
+    def signal(self, key):
+        # cheap no-op for the common case of nobody waiting on the key
+        if key not in self.waiters:
+            return
+        with self.lock:
+            waiting = list(self.waiters.get(key, ()))
+        for waiter in waiting:
+            waiter.wake()
+
+    def blocked_count(self):
+        with self.lock:
+            return len({id(waiter) for waiting in self.waiters.values() for waiter in waiting})
+
+
+class ThreadWaiter:
+    # a thread of the threaded server parked until a key it waits on changes
+    def __init__(self):
+        self.event = threading.Event()
+
+    def wake(self):
+        self.event.set()
+
+    def wait(self, timeout):
+        woken = self.event.wait(timeout)
+        self.event.clear()
+        return woken
@@ -0,0 +1,482 @@
+import os
+import secrets
+import socket
+
+from app.commands import COMMAND_TABLE, TRANSACTION_COMMANDS, command_keys
+from app.config import Config
+from app.rdb_utils import read_replies
+from app.resp import OK, encode_bulk, encode_command, encode_error, encode_integer, to_text
+from app.slots import SLOT_COUNT, key_hash_slot
+
+# --cluster-enabled: every node serves the hash slots assigned to it and redirects
+# clients to the right node for the others. there is no cluster bus: nodes learn
+# about each other with CLUSTER MEET (which asks the other node for its slots) and
+# changes of ownership are sent to every node with CLUSTER SETSLOT, the way
+# redis-cli drives a resharding
+
+# seconds CLUSTER MEET waits for the other node
+MEET_TIMEOUT = 2
+
+CROSSSLOT_ERROR = b"-CROSSSLOT Keys in request don't hash to the same slot\r\n"
+TRYAGAIN_ERROR = b"-TRYAGAIN Multiple keys request during rehashing of slot\r\n"
+
+
+def cluster_config_path(config: Config):
+    return os.path.join(config.get_value("dir"), config.get_value("cluster-config-file"))
+
+
+class ClusterNode:
+    def __init__(self, node_id, host, port):
+        self.node_id = node_id
+        self.host = host
+        self.port = port
+
+    def address(self):
+        return f"{self.host}:{self.port}"
+
+
+def slot_ranges(slots):
+    # sorted slot numbers -> [(start, end)] of consecutive runs
+    ranges = []
+    for slot in slots:
+        if ranges and ranges[-1][1] == slot - 1:
+            ranges[-1][1] = slot
+        else:
+            ranges.append([slot, slot])
+    return [tuple(r) for r in ranges]
+
+
+def parse_slot(value):
+    try:
+        slot = int(value)
+    except ValueError:
+        return None
+    return slot if 0 <= slot < SLOT_COUNT else None
+
+
+class ClusterState:
+    # this node's view of the cluster: the known nodes, the owner of every slot and
+    # the slots being moved. kept in the cluster config file (nodes.conf format) so
+    # a restarted node keeps its id and slots
+    def __init__(self, store, config: Config, host, port):
+        self.store = store
+        self.path = cluster_config_path(config)
+        self.nodes = {}
+        # slot -> owning ClusterNode, None while unassigned
+        self.slots = [None] * SLOT_COUNT
+        # slot -> node id the slot is moving to / coming from
+        self.migrating = {}
+        self.importing = {}
+        self.myself = None
+        if os.path.exists(self.path):
+            self.load()
+            print(f"[Cluster] Loaded node {self.myself.node_id} from {self.path}")
+        else:
+            self.myself = ClusterNode(secrets.token_hex(20), host, port)
+            self.nodes[self.myself.node_id] = self.myself
+            print(f"[Cluster] No cluster config found, I'm {self.myself.node_id}")
+        self.myself.host = host
+        self.myself.port = port
+        self.save()
+
+    # ---- cluster config file ----
+
+    def node_line(self, node):
+        flags = "myself,master" if node is self.myself else "master"
+        fields = [node.node_id, f"{node.address()}@{node.port + 10000}", flags, "-", "0", "0", "0", "connected"]
+        owned = [slot for slot in range(SLOT_COUNT) if self.slots[slot] is node]
+        fields += [str(start) if start == end else f"{start}-{end}" for start, end in slot_ranges(owned)]
+        if node is self.myself:
+            fields += [f"[{slot}->-{node_id}]" for slot, node_id in sorted(self.migrating.items())]
+            fields += [f"[{slot}-<-{node_id}]" for slot, node_id in sorted(self.importing.items())]
+        return " ".join(fields)
+
+    def nodes_description(self):
+        return "".join(self.node_line(node) + "\n" for node in self.nodes.values())
+
+    def save(self):
+        # written to a temp file and renamed, like the rdb
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            f.write(self.nodes_description())
+            f.write("vars currentEpoch 0 lastVoteEpoch 0\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        with open(self.path) as f:
+            lines = [line.split() for line in f if line.strip()]
+        for fields in lines:
+            if fields[0] == "vars":
+                continue
+            if len(fields) < 8:
+                raise ValueError(f"Unrecoverable error: corrupted cluster config file {self.path}")
+            host, _, port = fields[1].split("@")[0].rpartition(":")
+            node = ClusterNode(fields[0], host, int(port))
+            self.nodes[node.node_id] = node
+            if "myself" in fields[2].split(","):
+                self.myself = node
+            for field in fields[8:]:
+                self._load_slot_field(node, field)
+        if self.myself is None:
+            raise ValueError(f"Unrecoverable error: no myself node in {self.path}")
+
+    def _load_slot_field(self, node, field):
+        if field.startswith("["):
+            slot, marker, node_id = field[1:-1].partition("->-")
+            if marker:
+                self.migrating[int(slot)] = node_id
+            else:
+                slot, _, node_id = field[1:-1].partition("-<-")
+                self.importing[int(slot)] = node_id
+            return
+        start, _, end = field.partition("-")
+        for slot in range(int(start), int(end or start) + 1):
+            self.slots[slot] = node
+
+    # ---- redirections ----
+
+    def check_keys(self, keys, asking):
+        # None when this node can run a command on keys, otherwise the error that
+        # sends the client elsewhere
+        slot = key_hash_slot(keys[0])
+        for key in keys[1:]:
+            if key_hash_slot(key) != slot:
+                return CROSSSLOT_ERROR
+        owner = self.slots[slot]
+        if owner is None:
+            return b"-CLUSTERDOWN Hash slot not served\r\n"
+        if owner is self.myself:
+            target = self.nodes.get(self.migrating.get(slot))
+            if target is not None:
+                # keys already moved (or never there) are looked up on the target
+                missing = sum(1 for key in keys if self.store.object(key) is None)
+                if missing == len(keys):
+                    return f"-ASK {slot} {target.address()}\r\n".encode()
+                if missing:
+                    return TRYAGAIN_ERROR
+            return None
+        if asking and slot in self.importing:
+            return None
+        return f"-MOVED {slot} {owner.address()}\r\n".encode()
+
+    # ---- CLUSTER subcommands ----
+
+    def command(self, args):
+        # slots, node ids and addresses are text, only KEYSLOT's key stays bytes
+        sub = to_text(args[0]).upper()
+        handler = CLUSTER_SUBCOMMANDS.get(sub)
+        if handler is None:
+            return encode_error(f"ERR unknown subcommand '{to_text(args[0])}'. Try CLUSTER HELP.")
+        if handler is not ClusterState.keyslot:
+            args = [to_text(arg) for arg in args]
+        return handler(self, args[1:])
+
+    def myid(self, args):
+        return encode_bulk(self.myself.node_id)
+
+    def info(self, args):
+        assigned = sum(1 for node in self.slots if node is not None)
+        owners = {node.node_id for node in self.slots if node is not None}
+        lines = [
+            f"cluster_state:{'ok' if assigned == SLOT_COUNT else 'fail'}",
+            f"cluster_slots_assigned:{assigned}",
+            f"cluster_slots_ok:{assigned}",
+            "cluster_slots_pfail:0",
+            "cluster_slots_fail:0",
+            f"cluster_known_nodes:{len(self.nodes)}",
+            f"cluster_size:{len(owners)}",
+            "cluster_current_epoch:0",
+            "cluster_my_epoch:0",
+        ]
+        return encode_bulk("\r\n".join(lines) + "\r\n")
+
+    def nodes_command(self, args):
+        return encode_bulk(self.nodes_description())
+
+    def _ranges_by_node(self):
+        # [(node, [(start, end)])] for every node owning slots, in slot order
+        owned = {}
+        for slot, node in enumerate(self.slots):
+            if node is not None:
+                owned.setdefault(node, []).append(slot)
+        return [(node, slot_ranges(slots)) for node, slots in owned.items()]
+
+    def slots_command(self, args):
+        # [start, end, [host, port, id]] per range, what smart clients route with
+        entries = []
+        for node, ranges in self._ranges_by_node():
+            for start, end in ranges:
+                entries.append(
+                    b"*3\r\n" + encode_integer(start) + encode_integer(end)
+                    + b"*3\r\n" + encode_bulk(node.host) + encode_integer(node.port) + encode_bulk(node.node_id)
+                )
+        return b"*%d\r\n" % len(entries) + b"".join(entries)
+
+    def shards_command(self, args):
+        shards = []
+        for node, ranges in self._ranges_by_node():
+            bounds = [bound for start, end in ranges for bound in (start, end)]
+            description = [
+                (b"id", encode_bulk(node.node_id)),
+                (b"port", encode_integer(node.port)),
+                (b"ip", encode_bulk(node.host)),
+                (b"endpoint", encode_bulk(node.host)),
+                (b"role", encode_bulk("master")),
+                (b"replication-offset", encode_integer(0)),
+                (b"health", encode_bulk("online")),
+            ]
+            node_entry = b"*%d\r\n" % (len(description) * 2) + b"".join(
+                encode_bulk(name.decode()) + value for name, value in description
+            )
+            shards.append(
+                b"*4\r\n" + encode_bulk("slots")
+                + b"*%d\r\n" % len(bounds) + b"".join(encode_integer(bound) for bound in bounds)
+                + encode_bulk("nodes") + b"*1\r\n" + node_entry
+            )
+        return b"*%d\r\n" % len(shards) + b"".join(shards)
+
+    def keyslot(self, args):
+        if len(args) != 1:
+            return wrong_arity("keyslot")
+        return encode_integer(key_hash_slot(args[0]))
+
+    def countkeysinslot(self, args):
+        if len(args) != 1:
+            return wrong_arity("countkeysinslot")
+        slot = parse_slot(args[0])
+        if slot is None:
+            return b"-ERR Invalid slot\r\n"
+        return encode_integer(len(self.store.slot_keys.get(slot, ())))
+
+    def getkeysinslot(self, args):
+        if len(args) != 2:
+            return wrong_arity("getkeysinslot")
+        slot = parse_slot(args[0])
+        try:
+            count = int(args[1])
+        except ValueError:
+            count = -1
+        if slot is None:
+            return b"-ERR Invalid slot\r\n"
+        if count < 0:
+            return b"-ERR Invalid number of keys\r\n"
+        keys = self.store.keys_in_slot(slot, count)
+        return b"*%d\r\n" % len(keys) + b"".join(encode_bulk(key) for key in keys)
+
+    def _parse_slots(self, values, ranges):
+        slots = []
+        if ranges and len(values) % 2:
+            return None, wrong_arity("addslotsrange")
+        bounds = [parse_slot(value) for value in values]
+        if None in bounds:
+            return None, b"-ERR Invalid or out of range slot\r\n"
+        if ranges:
+            for start, end in zip(bounds[::2], bounds[1::2]):
+                if start > end:
+                    return None, f"-ERR start slot number {start} is greater than end slot number {end}\r\n".encode()
+                slots.extend(range(start, end + 1))
+        else:
+            slots = bounds
+        if len(set(slots)) != len(slots):
+            return None, b"-ERR Slot specified multiple times\r\n"
+        return slots, None
+
+    def _add_slots(self, args, ranges):
+        if not args:
+            return wrong_arity("addslotsrange" if ranges else "addslots")
+        slots, error = self._parse_slots(args, ranges)
+        if error is not None:
+            return error
+        for slot in slots:
+            if self.slots[slot] is not None:
+                return f"-ERR Slot {slot} is already busy\r\n".encode()
+        for slot in slots:
+            self.slots[slot] = self.myself
+            self.importing.pop(slot, None)
+        self.save()
+        return OK
+
+    def addslots(self, args):
+        return self._add_slots(args, ranges=False)
+
+    def addslotsrange(self, args):
+        return self._add_slots(args, ranges=True)
+
+    def delslots(self, args):
+        if not args:
+            return wrong_arity("delslots")
+        slots, error = self._parse_slots(args, ranges=False)
+        if error is not None:
+            return error
+        for slot in slots:
+            if self.slots[slot] is None:
+                return f"-ERR Slot {slot} is already unassigned\r\n".encode()
+        for slot in slots:
+            self.slots[slot] = None
+            self.migrating.pop(slot, None)
+            self.importing.pop(slot, None)
+        self.save()
+        return OK
+
+    def meet(self, args):
+        # CLUSTER MEET host port: the other node's id and slots, asked right away
+        # since there is no bus to gossip them
+        if len(args) < 2:
+            return wrong_arity("meet")
+        host = args[0]
+        try:
+            port = int(args[1])
+        except ValueError:
+            return f"-ERR Invalid base port specified: {args[1]}\r\n".encode()
+        try:
+            with socket.create_connection((host, port), timeout=MEET_TIMEOUT) as sock:
+                sock.sendall(encode_command(["CLUSTER", "NODES"]))
+                description = read_replies(sock, 1)[0]
+        except OSError as e:
+            return encode_error(f"ERR Invalid node address specified: {host}:{port} ({e})")
+        if isinstance(description, Exception):
+            return encode_error(f"ERR {host}:{port} replied with error: {description}")
+        for line in description.decode().splitlines():
+            fields = line.split()
+            if len(fields) >= 8 and "myself" in fields[2].split(","):
+                break
+        else:
+            return encode_error(f"ERR {host}:{port} didn't describe itself")
+        if fields[0] == self.myself.node_id:
+            return OK
+        node = self.nodes.get(fields[0])
+        if node is None:
+            node = ClusterNode(fields[0], host, port)
+            self.nodes[node.node_id] = node
+            print(f"[Cluster] Met node {node.node_id} at {node.address()}")
+        node.host, node.port = host, port
+        for slot, owner in enumerate(self.slots):
+            if owner is node:
+                self.slots[slot] = None
+        for field in fields[8:]:
+            if field.startswith("["):
+                continue
+            start, _, end = field.partition("-")
+            for slot in range(int(start), int(end or start) + 1):
+                # the slots we serve ourselves only move with SETSLOT
+                if self.slots[slot] is not self.myself:
+                    self.slots[slot] = node
+        self.save()
+        return OK
+
+    def forget(self, args):
+        if len(args) != 1:
+            return wrong_arity("forget")
+        node = self.nodes.get(args[0])
+        if node is None:
+            return f"-ERR Unknown node {args[0]}\r\n".encode()
+        if node is self.myself:
+            return b"-ERR I tried hard but I can't forget myself...\r\n"
+        del self.nodes[node.node_id]
+        for slot, owner in enumerate(self.slots):
+            if owner is node:
+                self.slots[slot] = None
+        self.save()
+        return OK
+
+    def setslot(self, args):
+        # CLUSTER SETSLOT slot IMPORTING id | MIGRATING id | STABLE | NODE id
+        if len(args) < 2:
+            return wrong_arity("setslot")
+        slot = parse_slot(args[0])
+        if slot is None:
+            return b"-ERR Invalid or out of range slot\r\n"
+        action = args[1].upper()
+        if action == "STABLE":
+            self.migrating.pop(slot, None)
+            self.importing.pop(slot, None)
+            self.save()
+            return OK
+        if len(args) != 3 or action not in ("IMPORTING", "MIGRATING", "NODE"):
+            return b"-ERR Invalid CLUSTER SETSLOT action or number of arguments. Try CLUSTER HELP\r\n"
+        node = self.nodes.get(args[2])
+        if node is None:
+            return f"-ERR I don't know about node {args[2]}\r\n".encode()
+        if action == "MIGRATING":
+            if self.slots[slot] is not self.myself:
+                return f"-ERR I'm not the owner of hash slot {slot}\r\n".encode()
+            if node is self.myself:
+                return b"-ERR Target node is myself\r\n"
+            self.migrating[slot] = node.node_id
+        elif action == "IMPORTING":
+            if self.slots[slot] is self.myself:
+                return f"-ERR I'm already the owner of hash slot {slot}\r\n".encode()
+            if node is self.myself:
+                return b"-ERR Source node is myself\r\n"
+            self.importing[slot] = node.node_id
+        else:
+            if self.slots[slot] is self.myself and node is not self.myself and self.store.slot_keys.get(slot):
+                return f"-ERR Can't assign hashslot {slot} to a different node while I still hold keys for this hash slot.\r\n".encode()
+            # the move is over once the slot is assigned, on both sides
+            self.slots[slot] = node
+            if node is not self.myself:
+                self.migrating.pop(slot, None)
+            self.importing.pop(slot, None)
+        self.save()
+        return OK
+
+
+def wrong_arity(subcommand):
+    return encode_error(f"ERR wrong number of arguments for 'cluster|{subcommand}' command")
+
+
+CLUSTER_SUBCOMMANDS = {
+    "MYID": ClusterState.myid,
+    "INFO": ClusterState.info,
+    "NODES": ClusterState.nodes_command,
+    "SLOTS": ClusterState.slots_command,
+    "SHARDS": ClusterState.shards_command,
+    "KEYSLOT": ClusterState.keyslot,
+    "COUNTKEYSINSLOT": ClusterState.countkeysinslot,
+    "GETKEYSINSLOT": ClusterState.getkeysinslot,
+    "ADDSLOTS": ClusterState.addslots,
+    "ADDSLOTSRANGE": ClusterState.addslotsrange,
+    "DELSLOTS": ClusterState.delslots,
+    "MEET": ClusterState.meet,
+    "FORGET": ClusterState.forget,
+    "SETSLOT": ClusterState.setslot,
+}
+
+
+class ClusterRouter:
+    # the executor of client connections in cluster mode: a command on keys of a
+    # slot served elsewhere gets a redirection instead of running. commands that
+    # come from the master or the aof go straight to the command table
+    def __init__(self, cluster: ClusterState, local):
+        self.cluster = cluster
+        self.local = local
+
+    def execute(self, conn, args):
+        cmd = COMMAND_TABLE.get(args[0].upper())
+        state = conn.client_state
+        # ASKING only covers the command right after it
+        asking = state["asking"] or (cmd is not None and cmd.name == "RESTORE-ASKING")
+        state["asking"] = False
+        if cmd is None or (cmd.arity > 0 and len(args) != cmd.arity) or len(args) < -cmd.arity:
+            self.local(conn, args)
+            return
+        keys = command_keys(cmd, args)
+        if keys and state["multi"] and cmd.name not in TRANSACTION_COMMANDS:
+            # the whole transaction has to hash to one slot
+            for _, queued_args in state["queued_commands"]:
+                queued_keys = command_keys(COMMAND_TABLE[queued_args[0].upper()], queued_args)
+                if queued_keys:
+                    keys = keys + queued_keys[:1]
+                    break
+        if keys:
+            error = self.cluster.check_keys(keys, asking)
+            if error is not None:
+                if state["multi"]:
+                    state["exec_abort"] = True
+                conn.send(error)
+                return
+        self.local(conn, args)
@@ -0,0 +1,1122 @@
+import os
+import socket
+import time
+from time import perf_counter_ns
+
+from app import log
+from app.aof import rewrite_append_only_file_background
+from app.config import REDIS_VERSION, Config
+from app.evict import bytes_to_human, idle_seconds, lfu_decay, object_size, process_rss, restored_lru
+from app.persistence import rdb_save, rdb_save_background
+from app.rdb_loader import RdbError, load_object
+from app.rdb_utils import read_replies
+from app.rdb_writer import dump_object
+from app.redis_object import INT64_MIN, object_encoding, string_to_int
+from app.redis_store import WRONGTYPE_ERROR, RedisStore
+from app.replication import (
+    count_acked_replicas,
+    full_resync,
+    propagate_expired_keys,
+    propagate_write,
+    record_replica_ack,
+    send_getack_if_requested,
+    setup_replica_connection,
+)
+from app.stats import LATENCY_PERCENTILES, LatencyHistogram, format_percentile
+from app.resp import (
+    EMPTY_ARRAY,
+    NULL_BULK,
+    OK,
+    PONG,
+    QUEUED,
+    encode_array,
+    encode_bulk,
+    encode_command,
+    encode_error,
+    encode_integer,
+    encode_simple,
+    to_text,
+)
+
+START_TIME = time.time()
+
+OOM_ERROR = b"-OOM command not allowed when used memory > 'maxmemory'.\r\n"
+
+# commands that drive the transaction itself and are never queued by MULTI
+TRANSACTION_COMMANDS = frozenset(("MULTI", "EXEC", "DISCARD"))
+
+
+class Command:
+    # one entry of the command table. arity follows redis: a positive value is the
+    # exact number of arguments (command name included), a negative one the minimum.
+    # first_key/last_key/key_step describe where the keys are in the arguments.
+    # the rest are its INFO commandstats / latencystats counters
+    __slots__ = (
+        "name", "handler", "arity", "flags", "first_key", "last_key", "key_step",
+        "calls", "duration_ns", "rejected_calls", "failed_calls", "latency",
+    )
+
+    def __init__(self, name, handler, arity, flags, first_key=0, last_key=0, key_step=0):
+        self.name = name
+        self.handler = handler
+        self.arity = arity
+        self.flags = frozenset(flags.split())
+        self.first_key = first_key
+        self.last_key = last_key
+        self.key_step = key_step
+        self.calls = 0
+        self.duration_ns = 0
+        self.rejected_calls = 0
+        self.failed_calls = 0
+        self.latency = LatencyHistogram()
+
+    def is_write(self):
+        return "write" in self.flags
+
+    def reset_stats(self):
+        self.calls = 0
+        self.duration_ns = 0
+        self.rejected_calls = 0
+        self.failed_calls = 0
+        self.latency.reset()
+
+
+def command_keys(cmd: Command, args):
+    # the key arguments of a command, from the table or for movablekeys commands
+    # from the arguments themselves
+    if cmd.name == "MIGRATE":
+        if args[3] != b"":
+            return [args[3]]
+        for i in range(6, len(args)):
+            if args[i].upper() == b"KEYS":
+                return args[i + 1:]
+        return []
+    if cmd.name == "XREAD":
+        for i in range(1, len(args)):
+            if args[i].upper() == b"STREAMS":
+                names = args[i + 1:]
+                return names[:len(names) // 2]
+        return []
+    if cmd.first_key == 0:
+        return []
+    last = cmd.last_key if cmd.last_key >= 0 else len(args) + cmd.last_key
+    return args[cmd.first_key:last + 1:cmd.key_step]
+
+
+def wrong_arity_error(name):
+    return encode_error(f"ERR wrong number of arguments for '{name.lower()}' command")
+
+
+def syntax_error():
+    return b"-ERR syntax error\r\n"
+
+
+# ---- connection ----
+
+def ping_command(client, args, store: RedisStore, config: Config):
+    if len(args) == 2:
+        return encode_bulk(args[1])
+    if len(args) > 2:
+        return wrong_arity_error("ping")
+    return PONG
+
+
+def echo_command(client, args, store: RedisStore, config: Config):
+    return encode_bulk(args[1])
+
+
+# ---- strings ----
+
+def get_command(client, args, store: RedisStore, config: Config):
+    return store.get(args[1])
+
+
+def mget_command(client, args, store: RedisStore, config: Config):
+    parts = [b"*%d\r\n" % (len(args) - 1)]
+    for key in args[1:]:
+        reply = store.get(key)
+        # keys holding another type read as missing
+        parts.append(NULL_BULK if reply == WRONGTYPE_ERROR else reply)
+    return b"".join(parts)
+
+
+def set_command(client, args, store: RedisStore, config: Config):
+    k, v = args[1], args[2]
+    pxat = None
+    i = 3
+    while i < len(args):
+        option = args[i].upper()
+        if option in (b"PX", b"EX", b"PXAT", b"EXAT") and i + 1 < len(args):
+            # form validation for wrong input
+            try:
+                px = int(args[i + 1])
+            except ValueError:
+                return b"-ERR value is not an integer or out of range\r\n"
+            if px <= 0:
+                return b"-ERR invalid expire time in 'set' command\r\n"
+            if option in (b"EX", b"EXAT"):
+                px *= 1000
+            pxat = px if option in (b"PXAT", b"EXAT") else store._curr_time_ms() + px
+            i += 2
+        else:
+            return syntax_error()
+    reply = store.set(k, v, pxat=pxat)
+    if pxat is not None:
+        # like EXPIRE, the ttl is propagated (and logged) as an absolute deadline
+        args[:] = [b"SET", k, v, b"PXAT", b"%d" % pxat]
+    return reply
+
+
+def generic_incr_command(store: RedisStore, key, increment):
+    try:
+        return encode_integer(store.incrby(key, increment))
+    except TypeError:
+        return WRONGTYPE_ERROR
+    except ValueError as e:
+        return encode_error(f"ERR {e}")
+
+
+def incr_command(client, args, store: RedisStore, config: Config):
+    return generic_incr_command(store, args[1], 1)
+
+
+def decr_command(client, args, store: RedisStore, config: Config):
+    return generic_incr_command(store, args[1], -1)
+
+
+def incrby_command(client, args, store: RedisStore, config: Config):
+    increment = string_to_int(args[2])
+    if increment is None:
+        return b"-ERR value is not an integer or out of range\r\n"
+    return generic_incr_command(store, args[1], increment)
+
+
+def decrby_command(client, args, store: RedisStore, config: Config):
+    decrement = string_to_int(args[2])
+    if decrement is None:
+        return b"-ERR value is not an integer or out of range\r\n"
+    if decrement == INT64_MIN:
+        # its negation doesn't fit in 64 bits
+        return b"-ERR decrement would overflow\r\n"
+    return generic_incr_command(store, args[1], -decrement)
+
+
+# ---- keyspace ----
+
+def keys_command(client, args, store: RedisStore, config: Config):
+    return store.keys(args[1])
+
+
+def scan_command(client, args, store: RedisStore, config: Config):
+    # SCAN cursor [MATCH pattern] [COUNT n] [TYPE type]
+    try:
+        cursor = int(args[1])
+    except ValueError:
+        return b"-ERR invalid cursor\r\n"
+    if cursor < 0 or cursor >= 1 << 64:
+        return b"-ERR invalid cursor\r\n"
+
+    count = 10
+    pattern = None
+    type_name = None
+    i = 2
+    while i < len(args):
+        option = args[i].upper()
+        if i + 1 >= len(args):
+            return syntax_error()
+        if option == b"COUNT":
+            count = parse_count(args[i + 1])
+            if count is None:
+                return b"-ERR value is not an integer or out of range\r\n"
+            if count < 1:
+                return syntax_error()
+        elif option == b"MATCH":
+            pattern = args[i + 1]
+        elif option == b"TYPE":
+            type_name = to_text(args[i + 1]).lower()
+        else:
+            return syntax_error()
+        i += 2
+
+    cursor, keys = store.scan(cursor, count, pattern, type_name)
+    return b"*2\r\n" + encode_bulk(b"%d" % cursor) + encode_array(keys)
+
+
+def type_command(client, args, store: RedisStore, config: Config):
+    return store.type(args[1])
+
+
+def del_command(client, args, store: RedisStore, config: Config):
+    return encode_integer(store.delete(args[1:]))
+
+
+def object_command(client, args, store: RedisStore, config: Config):
+    sub = args[1].upper()
+    if sub == b"ENCODING" and len(args) == 3:
+        obj = store.object(args[2])
+        if obj is None:
+            return NULL_BULK
+        return encode_bulk(object_encoding(obj))
+    if sub == b"IDLETIME" and len(args) == 3:
+        if store.lfu:
+            return b"-ERR An LFU maxmemory policy is selected, idle time not tracked. Please note that when switching between policies at runtime LRU and LFU data will take some time to adjust.\r\n"
+        obj = store.object(args[2])
+        if obj is None:
+            return NULL_BULK
+        return encode_integer(idle_seconds(obj.lru, store.lru_clock))
+    if sub == b"FREQ" and len(args) == 3:
+        if not store.lfu:
+            return b"-ERR An LFU maxmemory policy is not selected, access frequency not tracked. Please note that when switching between policies at runtime LRU and LFU data will take some time to adjust.\r\n"
+        obj = store.object(args[2])
+        if obj is None:
+            return NULL_BULK
+        return encode_integer(lfu_decay(obj.lru, store.lfu_decay_time))
+    return encode_error(f"ERR unknown subcommand or wrong number of arguments for '{to_text(args[1])}'")
+
+
+def dump_command(client, args, store: RedisStore, config: Config):
+    # the payload is redis' DUMP format, sent as is since arguments are binary safe
+    obj = store.object(args[1])
+    if obj is None:
+        return NULL_BULK
+    return encode_bulk(dump_object(obj))
+
+
+def restore_command(client, args, store: RedisStore, config: Config):
+    # RESTORE key ttl payload [REPLACE] [ABSTTL] [IDLETIME seconds] [FREQ frequency]
+    ttl = string_to_int(args[2])
+    if ttl is None:
+        return b"-ERR value is not an integer or out of range\r\n"
+    if ttl < 0:
+        return b"-ERR Invalid TTL value, must be >= 0\r\n"
+    replace = absttl = False
+    idletime = freq = None
+    i = 4
+    while i < len(args):
+        option = args[i].upper()
+        if option == b"REPLACE":
+            replace = True
+        elif option == b"ABSTTL":
+            absttl = True
+        elif option == b"IDLETIME" and i + 1 < len(args) and freq is None:
+            i += 1
+            idletime = string_to_int(args[i])
+            if idletime is None:
+                return b"-ERR value is not an integer or out of range\r\n"
+            if idletime < 0:
+                return b"-ERR Invalid IDLETIME value, must be >= 0\r\n"
+        elif option == b"FREQ" and i + 1 < len(args) and idletime is None:
+            i += 1
+            freq = string_to_int(args[i])
+            if freq is None:
+                return b"-ERR value is not an integer or out of range\r\n"
+            if freq < 0 or freq > 255:
+                return b"-ERR Invalid FREQ value, must be >= 0 and <= 255\r\n"
+        else:
+            return syntax_error()
+        i += 1
+    try:
+        obj = load_object(args[3])
+    except (ValueError, RdbError):
+        return b"-ERR DUMP payload version or checksum are wrong\r\n"
+
+    pxat = None
+    if ttl:
+        pxat = ttl if absttl else int(time.time() * 1000) + ttl
+    if pxat is not None and pxat <= int(time.time() * 1000):
+        # already expired, the key is not created
+        if replace:
+            store.delete([args[1]])
+        return OK
+    lru = restored_lru(store.lfu, store.lru_clock, idletime, freq)
+    if not store.restore(args[1], obj, pxat, replace, lru):
+        return b"-BUSYKEY Target key name already exists.\r\n"
+    return OK
+
+
+# ---- expiry ----
+
+def ttl_command(client, args, store: RedisStore, config: Config):
+    ttl = store.pttl(args[1])
+    if ttl < 0:
+        return encode_integer(ttl)
+    # rounded like redis does
+    return encode_integer((ttl + 500) // 1000)
+
+
+def pttl_command(client, args, store: RedisStore, config: Config):
+    return encode_integer(store.pttl(args[1]))
+
+
+def generic_expire_command(args, store: RedisStore, unit_ms, relative):
+    try:
+        amount = int(args[2])
+    except ValueError:
+        return b"-ERR value is not an integer or out of range\r\n"
+    condition = None
+    if len(args) == 4:
+        condition = args[3].upper()
+        if condition not in (b"NX", b"XX", b"GT", b"LT"):
+            return encode_error(f"ERR Unsupported option {to_text(args[3])}")
+    elif len(args) > 4:
+        return syntax_error()
+
+    when_ms = amount * unit_ms
+    if relative:
+        when_ms += store._curr_time_ms()
+    reply = encode_integer(store.expire_at(args[1], when_ms, condition))
+    # propagated as an absolute deadline so replicas expire the key at the same
+    # moment no matter when they apply the command
+    args[:] = [b"PEXPIREAT", args[1], b"%d" % when_ms] + args[3:]
+    return reply
+
+
+def expire_command(client, args, store: RedisStore, config: Config):
+    return generic_expire_command(args, store, 1000, True)
+
+
+def pexpire_command(client, args, store: RedisStore, config: Config):
+    return generic_expire_command(args, store, 1, True)
+
+
+def expireat_command(client, args, store: RedisStore, config: Config):
+    return generic_expire_command(args, store, 1000, False)
+
+
+def pexpireat_command(client, args, store: RedisStore, config: Config):
+    return generic_expire_command(args, store, 1, False)
+
+
+def persist_command(client, args, store: RedisStore, config: Config):
+    return encode_integer(store.persist(args[1]))
+
+
+# ---- streams ----
+
+def xadd_command(client, args, store: RedisStore, config: Config):
+    # key id followed by field value pairs
+    if len(args) % 2 != 1:
+        return wrong_arity_error("xadd")
+    reply = store.xadd(stream_key=args[1], entry_id=args[2], fields=args[3:])
+    if reply.startswith(b"$"):
+        # replicas must store the same id, so an auto generated one ("*" or "ms-*")
+        # is propagated as the id that was actually used
+        args[2] = reply.split(b"\r\n")[1]
+    return reply
+
+
+def parse_count(value):
+    try:
+        count = int(value)
+    except ValueError:
+        return None
+    return max(count, 0)
+
+
+def xrange_command(client, args, store: RedisStore, config: Config):
+    # XRANGE key start end [COUNT n]
+    count = None
+    if len(args) == 6 and args[4].upper() == b"COUNT":
+        count = parse_count(args[5])
+        if count is None:
+            return b"-ERR value is not an integer or out of range\r\n"
+    elif len(args) != 4:
+        return syntax_error()
+    return store.xrange(stream_key=args[1], start_id=args[2], end_id=args[3], count=count)
+
+
+def xread_command(client, args, store: RedisStore, config: Config):
+    # XREAD [COUNT n] [BLOCK ms] STREAMS key [key ...] id [id ...]
+    count = None
+    block_ms = None
+    streams_at = None
+    i = 1
+    while i < len(args):
+        option = args[i].upper()
+        if option == b"STREAMS":
+            streams_at = i
+            break
+        if option in (b"COUNT", b"BLOCK") and i + 1 < len(args):
+            value = parse_count(args[i + 1])
+            if value is None:
+                return b"-ERR value is not an integer or out of range\r\n"
+            if option == b"COUNT":
+                count = value
+            else:
+                block_ms = value
+            i += 2
+        else:
+            return syntax_error()
+    if streams_at is None:
+        return syntax_error()
+
+    names = args[streams_at + 1:]
+    if not names or len(names) % 2 != 0:
+        return b"-ERR Unbalanced 'xread' list of streams: for each stream key an ID or '$' must be specified.\r\n"
+    half = len(names) // 2
+    stream_keys, last_ids = names[:half], names[half:]
+
+    # inside a transaction BLOCK behaves like a plain read
+    if block_ms is None or client.client_state["in_exec"]:
+        return store.xread(stream_keys, last_ids, count=count or None)
+
+    # "$" is pinned to the current last id, so a wakeup only returns entries added
+    # after this call
+    last_ids = [store.stream_last_id(key) if last_id == b"$" else last_id for key, last_id in zip(stream_keys, last_ids)]
+    reply = store.xread(stream_keys, last_ids, count=count or None)
+    if reply != NULL_BULK:
+        return reply
+
+    def retry():
+        reply = store.xread(stream_keys, last_ids, count=count or None)
+        return None if reply == NULL_BULK else reply
+
+    return client.block(store.blocking, stream_keys, block_ms, retry, NULL_BULK)
+
+
+# ---- transactions ----
+
+def multi_command(client, args, store: RedisStore, config: Config):
+    client_state = client.client_state
+    if client_state["multi"]:
+        return b"-ERR MULTI calls can not be nested\r\n"
+    client_state["multi"] = True
+    client_state["queued_commands"] = []
+    client_state["exec_abort"] = False
+    return OK
+
+
+def exec_command(client, args, store: RedisStore, config: Config):
+    client_state = client.client_state
+    if not client_state["multi"]:
+        return b"-ERR EXEC without MULTI\r\n"
+
+    queued = client_state["queued_commands"]
+    aborted = client_state["exec_abort"]
+    # resetting client_state
+    client_state["multi"] = False
+    client_state["queued_commands"] = []
+    client_state["exec_abort"] = False
+    if aborted:
+        return b"-EXECABORT Transaction discarded because of previous errors.\r\n"
+
+    # queued commands go through the same table as the live path, writes are
+    # propagated wrapped in MULTI/EXEC so replicas apply them as one unit
+    responses = []
+    writes = []
+    client_state["in_exec"] = True
+    try:
+        for cmd, queued_args in queued:
+            reply = call(cmd, client, queued_args, store, config)
+            responses.append(reply)
+            if cmd.is_write() and not reply.startswith(b"-"):
+                writes.append(queued_args)
+                store.dirty += 1
+    finally:
+        client_state["in_exec"] = False
+    if writes:
+        propagate_write(["MULTI"], store)
+        for write_args in writes:
+            propagate_write(write_args, store)
+        propagate_write(["EXEC"], store)
+    return b"*%d\r\n" % len(responses) + b"".join(responses)
+
+
+def discard_command(client, args, store: RedisStore, config: Config):
+    client_state = client.client_state
+    if not client_state["multi"]:
+        return b"-ERR DISCARD without MULTI\r\n"
+    client_state["multi"] = False
+    client_state["queued_commands"] = []
+    client_state["exec_abort"] = False
+    return OK
+
+
+# ---- server ----
+
+def config_command(client, args, store: RedisStore, config: Config):
+    # settings are text, the names and values are decoded here once
+    sub = args[1].upper()
+    if sub == b"GET" and len(args) == 3:
+        return config.get(to_text(args[2]))
+    if sub == b"SET" and len(args) == 4:
+        name, value = to_text(args[2]), to_text(args[3])
+        reply = config.set(name, value)
+        if reply == OK and name.startswith(("maxmemory", "lfu-")):
+            store.configure_memory(config)
+        if reply == OK and name == "loglevel":
+            log.set_level(value)
+        if reply == OK and name.startswith("slowlog-"):
+            store.slowlog.configure(config)
+        if reply == OK and name == "latency-monitor-threshold":
+            store.latency.configure(config)
+        return reply
+    if sub == b"RESETSTAT" and len(args) == 2:
+        store.reset_stats()
+        for cmd in COMMAND_TABLE.values():
+            cmd.reset_stats()
+        return OK
+    return encode_error(f"ERR unknown subcommand or wrong number of arguments for '{to_text(args[1])}'")
+
+
+def save_command(client, args, store: RedisStore, config: Config):
+    if store.child_job is not None:
+        return b"-ERR Background save already in progress\r\n"
+    if not rdb_save(store, config):
+        return b"-ERR\r\n"
+    return OK
+
+
+def bgsave_command(client, args, store: RedisStore, config: Config):
+    if len(args) > 2 or (len(args) == 2 and args[1].upper() != b"SCHEDULE"):
+        return syntax_error()
+    if store.child_job is not None:
+        if store.child_job.kind == "aofrw":
+            return b"-ERR Another child process is active (AOF?): can't BGSAVE right now\r\n"
+        return b"-ERR Background save already in progress\r\n"
+    if not rdb_save_background(store, config):
+        return b"-ERR Background save failed to start\r\n"
+    return encode_simple("Background saving started")
+
+
+def lastsave_command(client, args, store: RedisStore, config: Config):
+    return encode_integer(store.lastsave)
+
+
+def bgrewriteaof_command(client, args, store: RedisStore, config: Config):
+    if store.aof is None:
+        return b"-ERR Append only file is disabled, enable it with --appendonly yes\r\n"
+    job = store.child_job
+    if job is not None and job.kind == "aofrw":
+        return b"-ERR Background append only file rewriting already in progress\r\n"
+    if job is not None:
+        # runs from the cron once the background save is done
+        store.aof_rewrite_scheduled = True
+        return encode_simple("Background append only file rewriting scheduled")
+    if not rewrite_append_only_file_background(store, config):
+        return b"-ERR Can't execute an AOF background rewriting. Please check the server logs for more information.\r\n"
+    return encode_simple("Background append only file rewriting started")
+
+
+def info_server(store: RedisStore, config: Config):
+    return [
+        f"redis_version:{REDIS_VERSION}",
+        f"process_id:{os.getpid()}",
+        f"uptime_in_seconds:{int(time.time() - START_TIME)}",
+    ]
+
+
+def info_memory(store: RedisStore, config: Config):
+    # sizes are estimates of the dataset (see evict.object_size), the rss is the
+    # whole interpreter's
+    peak = max(store.used_memory_peak, store.used_memory)
+    return [
+        f"used_memory:{store.used_memory}",
+        f"used_memory_human:{bytes_to_human(store.used_memory)}",
+        f"used_memory_rss:{process_rss()}",
+        f"used_memory_peak:{peak}",
+        f"used_memory_peak_human:{bytes_to_human(peak)}",
+        f"maxmemory:{store.maxmemory}",
+        f"maxmemory_human:{bytes_to_human(store.maxmemory)}",
+        f"maxmemory_policy:{store.maxmemory_policy}",
+    ]
+
+
+def info_stats(store: RedisStore, config: Config):
+    return [
+        f"total_commands_processed:{store.stat_numcommands}",
+        f"instantaneous_ops_per_sec:{store.ops_sec.value()}",
+        f"total_error_replies:{store.stat_total_error_replies}",
+        f"expired_keys:{store.stat_expired_keys}",
+        f"evicted_keys:{store.stat_evicted_keys}",
+    ]
+
+
+def info_commandstats(store: RedisStore, config: Config):
+    lines = []
+    for cmd in COMMAND_TABLE.values():
+        if not cmd.calls and not cmd.rejected_calls:
+            continue
+        usec = cmd.duration_ns // 1000
+        per_call = cmd.duration_ns / 1000 / cmd.calls if cmd.calls else 0
+        lines.append(
+            f"cmdstat_{cmd.name.lower()}:calls={cmd.calls},usec={usec},usec_per_call={per_call:.2f},"
+            f"rejected_calls={cmd.rejected_calls},failed_calls={cmd.failed_calls}"
+        )
+    return lines
+
+
+def info_latencystats(store: RedisStore, config: Config):
+    lines = []
+    for cmd in COMMAND_TABLE.values():
+        if not cmd.latency.total:
+            continue
+        percentiles = ",".join(
+            f"{format_percentile(p)}={cmd.latency.percentile(p) / 1000:.3f}" for p in LATENCY_PERCENTILES
+        )
+        lines.append(f"latency_percentiles_usec_{cmd.name.lower()}:{percentiles}")
+    return lines
+
+
+def slowlog_command(client, args, store: RedisStore, config: Config):
+    sub = args[1].upper()
+    if sub == b"GET" and len(args) <= 3:
+        count = 10
+        if len(args) == 3:
+            count = string_to_int(args[2])
+            if count is None or count < -1:
+                return b"-ERR count should be greater than or equal to -1\r\n"
+        entries = store.slowlog.get(count)
+        parts = [b"*%d\r\n" % len(entries)]
+        for entry in entries:
+            parts += [
+                b"*6\r\n",
+                encode_integer(entry.id),
+                encode_integer(entry.time),
+                encode_integer(entry.duration_us),
+                encode_array(entry.args),
+                encode_bulk(entry.client_addr),
+                encode_bulk(b""),
+            ]
+        return b"".join(parts)
+    if sub == b"LEN" and len(args) == 2:
+        return encode_integer(len(store.slowlog.entries))
+    if sub == b"RESET" and len(args) == 2:
+        store.slowlog.reset()
+        return OK
+    return encode_error(f"ERR unknown subcommand or wrong number of arguments for '{to_text(args[1])}'")
+
+
+def latency_command(client, args, store: RedisStore, config: Config):
+    sub = args[1].upper()
+    if sub == b"LATEST" and len(args) == 2:
+        latest = store.latency.latest()
+        parts = [b"*%d\r\n" % len(latest)]
+        for event, when, last_ms, max_ms in latest:
+            parts += [b"*4\r\n", encode_bulk(event), encode_integer(when), encode_integer(last_ms), encode_integer(max_ms)]
+        return b"".join(parts)
+    if sub == b"HISTORY" and len(args) == 3:
+        history = store.latency.history(to_text(args[2]))
+        parts = [b"*%d\r\n" % len(history)]
+        for when, ms in history:
+            parts += [b"*2\r\n", encode_integer(when), encode_integer(ms)]
+        return b"".join(parts)
+    if sub == b"RESET":
+        return encode_integer(store.latency.reset([to_text(event) for event in args[2:]]))
+    return encode_error(f"ERR unknown subcommand or wrong number of arguments for '{to_text(args[1])}'")
+
+
+def memory_command(client, args, store: RedisStore, config: Config):
+    sub = args[1].upper()
+    if sub == b"USAGE" and len(args) in (3, 5):
+        # MEMORY USAGE key [SAMPLES count]: sizes are tracked whole, the count is
+        # only checked
+        if len(args) == 5:
+            if args[3].upper() != b"SAMPLES":
+                return syntax_error()
+            if string_to_int(args[4]) is None:
+                return b"-ERR value is not an integer or out of range\r\n"
+        obj = store.object(args[2])
+        if obj is None:
+            return NULL_BULK
+        return encode_integer(object_size(args[2], obj))
+    return encode_error(f"ERR unknown subcommand or wrong number of arguments for '{to_text(args[1])}'")
+
+
+def info_persistence(store: RedisStore, config: Config):
+    job = store.child_job
+    in_progress = job is not None and job.kind == "save"
+    return [
+        f"loading:{int(store.loading)}",
+        f"rdb_changes_since_last_save:{store.dirty}",
+        f"rdb_bgsave_in_progress:{int(in_progress)}",
+        f"rdb_last_save_time:{store.lastsave}",
+        f"rdb_last_bgsave_status:{'ok' if store.last_bgsave_ok else 'err'}",
+        f"rdb_last_bgsave_time_sec:{store.last_bgsave_duration}",
+        f"rdb_current_bgsave_time_sec:{int(time.time() - job.started) if in_progress else -1}",
+    ] + info_aof(store)
+
+
+def info_aof(store: RedisStore):
+    aof = store.aof
+    rewriting = store.child_job is not None and store.child_job.kind == "aofrw"
+    lines = [
+        f"aof_enabled:{int(aof is not None)}",
+        f"aof_rewrite_in_progress:{int(rewriting)}",
+        f"aof_rewrite_scheduled:{int(store.aof_rewrite_scheduled)}",
+        f"aof_last_bgrewrite_status:{'ok' if store.aof_last_rewrite_ok else 'err'}",
+        f"aof_last_write_status:{'ok' if aof is None or aof.last_write_ok else 'err'}",
+    ]
+    if aof is not None:
+        lines += [
+            f"aof_current_size:{aof.size}",
+            f"aof_base_size:{aof.base_size}",
+            f"aof_buffer_length:{len(aof.buf)}",
+        ]
+    return lines
+
+
+def info_replication(store: RedisStore, config: Config):
+    return store.replication_info()
+
+
+def info_cluster(store: RedisStore, config: Config):
+    return [f"cluster_enabled:{int(store.cluster is not None)}"]
+
+
+def info_keyspace(store: RedisStore, config: Config):
+    if not store.data:
+        return []
+    return [f"db0:keys={len(store.data)},expires={len(store.expires)}"]
+
+
+# INFO sections in output order, each returns its "field:value" lines
+INFO_SECTIONS = {
+    "server": info_server,
+    "memory": info_memory,
+    "persistence": info_persistence,
+    "stats": info_stats,
+    "replication": info_replication,
+    "commandstats": info_commandstats,
+    "latencystats": info_latencystats,
+    "cluster": info_cluster,
+    "keyspace": info_keyspace,
+}
+
+# only sent when asked for by name or with all/everything, like redis
+INFO_EXTRA_SECTIONS = ("commandstats", "latencystats")
+
+
+def info_command(client, args, store: RedisStore, config: Config):
+    requested = [to_text(arg).lower() for arg in args[1:]]
+    if any(name in ("all", "everything") for name in requested):
+        requested = list(INFO_SECTIONS)
+    elif not requested or "default" in requested:
+        requested = [name for name in INFO_SECTIONS if name not in INFO_EXTRA_SECTIONS]
+
+    blocks = []
+    for name in requested:
+        section = INFO_SECTIONS.get(name)
+        if section is None:
+            continue
+        lines = [f"# {name.capitalize()}"] + section(store, config)
+        blocks.append("\r\n".join(lines))
+    return encode_bulk("\r\n\r\n".join(blocks))
+
+
+def command_info_entry(cmd: Command):
+    # [name, arity, [flags], first key, last key, step]
+    parts = [
+        "*6\r\n",
+        f"${len(cmd.name)}\r\n{cmd.name.lower()}\r\n",
+        f":{cmd.arity}\r\n",
+        f"*{len(cmd.flags)}\r\n",
+    ]
+    for flag in sorted(cmd.flags):
+        parts.append(f"+{flag}\r\n")
+    parts.append(f":{cmd.first_key}\r\n:{cmd.last_key}\r\n:{cmd.key_step}\r\n")
+    return "".join(parts).encode()
+
+
+def command_command(client, args, store: RedisStore, config: Config):
+    if len(args) == 1:
+        entries = [command_info_entry(cmd) for cmd in COMMAND_TABLE.values()]
+        return b"*%d\r\n" % len(entries) + b"".join(entries)
+
+    sub = args[1].upper()
+    if sub == b"COUNT" and len(args) == 2:
+        return encode_integer(len(COMMAND_TABLE))
+    if sub == b"INFO":
+        names = args[2:] or list(COMMAND_TABLE)
+        entries = []
+        for name in names:
+            cmd = COMMAND_TABLE.get(name.upper())
+            entries.append(command_info_entry(cmd) if cmd is not None else NULL_BULK)
+        return b"*%d\r\n" % len(entries) + b"".join(entries)
+    if sub == b"LIST" and len(args) == 2:
+        names = [name.lower() for name in COMMAND_TABLE]
+        return b"*%d\r\n" % len(names) + b"".join(encode_bulk(name) for name in names)
+    return encode_error(f"ERR unknown subcommand '{to_text(args[1])}'. Try COMMAND HELP.")
+
+
+# ---- replication ----
+
+def replconf_command(client, args, store: RedisStore, config: Config):
+    if len(args) >= 2 and args[1].upper() == b"ACK":
+        # acks are never answered
+        if store.role == "master" and len(args) == 3:
+            offset = string_to_int(args[2])
+            if offset is not None:
+                record_replica_ack(client, offset, store)
+        return None
+    if log.level <= log.DEBUG:
+        log.debug("[Master/Replica] Received REPLCONF command")
+    return OK
+
+
+def psync_command(client, args, store: RedisStore, config: Config):
+    if store.role != "master":
+        return EMPTY_ARRAY
+    try:
+        psync_offset = int(args[2])
+    except ValueError:
+        return b"-ERR value is not an integer or out of range\r\n"
+
+    setup_replica_connection(client, config)
+    repl_id = store.master_repl_id
+    backlog = store.repl_backlog
+    # nothing can be propagated between answering and registering the replica
+    with store.repl_lock:
+        if args[1] == repl_id.encode() and backlog.covers(psync_offset):
+            # the replica was ours and the bytes it missed are still in the
+            # backlog: send just those
+            client.send(f"+CONTINUE {repl_id}\r\n".encode())
+            client.sendall(backlog.read_from(psync_offset))
+            store.replica_sockets.append(client)
+            print(f"[Master] Partial resync from offset {psync_offset}, {store.master_repl_offset + 1 - psync_offset} bytes sent")
+            return None
+
+    # full resync: an rdb snapshot of the dataset, then the writes made since
+    full_resync(client, store, config)
+    return None
+
+
+def wait_command(client, args, store: RedisStore, config: Config):
+    if store.role != "master":
+        return b"-ERR WAIT cannot be used with replica instances. Please also note that since Redis 4.0 if a replica is configured to be writable (which is not the default) writes to replicas are just local and are not propagated.\r\n"
+    numreplicas = string_to_int(args[1])
+    timeout_ms = string_to_int(args[2])
+    if numreplicas is None or timeout_ms is None:
+        return b"-ERR value is not an integer or out of range\r\n"
+    if timeout_ms < 0:
+        return b"-ERR timeout is negative\r\n"
+
+    # every write made before WAIT, this client's included
+    target = store.master_repl_offset
+    acked = count_acked_replicas(store, target)
+    if acked >= numreplicas or client.client_state["in_exec"]:
+        return encode_integer(acked)
+
+    # ask the replicas where they are, then park until enough of them answered
+    store.getack_requested = True
+    if client.loop is None:
+        send_getack_if_requested(store)
+
+    def retry():
+        acked = count_acked_replicas(store, target)
+        return encode_integer(acked) if acked >= numreplicas else None
+
+    def on_timeout():
+        return encode_integer(count_acked_replicas(store, target))
+
+    return client.block(store.ack_waiters, ["ack"], timeout_ms, retry, on_timeout)
+
+
+# ---- cluster ----
+
+def cluster_command(client, args, store: RedisStore, config: Config):
+    if store.cluster is None:
+        return b"-ERR This instance has cluster support disabled\r\n"
+    return store.cluster.command(args[1:])
+
+
+def asking_command(client, args, store: RedisStore, config: Config):
+    if store.cluster is None:
+        return b"-ERR This instance has cluster support disabled\r\n"
+    client.client_state["asking"] = True
+    return OK
+
+
+def migrate_command(client, args, store: RedisStore, config: Config):
+    # MIGRATE host port key|"" destination-db timeout [COPY] [REPLACE] [KEYS key ...]
+    # the keys go to the target as RESTORE-ASKING and are deleted here once it
+    # has them. like in redis the server waits for the target meanwhile
+    port = string_to_int(args[2])
+    timeout_ms = string_to_int(args[5])
+    if port is None or timeout_ms is None:
+        return b"-ERR value is not an integer or out of range\r\n"
+    if args[4] != b"0":
+        return b"-ERR DB index is out of range\r\n"
+    copy = replace = False
+    keys = [args[3]]
+    i = 6
+    while i < len(args):
+        option = args[i].upper()
+        if option == b"COPY":
+            copy = True
+        elif option == b"REPLACE":
+            replace = True
+        elif option == b"KEYS":
+            if args[3] != b"":
+                return b"-ERR When using MIGRATE KEYS option, the key argument must be set to the empty string\r\n"
+            keys = args[i + 1:]
+            break
+        else:
+            return syntax_error()
+        i += 1
+
+    entries = []
+    for key in keys:
+        obj = store.object(key)
+        if obj is not None:
+            entries.append((key, obj, max(store.pttl(key), 0)))
+    if not entries:
+        return b"+NOKEY\r\n"
+    options = ["REPLACE"] if replace else []
+    request = b"".join(
+        encode_command(["RESTORE-ASKING", key, b"%d" % ttl, dump_object(obj)] + options)
+        for key, obj, ttl in entries
+    )
+    try:
+        with socket.create_connection((to_text(args[1]), port), timeout=(timeout_ms or 1000) / 1000) as sock:
+            sock.sendall(request)
+            replies = read_replies(sock, len(entries))
+    except OSError as e:
+        return encode_error(f"IOERR error or timeout talking to the target instance: {e}")
+
+    moved = [key for (key, _, _), reply in zip(entries, replies) if not isinstance(reply, Exception)]
+    if moved and not copy:
+        # propagated as a DEL, replicas and the aof never migrate anything
+        store.delete(moved)
+        store.dirty += 1
+        propagate_write(["DEL"] + moved, store)
+    for reply in replies:
+        if isinstance(reply, Exception):
+            return encode_error(f"ERR Target instance replied with error: {reply}")
+    return OK
+
+
+# keyed by the upper cased name as bytes, what args[0].upper() gives
+COMMAND_TABLE = {}
+
+
+def register(name, handler, arity, flags, first_key=0, last_key=0, key_step=0):
+    COMMAND_TABLE[name.encode()] = Command(name, handler, arity, flags, first_key, last_key, key_step)
+
+
+register("PING", ping_command, -1, "fast")
+register("ECHO", echo_command, 2, "fast")
+register("GET", get_command, 2, "readonly fast", 1, 1, 1)
+register("MGET", mget_command, -2, "readonly fast", 1, -1, 1)
+register("SET", set_command, -3, "write denyoom", 1, 1, 1)
+register("INCR", incr_command, 2, "write denyoom fast", 1, 1, 1)
+register("INCRBY", incrby_command, 3, "write denyoom fast", 1, 1, 1)
+register("DECR", decr_command, 2, "write denyoom fast", 1, 1, 1)
+register("DECRBY", decrby_command, 3, "write denyoom fast", 1, 1, 1)
+register("KEYS", keys_command, 2, "readonly")
+register("SCAN", scan_command, -2, "readonly")
+register("TYPE", type_command, 2, "readonly fast", 1, 1, 1)
+register("DEL", del_command, -2, "write", 1, -1, 1)
+register("OBJECT", object_command, -2, "readonly", 2, 2, 1)
+register("DUMP", dump_command, 2, "readonly", 1, 1, 1)
+register("RESTORE", restore_command, -4, "write denyoom", 1, 1, 1)
+register("RESTORE-ASKING", restore_command, -4, "write denyoom asking", 1, 1, 1)
+register("TTL", ttl_command, 2, "readonly fast", 1, 1, 1)
+register("PTTL", pttl_command, 2, "readonly fast", 1, 1, 1)
+register("EXPIRE", expire_command, -3, "write fast", 1, 1, 1)
+register("PEXPIRE", pexpire_command, -3, "write fast", 1, 1, 1)
+register("EXPIREAT", expireat_command, -3, "write fast", 1, 1, 1)
+register("PEXPIREAT", pexpireat_command, -3, "write fast", 1, 1, 1)
+register("PERSIST", persist_command, 2, "write fast", 1, 1, 1)
+register("XADD", xadd_command, -5, "write denyoom fast", 1, 1, 1)
+register("XRANGE", xrange_command, -4, "readonly", 1, 1, 1)
+register("XREAD", xread_command, -4, "readonly movablekeys")
+register("MULTI", multi_command, 1, "fast")
+register("EXEC", exec_command, 1, "")
+register("DISCARD", discard_command, 1, "fast")
+register("CONFIG", config_command, -2, "admin")
+register("INFO", info_command, -1, "")
+register("MEMORY", memory_command, -2, "readonly", 2, 2, 1)
+register("SLOWLOG", slowlog_command, -2, "admin")
+register("LATENCY", latency_command, -2, "admin")
+register("SAVE", save_command, 1, "admin noscript")
+register("BGSAVE", bgsave_command, -1, "admin noscript")
+register("LASTSAVE", lastsave_command, 1, "fast")
+register("BGREWRITEAOF", bgrewriteaof_command, 1, "admin noscript")
+register("COMMAND", command_command, -1, "")
+register("REPLCONF", replconf_command, -1, "admin")
+register("PSYNC", psync_command, 3, "admin")
+register("WAIT", wait_command, 3, "")
+register("CLUSTER", cluster_command, -2, "admin")
+register("ASKING", asking_command, 1, "fast")
+# not flagged write: the keys it moves away are propagated as a DEL
+register("MIGRATE", migrate_command, -6, "movablekeys", 3, 3, 1)
+
+
+def call(cmd: Command, client, args, store: RedisStore, config: Config):
+    # runs the handler and records it for INFO commandstats / latencystats. a
+    # handler may rewrite args for propagation (SET EX becomes PXAT), the slowlog
+    # gets what the client sent. time a threaded client spends blocked
+    # (ThreadedClientConnection.block) isn't execution time, like in redis
+    sent = list(args) if store.slowlog.enabled else args
+    blocked_ns = getattr(client, "blocked_ns", 0)
+    start = perf_counter_ns()
+    reply = cmd.handler(client, args, store, config)
+    duration = perf_counter_ns() - start - (getattr(client, "blocked_ns", 0) - blocked_ns)
+    record_call(cmd, store, duration, reply)
+    if duration >= store.slowlog.threshold_ns:
+        store.slowlog.add(client, sent, duration)
+    if store.latency.threshold_ms:
+        store.latency.add_sample("fast-command" if "fast" in cmd.flags else "command", duration / 1e6)
+    return reply
+
+
+def record_call(cmd: Command, store: RedisStore, duration, reply):
+    # in threaded mode two threads can race on a counter, a lost increment is
+    # the price of not locking every call
+    cmd.calls += 1
+    cmd.duration_ns += duration
+    cmd.latency.record(duration)
+    store.stat_numcommands += 1
+    if reply is not None and reply[:1] == b"-":
+        cmd.failed_calls += 1
+        store.stat_total_error_replies += 1
+
+
+def execute_command(client, args, store: RedisStore, config: Config):
+    # single entry point for every command: one dict lookup to find the handler,
+    # arity check from the table, MULTI queueing and propagation of writes.
+    # client is a ClientConnection (event loop) or ThreadedClientConnection
+    cmd = COMMAND_TABLE.get(args[0].upper())
+    client_state = client.client_state
+
+    if cmd is None:
+        beginning = " ".join(f"'{to_text(arg)}'" for arg in args[1:])
+        error = encode_error(f"ERR unknown command '{to_text(args[0])}', with args beginning with: {beginning}")
+    elif (cmd.arity > 0 and len(args) != cmd.arity) or len(args) < -cmd.arity:
+        error = wrong_arity_error(cmd.name)
+    elif store.maxmemory and store.over_maxmemory():
+        # make room before running anything, like redis. the threaded server
+        # already tried under every stripe (locking.LockingExecutor)
+        if store.locks is None:
+            store.evict()
+            propagate_expired_keys(store)
+        error = OOM_ERROR if "denyoom" in cmd.flags and store.over_maxmemory() else None
+    else:
+        error = None
+
+    if error is not None:
+        if client_state["multi"]:
+            client_state["exec_abort"] = True
+        if cmd is not None:
+            cmd.rejected_calls += 1
+        store.stat_total_error_replies += 1
+        client.send(error)
+        return
+
+    if client_state["multi"] and cmd.name not in TRANSACTION_COMMANDS:
+        client_state["queued_commands"].append((cmd, args))
+        client.send(QUEUED)
+        return
+
+    reply = call(cmd, client, args, store, config)
+    # keys expired while running the command are deleted on replicas first
+    if store.expired_keys:
+        propagate_expired_keys(store)
+    if reply is None:
+        # the handler already wrote to the client (or must not reply at all)
+        return
+    client.send(reply)
+    if cmd.is_write() and not reply.startswith(b"-"):
+        store.dirty += 1
+        propagate_write(args, store)
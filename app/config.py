@@ -1,13 +1,145 @@
-class Config: 
+from .log import LOG_LEVELS
+
+REDIS_VERSION = "7.2.0"
+
+MEMORY_UNITS = {
+  "b": 1,
+  "k": 1000,
+  "kb": 1024,
+  "m": 1000 ** 2,
+  "mb": 1024 ** 2,
+  "g": 1000 ** 3,
+  "gb": 1024 ** 3,
+}
+
+def parse_memory(value):
+  # accepts plain byte counts as well as redis style sizes like "64mb" or "1gb"
+  text = str(value).strip().lower()
+  for unit in sorted(MEMORY_UNITS, key=len, reverse=True):
+    if text.endswith(unit) and text[:-len(unit)].isdigit():
+      return int(text[:-len(unit)]) * MEMORY_UNITS[unit]
+  return int(text)
+
+def parse_save_params(value):
+  # "3600 1 300 100" -> [(3600, 1), (300, 100)], "" disables snapshotting.
+  # None if the value is malformed
+  parts = str(value).split()
+  if len(parts) % 2 != 0 or not all(part.isdigit() for part in parts):
+    return None
+  return [(int(parts[i]), int(parts[i + 1])) for i in range(0, len(parts), 2)]
+
+# fsync policies of the append only file
+APPENDFSYNC_POLICIES = ("always", "everysec", "no")
+
+# what to do when the dataset outgrows maxmemory, like redis
+MAXMEMORY_POLICIES = (
+  "noeviction",
+  "allkeys-lru", "volatile-lru",
+  "allkeys-lfu", "volatile-lfu",
+  "allkeys-random", "volatile-random",
+  "volatile-ttl",
+)
+
+# options only the command line can set
+IMMUTABLE_OPTIONS = {"appendonly", "appendfilename", "cluster-enabled", "cluster-config-file"}
+
+def parse_output_buffer_limit(value):
+  # "<hard> <soft> <soft seconds>" -> (hard bytes, soft bytes, seconds), 0 turns
+  # a limit off. None if the value is malformed
+  parts = str(value).split()
+  if len(parts) != 3:
+    return None
+  try:
+    hard, soft = parse_memory(parts[0]), parse_memory(parts[1])
+    seconds = int(parts[2])
+  except ValueError:
+    return None
+  if min(hard, soft, seconds) < 0:
+    return None
+  return hard, soft, seconds
+
+class Config:
   def __init__(self, dir_path="/tmp", db_file_name="dump.rdb"):
     self.config_map = {
       "dir": dir_path,
-      "db_file_name": db_file_name
+      "db_file_name": db_file_name,
+      # hard limit for the reply bytes buffered for a client, 0 = unlimited
+      "client-output-buffer-limit": 0,
+      # how many times per second the server cron runs
+      "hz": 10,
+      # share of each cron period the active expire cycle may use
+      "active-expire-cpu-percent": 25,
+      # verify the crc64 trailer of the rdb file when loading it
+      "rdbchecksum": "yes",
+      # "<seconds> <changes>" pairs that trigger a background save, empty disables
+      "save": "",
+      # log every write to the append only file, replayed on startup
+      "appendonly": "no",
+      "appendfsync": "everysec",
+      "appendfilename": "appendonly.aof",
+      # bytes of the replication stream kept for replicas that reconnect
+      "repl-backlog-size": 1024 * 1024,
+      # output buffer limits of replica connections, a replica that lags past
+      # them is disconnected (and resyncs when it reconnects)
+      "replica-output-buffer-limit": "256mb 64mb 60",
+      # cluster mode, the node's view of the cluster is kept in dir/cluster-config-file
+      "cluster-enabled": "no",
+      "cluster-config-file": "nodes.conf",
+      # bytes the dataset may use before keys are evicted, 0 = unlimited
+      "maxmemory": 0,
+      "maxmemory-policy": "noeviction",
+      # keys looked at per eviction, more is closer to true lru/lfu but slower
+      "maxmemory-samples": 5,
+      # how slowly the lfu counter grows, and the minutes it takes to lose a point
+      "lfu-log-factor": 10,
+      "lfu-decay-time": 1,
+      # debug, verbose, notice or warning (app/log.py)
+      "loglevel": "notice",
+      # commands slower than this many microseconds go to the SLOWLOG, -1 disables
+      "slowlog-log-slower-than": 10000,
+      "slowlog-max-len": 128,
+      # events slower than this many milliseconds are kept for LATENCY, 0 disables
+      "latency-monitor-threshold": 0,
     }
-    
-  def get(self, key): 
+
+  def get(self, key):
     value = self.config_map.get(key)
     if value is not None:
+        value = str(value)
         return f"*2\r\n${len(key)}\r\n{key}\r\n${len(value)}\r\n{value}\r\n".encode()
     else:
-        return b"*0\r\n"  # empty array if key not found
\ No newline at end of file
+        return b"*0\r\n"  # empty array if key not found
+
+  def get_value(self, key):
+    return self.config_map.get(key)
+
+  def set(self, key, value, startup=False):
+    if key not in self.config_map:
+      return f"-ERR Unknown option or number of arguments for CONFIG SET - '{key}'\r\n".encode()
+    if key in IMMUTABLE_OPTIONS and not startup:
+      return f"-ERR CONFIG SET failed (possibly related to argument '{key}') - can't set immutable config\r\n".encode()
+
+    # numeric settings keep their type, sizes may use memory units
+    if isinstance(self.config_map[key], int):
+      try:
+        value = parse_memory(value)
+      except ValueError:
+        return f"-ERR Invalid argument '{value}' for CONFIG SET '{key}'\r\n".encode()
+
+    if key == "save" and parse_save_params(value) is None:
+      return f"-ERR Invalid argument '{value}' for CONFIG SET '{key}'\r\n".encode()
+
+    if key == "replica-output-buffer-limit" and parse_output_buffer_limit(value) is None:
+      return f"-ERR Invalid argument '{value}' for CONFIG SET '{key}'\r\n".encode()
+
+    if key == "loglevel" and value not in LOG_LEVELS:
+      return f"-ERR Invalid argument '{value}' for CONFIG SET '{key}'\r\n".encode()
+
+    if key == "maxmemory-policy" and value not in MAXMEMORY_POLICIES:
+      return f"-ERR Invalid argument '{value}' for CONFIG SET '{key}'\r\n".encode()
+
+    if key == "appendfsync" and value not in APPENDFSYNC_POLICIES:
+      return f"-ERR Invalid argument '{value}' for CONFIG SET '{key}'\r\n".encode()
+
+    self.config_map[key] = value
+    return b"+OK\r\n"
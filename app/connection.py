@@ -0,0 +1,314 @@
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+from app.blocking import ThreadWaiter
+from app.resp import RespParser
+
+# small replies are coalesced into blocks of this size, bigger ones are queued as is
+REPLY_CHUNK_BYTES = 16 * 1024
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+class ClientConnection:
+    # per-connection state for the event loop server: the socket is non-blocking,
+    # incoming bytes accumulate in the request parser until full commands are
+    # available and replies accumulate in the output buffer until the loop
+    # flushes them, once per loop iteration, with a single sendmsg
+    def __init__(self, sock: socket.socket, addr, loop=None, output_limit=0):
+        self.sock = sock
+        self.addr = addr
+        self.loop = loop
+        self.parser = RespParser()
+        # parsed commands waiting their turn, they pile up while the client is blocked
+        self.pending_commands = deque()
+        # set by the loop while the client waits in a blocking command
+        self.blocked = None
+        # set by the loop: runs this connection's commands, executor(conn, args)
+        self.executor = None
+        # output buffer: a list of chunks plus how much of the first one is already written
+        self.reply_chunks = []
+        self.reply_offset = 0
+        self.reply_bytes = 0
+        # hard cap on buffered reply bytes, 0 means unlimited
+        self.output_limit = output_limit
+        # soft cap: may be exceeded for at most soft_seconds in a row (replicas)
+        self.soft_limit = 0
+        self.soft_seconds = 0
+        self.soft_since = None
+        # every byte ever queued, and where the bulk payload of a full resync
+        # ends. the payload doesn't count against the limits
+        self.queued_total = 0
+        self.exempt_until = 0
+        self.client_state = {
+            "multi": False,
+            "queued_commands": [],
+            # set when a command is rejected while queueing, EXEC then fails
+            "exec_abort": False,
+            # true while EXEC runs the queue, blocking commands don't block then
+            "in_exec": False,
+            # set by ASKING, lets the next command into a slot being imported
+            "asking": False
+        }
+        # whether the socket is currently registered for writable events
+        self.want_write = False
+        # set after a protocol error or an output buffer overflow, the connection
+        # is closed once whatever is left in the output buffer is written
+        self.close_after_reply = False
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    # same signature as socket.send so the command handlers don't care which
+    # server mode they are running under
+    def send(self, data: bytes):
+        if self.closed:
+            raise ConnectionError("Client connection is closed")
+        if self.close_after_reply:
+            return len(data)
+        if not self.reply_chunks and self.loop is not None:
+            self.loop.mark_pending_write(self)
+
+        size = len(data)
+        chunks = self.reply_chunks
+        if size < REPLY_CHUNK_BYTES:
+            # coalesce small replies so a pipeline of N commands is a handful of
+            # iovecs rather than N of them
+            if chunks and type(chunks[-1]) is bytearray and len(chunks[-1]) + size <= REPLY_CHUNK_BYTES:
+                chunks[-1] += data
+            else:
+                chunks.append(bytearray(data))
+        else:
+            chunks.append(data)
+        self.reply_bytes += size
+        self.queued_total += size
+
+        if self.output_limit or self.soft_limit:
+            self._check_output_limits()
+        return size
+
+    def _check_output_limits(self):
+        pending = self.reply_bytes - self.reply_offset
+        written = self.queued_total - pending
+        pending -= max(0, self.exempt_until - written)
+        over = None
+        if self.output_limit and pending > self.output_limit:
+            over = f"over {self.output_limit} bytes"
+        elif self.soft_limit and pending > self.soft_limit:
+            now = time.monotonic()
+            if self.soft_since is None:
+                self.soft_since = now
+            elif now - self.soft_since > self.soft_seconds:
+                over = f"over {self.soft_limit} bytes for {self.soft_seconds}s"
+        else:
+            self.soft_since = None
+        if over is not None:
+            print(f"[Client] {self.addr} output buffer {over}, closing connection")
+            self.discard_replies()
+            self.close_after_reply = True
+
+    def drop(self):
+        # close the connection from outside its owner: pending replies are
+        # discarded and the loop closes it on its next write pass
+        self.discard_replies()
+        self.close_after_reply = True
+        if self.loop is not None and not self.closed:
+            self.loop.mark_pending_write(self)
+
+    def send_payload(self, data):
+        # bulk data (an rdb) that is queued like a reply but exempt from the limits
+        self.exempt_until = self.queued_total + len(data)
+        return self.send(data)
+
+    def set_output_limits(self, hard, soft, soft_seconds):
+        self.output_limit = hard
+        self.soft_limit = soft
+        self.soft_seconds = soft_seconds
+
+    # replies are buffered, so sendall is the same as send
+    sendall = send
+
+    def has_pending_replies(self):
+        return bool(self.reply_chunks)
+
+    def discard_replies(self):
+        self.reply_chunks = []
+        self.reply_offset = 0
+        self.reply_bytes = 0
+
+    def write_replies(self):
+        # scatter/gather write of the output buffer. returns once everything is
+        # written, raises BlockingIOError when a non-blocking socket is full
+        chunks = self.reply_chunks
+        while chunks:
+            batch = chunks[:IOV_MAX]
+            views = [memoryview(chunk) for chunk in batch]
+            first = views[0]
+            if self.reply_offset:
+                views[0] = first[self.reply_offset:]
+            try:
+                sent = self.sock.sendmsg(views)
+            finally:
+                for view in views:
+                    view.release()
+                first.release()
+
+            # drop every chunk that went out completely, remember how far we got
+            # into the first one that didn't (short write)
+            sent += self.reply_offset
+            done = 0
+            for chunk in batch:
+                if sent < len(chunk):
+                    break
+                sent -= len(chunk)
+                self.reply_bytes -= len(chunk)
+                done += 1
+            del chunks[:done]
+            self.reply_offset = sent
+
+    def block(self, registry, keys, timeout_ms, retry, timeout_reply):
+        # park the client until one of the keys is written or timeout_ms passes
+        # (0 waits forever). retry() returns the reply once the command can be
+        # served, None otherwise. timeout_reply is the reply on timeout, or a
+        # function producing it. the loop sends the reply later, so nothing is
+        # returned here
+        self.loop.block_client(self, registry, keys, timeout_ms, retry, timeout_reply)
+        return None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.discard_replies()
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class ThreadedClientConnection(ClientConnection):
+    # connection used by the thread-per-connection server. the socket is blocking,
+    # the owning thread flushes once per read, and since other threads may write
+    # into it too (propagation to a replica) the output buffer is guarded by a lock
+    def __init__(self, sock: socket.socket, addr, output_limit=0):
+        super().__init__(sock, addr, loop=None, output_limit=output_limit)
+        self.write_lock = threading.Lock()
+        self.write_cond = threading.Condition(self.write_lock)
+        # set for replicas: writes are only queued, a writer thread sends them
+        self.async_writes = False
+        # the locks the running command holds (locking.HeldLocks)
+        self.held_locks = None
+        # total time spent parked in block(), commands.call leaves it out of the
+        # command's duration
+        self.blocked_ns = 0
+
+    def send(self, data: bytes):
+        with self.write_lock:
+            size = super().send(data)
+            if self.async_writes:
+                self.write_cond.notify()
+            return size
+
+    # socket.sendall semantics: the data is on the wire when this returns,
+    # except for asynchronous connections where it is queued like send
+    def sendall(self, data: bytes):
+        with self.write_lock:
+            super().send(data)
+            if self.async_writes:
+                self.write_cond.notify()
+            else:
+                self.write_replies()
+
+    def flush(self):
+        with self.write_lock:
+            if self.async_writes:
+                self.write_cond.notify()
+            else:
+                self.write_replies()
+
+    def close(self):
+        super().close()
+        with self.write_cond:
+            self.write_cond.notify_all()
+
+    def drop(self):
+        with self.write_cond:
+            super().drop()
+            self.write_cond.notify_all()
+        # the reader thread wakes up and closes the connection
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def start_async_writer(self):
+        # a replica gets every write the master propagates. queueing them and
+        # sending from a thread of its own means a slow replica only ever delays
+        # itself, never the client thread that made the write
+        with self.write_lock:
+            if self.async_writes:
+                return
+            self.async_writes = True
+        threading.Thread(target=self._drain_replies, daemon=True).start()
+
+    def _drain_replies(self):
+        while True:
+            with self.write_cond:
+                while not self.reply_chunks and not self.closed and not self.close_after_reply:
+                    self.write_cond.wait()
+                if self.closed or self.close_after_reply:
+                    break
+                # take the queue as a whole, senders start a new one meanwhile
+                batch = self.reply_chunks
+                self.reply_chunks = []
+            try:
+                for chunk in batch:
+                    self.sock.sendall(chunk)
+            except OSError as e:
+                print(f"[Client] {self.addr} write failed: {e}")
+                break
+            with self.write_cond:
+                self.reply_bytes -= sum(len(chunk) for chunk in batch)
+        # wakes up the connection's reader thread, which closes the connection
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    # the connection has its own thread, so blocking simply parks that thread.
+    # the command's locks are released while it waits
+    def block(self, registry, keys, timeout_ms, retry, timeout_reply):
+        held = self.held_locks
+        waiter = ThreadWaiter()
+        registry.add(keys, waiter)
+        deadline = time.monotonic() + timeout_ms / 1000 if timeout_ms else None
+        try:
+            # a write may have landed between the caller's check and add()
+            reply = retry()
+            while reply is None:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return timeout_reply() if callable(timeout_reply) else timeout_reply
+                if held is not None:
+                    held.release()
+                parked = time.perf_counter_ns()
+                try:
+                    woken = waiter.wait(remaining)
+                finally:
+                    if held is not None:
+                        held.acquire()
+                    self.blocked_ns += time.perf_counter_ns() - parked
+                if woken:
+                    reply = retry()
+            return reply
+        finally:
+            registry.remove(keys, waiter)
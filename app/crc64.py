@@ -0,0 +1,40 @@
+import sys
+
+# crc-64/jones, the checksum redis appends to rdb files (reflected, init 0).
+# CRC64("123456789") == 0xe9c6d914c4b8d9ca
+POLY = 0x95AC9329AC4BC9B5
+
+
+def _make_tables():
+  # slicing by 8: TABLES[k][b] is the crc of byte b followed by k zero bytes, so
+  # one 64 bit word is folded in with 8 lookups instead of 8 loop iterations
+  base = []
+  for i in range(256):
+    crc = i
+    for _ in range(8):
+      crc = (crc >> 1) ^ POLY if crc & 1 else crc >> 1
+    base.append(crc)
+  tables = [base]
+  for _ in range(7):
+    prev = tables[-1]
+    tables.append([(prev[i] >> 8) ^ base[prev[i] & 0xFF] for i in range(256)])
+  return tables
+
+
+TABLES = _make_tables()
+
+
+def crc64(data, crc=0):
+  # data is any bytes-like object, crc lets a checksum be built incrementally
+  table = TABLES[0]
+  data = memoryview(data).cast("B")
+  words = len(data) // 8 * 8 if sys.byteorder == "little" else 0
+  if words:
+    t0, t1, t2, t3, t4, t5, t6, t7 = TABLES
+    for word in data[:words].cast("Q"):
+      crc ^= word
+      crc = (t7[crc & 0xFF] ^ t6[(crc >> 8) & 0xFF] ^ t5[(crc >> 16) & 0xFF] ^ t4[(crc >> 24) & 0xFF]
+             ^ t3[(crc >> 32) & 0xFF] ^ t2[(crc >> 40) & 0xFF] ^ t1[(crc >> 48) & 0xFF] ^ t0[crc >> 56])
+  for b in data[words:]:
+    crc = table[(crc ^ b) & 0xFF] ^ (crc >> 8)
+  return crc
@@ -0,0 +1,69 @@
+import threading
+import time
+
+from app.config import Config
+from app.aof import check_scheduled_rewrite
+from app.evict import lru_clock
+from app.persistence import check_background_job, check_save_triggers
+from app.redis_store import RedisStore
+from app.replication import check_replica_syncs, propagate_expired_keys
+
+
+def server_cron(store: RedisStore, config: Config):
+    # periodic housekeeping, runs `hz` times per second: on a loop timer in event
+    # loop mode, on a dedicated thread in threaded mode
+    store.lru_clock = lru_clock()
+    store.used_memory_peak = max(store.used_memory_peak, store.used_memory)
+    store.ops_sec.track(store.stat_numcommands, time.monotonic())
+    check_background_job(store)
+    # finishes a resize of the SCAN index on an idle server, a millisecond a tick
+    with store.index_lock:
+        store.keyspace.rehash_for(1)
+    if store.role == "master":
+        check_replica_syncs(store, config)
+    check_save_triggers(store, config)
+    if store.aof is not None:
+        check_scheduled_rewrite(store, config)
+        # picks up the once a second fsync even when no write came in
+        store.aof.flush()
+    if store.role == "master":
+        # CONFIG SET repl-backlog-size takes effect here
+        with store.repl_lock:
+            store.repl_backlog.resize(max(1, config.get_value("repl-backlog-size")))
+        # each run may spend active-expire-cpu-percent of its period expiring keys
+        hz = max(1, config.get_value("hz"))
+        budget_ms = 1000 / hz * config.get_value("active-expire-cpu-percent") / 100
+        store.active_expire_cycle(budget_ms)
+        # a lowered maxmemory is enforced here even when no command comes in
+        if store.maxmemory and store.over_maxmemory():
+            store.evict()
+        propagate_expired_keys(store)
+
+
+def cron_period(config: Config):
+    return 1 / max(1, config.get_value("hz"))
+
+
+def schedule_cron(loop, store: RedisStore, config: Config):
+    def tick():
+        try:
+            server_cron(store, config)
+        except Exception as e:
+            print(f"[Cron] Error in server cron: {e}")
+        loop.call_later(cron_period(config), tick)
+
+    loop.call_later(cron_period(config), tick)
+
+
+def start_cron_thread(store: RedisStore, config: Config):
+    def run():
+        while True:
+            time.sleep(cron_period(config))
+            try:
+                # expiry, snapshots and syncs look at the whole keyspace
+                with store.locks.exclusive():
+                    server_cron(store, config)
+            except Exception as e:
+                print(f"[Cron] Error in server cron: {e}")
+
+    threading.Thread(target=run, daemon=True).start()
@@ -0,0 +1,334 @@
+import heapq
+import itertools
+import resource
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+from app.connection import ClientConnection
+
+BUFF_SIZE = 16 * 1024
+# how many pending connections we accept per readable event on the listening socket
+MAX_ACCEPTS_PER_CALL = 1000
+
+
+def raise_open_files_limit():
+    # every client is a file descriptor, so holding 10k+ connections needs a higher
+    # RLIMIT_NOFILE than the usual default of 1024
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            print(f"[EventLoop] Raised open files limit from {soft} to {hard}")
+    except (ValueError, OSError) as e:
+        print(f"[EventLoop] Could not raise open files limit: {e}")
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "cancelled")
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class BlockedClient:
+    # a client parked in a blocking command, registered as a waiter on its keys
+    __slots__ = ("loop", "conn", "registry", "keys", "retry", "timeout_reply", "timer")
+
+    def __init__(self, loop, conn, registry, keys, retry, timeout_reply):
+        self.loop = loop
+        self.conn = conn
+        self.registry = registry
+        self.keys = keys
+        self.retry = retry
+        self.timeout_reply = timeout_reply
+        self.timer = None
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.loop.ready_blocked.add, self.conn)
+
+
+class EventLoopServer:
+    # single threaded server: one selector (epoll on linux) multiplexes the listening
+    # socket and every client socket, commands run on the loop thread one at a time.
+    # timers (blocking command timeouts) live in a heap and bound the select timeout
+    def __init__(self, server_socket: socket.socket, executor, config):
+        self.server_socket = server_socket
+        self.config = config
+        # executor(conn, args) runs one parsed command and writes replies into conn
+        self.executor = executor
+        self.selector = selectors.DefaultSelector()
+        self.clients = {}
+        self.pending_writes = set()
+        # blocked clients whose keys changed since the last iteration
+        self.ready_blocked = set()
+        self.timers = []
+        self.timer_seq = itertools.count()
+        # callbacks scheduled from other threads, run on the loop thread
+        self.callbacks = deque()
+        self.loop_thread = None
+        # run once per iteration before replies go out (the aof flush)
+        self.before_sleep = []
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+
+    def serve_forever(self):
+        raise_open_files_limit()
+        self.loop_thread = threading.get_ident()
+        self.listen(self.server_socket, self.executor)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, self._drain_wakeup)
+        print("[EventLoop] Serving clients from a single event loop")
+        while True:
+            events = self.selector.select(self._select_timeout())
+            for key, mask in events:
+                callback = key.data
+                callback(key.fileobj, mask)
+            self._run_callbacks()
+            self._run_timers()
+            self._serve_unblocked_clients()
+            for callback in self.before_sleep:
+                callback()
+            self._flush_pending_writes()
+
+    def listen(self, server_socket: socket.socket, executor):
+        # clients accepted on server_socket run their commands with executor, the
+        # shard workers listen on a unix socket for commands other shards forward
+        server_socket.setblocking(False)
+        self.selector.register(server_socket, selectors.EVENT_READ, lambda sock, mask: self._accept(sock, executor))
+
+    def mark_pending_write(self, conn: ClientConnection):
+        self.pending_writes.add(conn)
+
+    # ---- timers and cross thread wakeups ----
+
+    def call_later(self, delay, callback):
+        timer = Timer(time.monotonic() + delay, callback)
+        heapq.heappush(self.timers, (timer.deadline, next(self.timer_seq), timer))
+        return timer
+
+    def call_soon_threadsafe(self, callback, *args):
+        if threading.get_ident() == self.loop_thread:
+            callback(*args)
+            return
+        self.callbacks.append((callback, args))
+        try:
+            self.wakeup_writer.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            # the pipe is already full of wakeups, the loop will run anyway
+            pass
+
+    def run_threadsafe(self, callback, *args):
+        # call_soon_threadsafe that waits for the callback to have run on the loop
+        # and returns its result, for a thread that changes the dataset (the
+        # replica's link with its master)
+        if threading.get_ident() == self.loop_thread:
+            return callback(*args)
+        done = threading.Event()
+        outcome = []
+
+        def run():
+            try:
+                outcome.append((True, callback(*args)))
+            except BaseException as e:
+                outcome.append((False, e))
+            finally:
+                done.set()
+
+        self.call_soon_threadsafe(run)
+        done.wait()
+        ok, value = outcome[0]
+        if not ok:
+            raise value
+        return value
+
+    def _drain_wakeup(self, sock, mask):
+        try:
+            while sock.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _run_callbacks(self):
+        callbacks = self.callbacks
+        while callbacks:
+            callback, args = callbacks.popleft()
+            callback(*args)
+
+    def _select_timeout(self):
+        timers = self.timers
+        while timers and timers[0][2].cancelled:
+            heapq.heappop(timers)
+        if self.callbacks or self.ready_blocked:
+            return 0
+        if not timers:
+            return None
+        return max(0.0, timers[0][0] - time.monotonic())
+
+    def _run_timers(self):
+        timers = self.timers
+        now = time.monotonic()
+        while timers and timers[0][0] <= now:
+            _, _, timer = heapq.heappop(timers)
+            if not timer.cancelled:
+                timer.callback()
+
+    # ---- blocking commands ----
+
+    def block_client(self, conn: ClientConnection, registry, keys, timeout_ms, retry, timeout_reply):
+        blocked = BlockedClient(self, conn, registry, keys, retry, timeout_reply)
+        conn.blocked = blocked
+        registry.add(keys, blocked)
+        if timeout_ms:
+            blocked.timer = self.call_later(timeout_ms / 1000, lambda: self._block_timeout(conn, blocked))
+
+    def _unblock(self, conn: ClientConnection):
+        blocked = conn.blocked
+        conn.blocked = None
+        blocked.registry.remove(blocked.keys, blocked)
+        if blocked.timer is not None:
+            blocked.timer.cancel()
+        self.ready_blocked.discard(conn)
+
+    def _block_timeout(self, conn: ClientConnection, blocked: BlockedClient):
+        if conn.closed or conn.blocked is not blocked:
+            return
+        self._unblock(conn)
+        reply = blocked.timeout_reply
+        conn.send(reply() if callable(reply) else reply)
+        self._process_commands(conn)
+
+    def _serve_unblocked_clients(self):
+        # serving a client can run its pipelined commands, which may wake others
+        while self.ready_blocked:
+            ready = self.ready_blocked
+            self.ready_blocked = set()
+            for conn in ready:
+                blocked = conn.blocked
+                if conn.closed or blocked is None:
+                    continue
+                reply = blocked.retry()
+                if reply is None:
+                    continue
+                self._unblock(conn)
+                conn.send(reply)
+                self._process_commands(conn)
+
+    # ---- client io ----
+
+    def _accept(self, server_socket, executor):
+        for _ in range(MAX_ACCEPTS_PER_CALL):
+            try:
+                sock, addr = server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"[EventLoop] Accept failed: {e}")
+                return
+            sock.setblocking(False)
+            if sock.family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            output_limit = self.config.get_value("client-output-buffer-limit")
+            conn = ClientConnection(sock, addr, loop=self, output_limit=output_limit)
+            conn.executor = executor
+            self.clients[sock.fileno()] = conn
+            self.selector.register(sock, selectors.EVENT_READ, self._on_event)
+
+    def _on_event(self, sock, mask):
+        conn = self.clients.get(sock.fileno())
+        if conn is None:
+            return
+        if mask & selectors.EVENT_WRITE:
+            self._write_to_client(conn)
+        if mask & selectors.EVENT_READ and not conn.closed:
+            self._read_from_client(conn)
+
+    def _read_from_client(self, conn: ClientConnection):
+        try:
+            chunk = conn.sock.recv(BUFF_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            print(f"[EventLoop] Read error from {conn.addr}: {e}")
+            self._close(conn)
+            return
+        if not chunk:
+            self._close(conn)
+            return
+
+        if conn.close_after_reply:
+            return
+        conn.parser.feed(chunk)
+        conn.pending_commands.extend(conn.parser.parse())
+        self._process_commands(conn)
+
+    def _process_commands(self, conn: ClientConnection):
+        # every complete command in this read is executed before we go back to the
+        # selector, replies stay buffered until the end of the loop iteration and
+        # then go out together. a blocked client keeps the rest of its pipeline
+        # queued until it is served
+        pending = conn.pending_commands
+        while pending and conn.blocked is None:
+            args = pending.popleft()
+            try:
+                conn.executor(conn, args)
+            except Exception as e:
+                print(f"[EventLoop] Exception while executing {args}: {e}")
+                self._close(conn)
+                return
+            if conn.closed:
+                return
+
+        if conn.parser.error is not None and not pending and conn.blocked is None:
+            conn.send(f"-ERR Protocol error: {conn.parser.error}\r\n".encode())
+            conn.close_after_reply = True
+
+    def _write_to_client(self, conn: ClientConnection):
+        try:
+            conn.write_replies()
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            print(f"[EventLoop] Write error to {conn.addr}: {e}")
+            self._close(conn)
+            return
+
+        if conn.close_after_reply and not conn.has_pending_replies():
+            self._close(conn)
+            return
+
+        # only ask for writable events while there is something left to write
+        want_write = conn.has_pending_replies()
+        if want_write != conn.want_write:
+            events = selectors.EVENT_READ
+            if want_write:
+                events |= selectors.EVENT_WRITE
+            self.selector.modify(conn.sock, events, self._on_event)
+            conn.want_write = want_write
+
+    def _flush_pending_writes(self):
+        pending = self.pending_writes
+        self.pending_writes = set()
+        for conn in pending:
+            if not conn.closed:
+                self._write_to_client(conn)
+
+    def _close(self, conn: ClientConnection):
+        if conn.closed:
+            return
+        if conn.blocked is not None:
+            self._unblock(conn)
+        self.clients.pop(conn.fileno(), None)
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        self.pending_writes.discard(conn)
+        conn.close()
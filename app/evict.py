@@ -0,0 +1,191 @@
+import random
+import resource
+import sys
+import time
+
+from .redis_object import HASH, LIST, SET, STREAM, STRING, ZSET
+
+# ---- memory accounting ----
+
+# what a key costs beyond its name and value: its slot in the main dict and in
+# the scan index, and the RedisObject
+KEY_OVERHEAD = 96
+STREAM_OVERHEAD = 200
+# a list, a python int and two array slots per stream entry
+STREAM_ENTRY_OVERHEAD = 56 + 16
+_getsizeof = sys.getsizeof
+
+
+def stream_entry_size(fields):
+  return STREAM_ENTRY_OVERHEAD + 8 * len(fields) + sum(_getsizeof(item) for item in fields)
+
+
+def value_size(obj):
+  # an estimate of what the value takes in memory. counters stored as ints are
+  # small cached objects or a few bytes, counted as nothing
+  value = obj.value
+  kind = obj.type
+  if kind == STRING:
+    return 0 if type(value) is int else _getsizeof(value)
+  if kind == STREAM:
+    return STREAM_OVERHEAD + sum(stream_entry_size(fields) for fields in value.fields)
+  if kind in (LIST, SET):
+    return _getsizeof(value) + sum(_getsizeof(item) for item in value)
+  if kind == ZSET:
+    return _getsizeof(value) + sum(_getsizeof(member) + 24 for member in value)
+  if kind == HASH:
+    return _getsizeof(value) + sum(_getsizeof(field) + _getsizeof(v) for field, v in value.items())
+  return 0
+
+
+def object_size(key, obj):
+  return KEY_OVERHEAD + _getsizeof(key) + value_size(obj)
+
+
+def process_rss():
+  # resident set size of the process, the peak where /proc isn't available
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * resource.getpagesize()
+  except (OSError, ValueError, IndexError):
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def bytes_to_human(n):
+  # like redis' bytesToHuman: 1023B, 1.00K, 15.25M
+  for unit, size in (("G", 1024 ** 3), ("M", 1024 ** 2), ("K", 1024)):
+    if n >= size:
+      return f"{n / size:.2f}{unit}"
+  return f"{n}B"
+
+
+# ---- access metadata ----
+#
+# every RedisObject has a single int slot, lru. with an lru policy it holds the
+# time of the last access in seconds, 24 bits wide like redis' LRU clock. with an
+# lfu policy it holds the minutes of the last decrement in the upper 16 bits and
+# a logarithmic access counter in the lower 8
+
+LRU_CLOCK_MAX = (1 << 24) - 1
+LFU_INIT_VAL = 5
+
+
+def lru_clock():
+  return int(time.time()) & LRU_CLOCK_MAX
+
+
+def idle_seconds(lru, clock):
+  # the clock wraps every ~194 days
+  return clock - lru if clock >= lru else clock + LRU_CLOCK_MAX - lru
+
+
+def lfu_minutes():
+  return (int(time.time()) // 60) & 0xFFFF
+
+
+def lfu_initial():
+  # a new key starts at LFU_INIT_VAL so it isn't the first one to go
+  return (lfu_minutes() << 8) | LFU_INIT_VAL
+
+
+def lfu_decay(lru, decay_time):
+  # the counter after decay_time minutes per point of idleness were taken off
+  counter = lru & 0xFF
+  if decay_time <= 0:
+    return counter
+  now = lfu_minutes()
+  last = lru >> 8
+  elapsed = now - last if now >= last else 0xFFFF - last + now
+  periods = elapsed // decay_time
+  return max(0, counter - periods)
+
+
+def restored_lru(lfu, clock, idletime, freq):
+  # the metadata RESTORE's IDLETIME / FREQ ask for, None when the hint doesn't
+  # apply to the current policy and the key starts fresh
+  if lfu and freq is not None:
+    return (lfu_minutes() << 8) | freq
+  if not lfu and idletime is not None:
+    return (clock - idletime) & LRU_CLOCK_MAX
+  return None
+
+
+def lfu_touch(lru, log_factor, decay_time):
+  # the counter grows with probability 1 / ((counter - LFU_INIT_VAL) * log_factor + 1),
+  # so it reaches 255 only after about a million hits with the default factor
+  counter = lfu_decay(lru, decay_time)
+  if counter < 255:
+    base = max(0, counter - LFU_INIT_VAL)
+    if random.random() < 1.0 / (base * log_factor + 1):
+      counter += 1
+  return (lfu_minutes() << 8) | counter
+
+
+# ---- eviction ----
+
+EVICTION_POOL_SIZE = 16
+
+
+class EvictionPool:
+  # the best candidates seen by the last sampling rounds, like redis' evictionPool:
+  # each round samples a few random keys and keeps the ones with the highest
+  # score, so evicting is O(samples) and every access stays O(1). candidates are
+  # checked again when picked, they may have been deleted or touched since
+  def __init__(self):
+    self.entries = []
+
+  def offer(self, score, key):
+    entries = self.entries
+    if len(entries) >= EVICTION_POOL_SIZE and score <= entries[0][0]:
+      return
+    for i, (_, existing) in enumerate(entries):
+      if existing == key:
+        entries[i] = (score, key)
+        entries.sort()
+        return
+    entries.append((score, key))
+    entries.sort()
+    if len(entries) > EVICTION_POOL_SIZE:
+      del entries[0]
+
+  def pop_best(self):
+    return self.entries.pop()[1] if self.entries else None
+
+  def clear(self):
+    self.entries.clear()
+
+
+def eviction_score(store, policy, key, clock):
+  # higher is evicted first, None for a key that is gone
+  entry = store.data.get(key)
+  if entry is None:
+    return None
+  if policy.endswith("lru"):
+    return idle_seconds(entry.lru, clock)
+  if policy.endswith("lfu"):
+    return 255 - lfu_decay(entry.lru, store.lfu_decay_time)
+  # volatile-ttl: the sooner it expires the better
+  expiry = store.expires.get(key)
+  return None if expiry is None else -expiry
+
+
+def pick_eviction_candidate(store, policy, samples):
+  # a key to evict under policy, None if there is none
+  volatile = policy.startswith("volatile")
+  if policy.endswith("random"):
+    keys = store.expires.random_keys(1) if volatile else store.keyspace.random_keys(1)
+    return keys[0] if keys else None
+  clock = store.lru_clock
+  pool = store.eviction_pool
+  sampled = store.expires.random_keys(samples) if volatile else store.keyspace.random_keys(samples)
+  for key in sampled:
+    score = eviction_score(store, policy, key, clock)
+    if score is not None:
+      pool.offer(score, key)
+  while True:
+    key = pool.pop_best()
+    if key is None:
+      return None
+    # still there (and still volatile) since it was sampled
+    if key in store.data and (not volatile or key in store.expires):
+      return key
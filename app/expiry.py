@@ -0,0 +1,89 @@
+import heapq
+import random
+import threading
+import time
+
+# how many due keys are handled between two checks of the time budget
+KEYS_PER_BUDGET_CHECK = 20
+
+
+class ExpiryIndex:
+  # the volatile keys of the keyspace: deadlines maps key -> absolute expiry in ms
+  # and is the source of truth, heap orders (deadline, key) pairs so the active
+  # cycle only ever looks at keys that are actually due. persisting or re-setting
+  # a key leaves its old heap entry behind, stale entries are skipped when popped
+  # and the heap is rebuilt once they outnumber the live ones
+  def __init__(self):
+    self.deadlines = {}
+    self.heap = []
+    # threads of the threaded server set and remove ttls side by side, a rebuild
+    # must not iterate deadlines while another thread changes it: every change to
+    # deadlines takes this lock
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.deadlines)
+
+  def __contains__(self, key):
+    return key in self.deadlines
+
+  def get(self, key):
+    return self.deadlines.get(key)
+
+  def set(self, key, when_ms):
+    with self.lock:
+      self.deadlines[key] = when_ms
+      heapq.heappush(self.heap, (when_ms, key))
+      if len(self.heap) > 2 * len(self.deadlines) + 1024:
+        self._rebuild()
+
+  def remove(self, key):
+    with self.lock:
+      return self.deadlines.pop(key, None) is not None
+
+  def clear(self):
+    with self.lock:
+      self.deadlines.clear()
+      self.heap.clear()
+
+  def _rebuild(self):
+    self.heap = [(when, key) for key, when in self.deadlines.items()]
+    heapq.heapify(self.heap)
+
+  def random_keys(self, count):
+    # up to count random volatile keys, sampled from the heap. stale entries are
+    # at most two thirds of it (see set), they are skipped
+    heap, deadlines = self.heap, self.deadlines
+    keys = []
+    for _ in range(count * 3):
+      if not heap:
+        break
+      when, key = heap[random.randrange(len(heap))]
+      if deadlines.get(key) == when:
+        keys.append(key)
+        if len(keys) >= count:
+          break
+    return keys
+
+  def next_deadline(self):
+    heap, deadlines = self.heap, self.deadlines
+    while heap and deadlines.get(heap[0][1]) != heap[0][0]:
+      heapq.heappop(heap)
+    return heap[0][0] if heap else None
+
+  def pop_due(self, now_ms, deadline, expire_key):
+    # expire every key due at now_ms until the time budget (a perf_counter
+    # deadline) runs out. expire_key(key) deletes one key. returns how many keys
+    # were expired and whether due keys were left behind for the next cycle
+    heap, deadlines = self.heap, self.deadlines
+    expired = 0
+    checked = 0
+    while heap and heap[0][0] <= now_ms:
+      when, key = heapq.heappop(heap)
+      if deadlines.get(key) == when:
+        expire_key(key)
+        expired += 1
+      checked += 1
+      if checked % KEYS_PER_BUDGET_CHECK == 0 and time.perf_counter() >= deadline:
+        return expired, bool(heap) and heap[0][0] <= now_ms
+    return expired, False
@@ -0,0 +1,199 @@
+import random
+import time
+
+# average number of keys per bucket before the table doubles, and below which
+# it halves again. a few keys per bucket keeps the index overhead a fraction of
+# the keyspace itself. buckets are dicts of key -> None rather than sets: a dict
+# holding only bytes is untracked by the cyclic gc, so millions of buckets don't
+# make every full collection longer
+BUCKET_LOAD = 8
+MIN_BUCKETS = 16
+# buckets moved to the new table by every add and remove while resizing, and by
+# each step of rehash_for
+REHASH_STEP = 1
+REHASH_CRON_STEP = 100
+
+MASK64 = (1 << 64) - 1
+
+
+def _rev64(v):
+  return int(f"{v:064b}"[::-1], 2)
+
+
+def _next_cursor(cursor, mask):
+  # increment the reversed cursor, the bits above the mask are kept set so the
+  # carry skips them
+  return _rev64((_rev64(cursor | (~mask & MASK64)) + 1) & MASK64)
+
+
+class KeyspaceIndex:
+  # the keys of the keyspace spread over 2^n buckets by hash, so SCAN can walk
+  # the keyspace a few buckets at a time with a cursor. the cursor is the bucket
+  # number incremented on its reversed bits, like redis' dictScan: every key that
+  # exists for the whole scan is returned at least once even if the table grows
+  # or shrinks between calls, and keys added or removed meanwhile may or may not be.
+  #
+  # resizing is incremental like redis' rehashing: the new table is allocated
+  # and the buckets of the old one move over a few at a time, on every add and
+  # remove and from the cron (rehash_for), so no insert pays for the whole
+  # keyspace. while both tables exist new keys go to the new one. an empty bucket
+  # is None, so allocating a table of millions of buckets is a single list
+  def __init__(self):
+    self.buckets = [None] * MIN_BUCKETS
+    self.mask = MIN_BUCKETS - 1
+    # the table being grown or shrunk into, and the next bucket of buckets to move
+    self.new_buckets = None
+    self.new_mask = 0
+    self.rehash_idx = 0
+    self.size = 0
+
+  def __len__(self):
+    return self.size
+
+  def is_rehashing(self):
+    return self.new_buckets is not None
+
+  def add(self, key):
+    h = hash(key)
+    if self.new_buckets is not None:
+      self._rehash(REHASH_STEP)
+    bucket = self.buckets[h & self.mask]
+    if bucket is not None and key in bucket:
+      return
+    if self.new_buckets is not None:
+      buckets, i = self.new_buckets, h & self.new_mask
+      bucket = buckets[i]
+      if bucket is not None and key in bucket:
+        return
+    else:
+      buckets, i = self.buckets, h & self.mask
+      bucket = buckets[i]
+    if bucket is None:
+      buckets[i] = {key: None}
+    else:
+      bucket[key] = None
+    self.size += 1
+    if self.new_buckets is None and self.size > len(self.buckets) * BUCKET_LOAD:
+      self._start_resize(len(self.buckets) * 2)
+
+  def remove(self, key):
+    h = hash(key)
+    if self.new_buckets is not None:
+      self._rehash(REHASH_STEP)
+    for buckets, mask in self._tables():
+      bucket = buckets[h & mask]
+      if bucket is not None and key in bucket:
+        del bucket[key]
+        if not bucket:
+          buckets[h & mask] = None
+        self.size -= 1
+        break
+    else:
+      return
+    if self.new_buckets is None and len(self.buckets) > MIN_BUCKETS and self.size < len(self.buckets) * BUCKET_LOAD // 8:
+      self._start_resize(len(self.buckets) // 2)
+
+  def clear(self):
+    self.__init__()
+
+  def _tables(self):
+    if self.new_buckets is None:
+      return [(self.buckets, self.mask)]
+    return [(self.buckets, self.mask), (self.new_buckets, self.new_mask)]
+
+  def _start_resize(self, count):
+    self.new_buckets = [None] * count
+    self.new_mask = count - 1
+    self.rehash_idx = 0
+
+  def _rehash(self, steps):
+    # moves up to steps buckets to the new table, visiting at most 10 empty ones
+    # per step like redis' dictRehash. returns whether there is more to move
+    old, new, new_mask = self.buckets, self.new_buckets, self.new_mask
+    idx = self.rehash_idx
+    empty_visits = steps * 10
+    while steps and idx < len(old):
+      bucket = old[idx]
+      if bucket is None:
+        idx += 1
+        empty_visits -= 1
+        if not empty_visits:
+          break
+        continue
+      for key in bucket:
+        i = hash(key) & new_mask
+        target = new[i]
+        if target is None:
+          new[i] = {key: None}
+        else:
+          target[key] = None
+      old[idx] = None
+      idx += 1
+      steps -= 1
+    if idx >= len(old):
+      self.buckets = new
+      self.mask = new_mask
+      self.new_buckets = None
+      self.new_mask = 0
+      self.rehash_idx = 0
+      return False
+    self.rehash_idx = idx
+    return True
+
+  def rehash_for(self, ms):
+    # from the cron: keep rehashing for about ms milliseconds, like redis'
+    # incrementallyRehash, so an idle server finishes a resize anyway
+    if self.new_buckets is None:
+      return
+    deadline = time.perf_counter() + ms / 1000
+    while self._rehash(REHASH_CRON_STEP) and time.perf_counter() < deadline:
+      pass
+
+  def random_keys(self, count):
+    # about count keys from random buckets, for eviction sampling. like redis'
+    # dictGetSomeKeys it isn't uniform, but it costs the same at any size
+    if not self.size:
+      return []
+    tables = self._tables()
+    keys = []
+    for _ in range(count * 10):
+      buckets, mask = random.choice(tables)
+      bucket = buckets[random.getrandbits(32) & mask]
+      if bucket:
+        keys.append(random.choice(tuple(bucket)))
+        if len(keys) >= count:
+          break
+    return keys
+
+  def scan(self, cursor, count):
+    # returns (next cursor, keys) after visiting buckets until about count keys
+    # were collected. the number of empty buckets visited is bounded too, so a
+    # sparse table can't turn one call into a full walk. cursor 0 means done
+    keys = []
+    visits = count * 10
+    while True:
+      if self.new_buckets is None:
+        bucket = self.buckets[cursor & self.mask]
+        if bucket:
+          keys.extend(bucket)
+        cursor = _next_cursor(cursor, self.mask)
+      else:
+        # while rehashing, a bucket of the small table and every bucket of the
+        # large one it expands to, then the cursor moves on in the small table
+        small, small_mask = self.buckets, self.mask
+        large, large_mask = self.new_buckets, self.new_mask
+        if len(small) > len(large):
+          small, small_mask, large, large_mask = large, large_mask, small, small_mask
+        bucket = small[cursor & small_mask]
+        if bucket:
+          keys.extend(bucket)
+        while True:
+          bucket = large[cursor & large_mask]
+          if bucket:
+            keys.extend(bucket)
+          cursor = _next_cursor(cursor, large_mask)
+          if not cursor & (small_mask ^ large_mask):
+            break
+      visits -= 1
+      if cursor == 0 or len(keys) >= count or visits <= 0:
+        return cursor, keys
@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import deque
+
+# samples kept per event, one per second at most, like redis
+LATENCY_TS_LEN = 160
+
+# the events the monitor knows about
+#   command, fast-command  a command slower than the threshold ("fast" flag or not)
+#   expire-cycle           the cron's active expiry
+#   eviction-cycle         making room under maxmemory
+#   keys-lazy-expire       KEYS deleting the expired keys it ran into
+#   xrange-reply           XRANGE collecting and encoding its reply
+#   rdb-load               loading an rdb, at startup or on a replica's full sync
+#   aof-load               replaying the append only file at startup
+#   full-sync              a master sending its rdb to a replica
+
+
+class LatencyEvent:
+    __slots__ = ("samples", "max_ms")
+
+    def __init__(self):
+        # (unix time, milliseconds)
+        self.samples = deque(maxlen=LATENCY_TS_LEN)
+        self.max_ms = 0
+
+
+class LatencyMonitor:
+    # spikes of internal events that took latency-monitor-threshold ms or more.
+    # with the threshold at 0 nothing is recorded and add_sample is one compare
+    def __init__(self):
+        self.threshold_ms = 0
+        self.events = {}
+        self.lock = threading.Lock()
+
+    def configure(self, config):
+        self.threshold_ms = config.get_value("latency-monitor-threshold")
+
+    def add_sample(self, event, ms):
+        if not self.threshold_ms or ms < self.threshold_ms:
+            return
+        ms = int(ms)
+        now = int(time.time())
+        with self.lock:
+            entry = self.events.get(event)
+            if entry is None:
+                entry = self.events[event] = LatencyEvent()
+            samples = entry.samples
+            # one sample per second, the worst one
+            if samples and samples[-1][0] == now:
+                samples[-1] = (now, max(samples[-1][1], ms))
+            else:
+                samples.append((now, ms))
+            entry.max_ms = max(entry.max_ms, ms)
+
+    def add_sample_since(self, event, start):
+        # start is a time.perf_counter() taken before the event
+        if self.threshold_ms:
+            self.add_sample(event, (time.perf_counter() - start) * 1000)
+
+    def latest(self):
+        # [(event, time, latest ms, max ms)]
+        with self.lock:
+            return [
+                (event, entry.samples[-1][0], entry.samples[-1][1], entry.max_ms)
+                for event, entry in self.events.items() if entry.samples
+            ]
+
+    def history(self, event):
+        with self.lock:
+            entry = self.events.get(event)
+            return list(entry.samples) if entry is not None else []
+
+    def reset(self, events=None):
+        # the number of events reset, all of them when none are named
+        with self.lock:
+            if not events:
+                count = len(self.events)
+                self.events.clear()
+                return count
+            count = 0
+            for event in events:
+                if self.events.pop(event, None) is not None:
+                    count += 1
+            return count
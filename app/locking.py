@@ -0,0 +1,151 @@
+import threading
+from time import perf_counter_ns
+
+from app.commands import COMMAND_TABLE, TRANSACTION_COMMANDS, command_keys, record_call
+from app.replication import propagate_expired_keys
+
+# concurrency model of the threaded server (--io-mode threaded)
+#
+# every connection has its own thread and they all share one RedisStore. the
+# event loop server doesn't need any of this, it runs one command at a time: a
+# replica's link with its master reads on its own thread but hands what it
+# applies to the loop (EventLoopServer.run_threadsafe).
+#
+# - the keyspace is guarded by striped locks: a key maps to one of lock-stripes
+#   locks by its hash, and a command holds the stripes of all of its keys while
+#   it runs, its propagation to the aof and the replicas included. two commands
+#   on the same key are serialized and go out in the order they ran, commands on
+#   different stripes run side by side.
+# - a command on several keys (MGET, DEL, EXEC over its queued commands) takes
+#   its stripes in ascending order, so two commands can never wait on each other.
+# - commands that look at the whole keyspace (KEYS, SCAN, INFO, SAVE/BGSAVE,
+#   PSYNC, CLUSTER...) and the server cron hold every stripe.
+# - commands that don't touch the keyspace (PING, CONFIG, WAIT...) and commands
+#   being queued inside MULTI take no lock.
+# - GET reads without a lock: a dict lookup is atomic under the GIL and string
+#   values are replaced or assigned whole, never changed piecemeal. a key that has
+#   to be lazily expired is a write, GET then takes the stripe like any command.
+# - a blocking command (XREAD BLOCK, WAIT) releases its locks while it waits and
+#   takes them again before checking whether it can be served.
+# - the structures shared by all keys (the scan index, the expiry index, the slot
+#   index) are updated under store.index_lock, held only for the update itself,
+#   and so is store.used_memory.
+# - eviction deletes keys of any stripe: once over maxmemory, the next command
+#   evicts under every stripe before it takes its own.
+#
+# with lock-stripes 1 this is a single global lock, which is what
+# benchmarks/lock_contention.py compares against
+
+# commands that never touch the keyspace
+UNLOCKED_COMMANDS = frozenset((
+    "PING", "ECHO", "MULTI", "DISCARD", "LASTSAVE", "COMMAND", "CONFIG", "REPLCONF", "WAIT", "ASKING",
+    "SLOWLOG", "LATENCY",
+))
+
+
+class HeldLocks:
+    # the stripes one command holds, taken in ascending order
+    __slots__ = ("locks", "stripes")
+
+    def __init__(self, locks, stripes):
+        self.locks = locks
+        self.stripes = stripes
+
+    def acquire(self):
+        locks = self.locks
+        for stripe in self.stripes:
+            locks[stripe].acquire()
+
+    def release(self):
+        locks = self.locks
+        for stripe in reversed(self.stripes):
+            locks[stripe].release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class StripedLocks:
+    def __init__(self, stripes=256):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        self.count = stripes
+        self.everything = tuple(range(stripes))
+
+    def for_keys(self, keys):
+        count = self.count
+        return HeldLocks(self.locks, sorted({hash(key) % count for key in keys}))
+
+    def exclusive(self):
+        return HeldLocks(self.locks, self.everything)
+
+
+# command -> function(store, args) serving it without locks when it can, None
+# sends it down the locked path
+LOCK_FREE_READS = {
+    "GET": lambda store, args: store.get_if_live(args[1]),
+}
+
+
+class LockingExecutor:
+    # the executor of the threaded server: runs a command with the locks its
+    # keys need, see the model above
+    def __init__(self, store, executor):
+        self.store = store
+        self.locks = store.locks
+        self.executor = executor
+
+    def execute(self, conn, args):
+        cmd = COMMAND_TABLE.get(args[0].upper())
+        state = conn.client_state
+        if cmd is None or (cmd.arity > 0 and len(args) != cmd.arity) or len(args) < -cmd.arity:
+            # rejected before touching anything
+            self.executor(conn, args)
+            return
+        name = cmd.name
+        if name in UNLOCKED_COMMANDS or (state["multi"] and name not in TRANSACTION_COMMANDS):
+            self.executor(conn, args)
+            return
+        if not state["multi"] and self.store.cluster is None:
+            # (a cluster node checks the slot of every key first)
+            lockfree = LOCK_FREE_READS.get(name)
+            if lockfree is not None:
+                start = perf_counter_ns()
+                reply = lockfree(self.store, args)
+                if reply is not None:
+                    record_call(cmd, self.store, perf_counter_ns() - start, reply)
+                    conn.send(reply)
+                    return
+
+        store = self.store
+        if store.maxmemory and store.over_maxmemory():
+            with self.locks.exclusive():
+                store.evict()
+                propagate_expired_keys(store)
+
+        held = self.locks_for(cmd, args, state)
+        conn.held_locks = held
+        held.acquire()
+        try:
+            self.executor(conn, args)
+        finally:
+            held.release()
+            conn.held_locks = None
+
+    def locks_for(self, cmd, args, state):
+        if cmd.name == "EXEC":
+            commands = [(queued, queued_args) for queued, queued_args in state["queued_commands"]]
+        else:
+            commands = [(cmd, args)]
+        keys = []
+        for queued, queued_args in commands:
+            if queued.name in UNLOCKED_COMMANDS:
+                continue
+            queued_keys = command_keys(queued, queued_args)
+            if not queued_keys:
+                return self.locks.exclusive()
+            keys += queued_keys
+        return self.locks.for_keys(keys)
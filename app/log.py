@@ -0,0 +1,30 @@
+# log levels, like redis' loglevel option. messages that would go out for every
+# command or every write are debug: the hot paths test the level before they
+# build the message, so they cost a comparison when it is off
+#
+#     if log.level <= log.DEBUG:
+#         log.debug("Parsed command:", args)
+
+DEBUG = 0
+VERBOSE = 1
+NOTICE = 2
+WARNING = 3
+
+LOG_LEVELS = {"debug": DEBUG, "verbose": VERBOSE, "notice": NOTICE, "warning": WARNING}
+
+level = NOTICE
+
+
+def set_level(name):
+    global level
+    level = LOG_LEVELS[name]
+
+
+def debug(*parts):
+    if level <= DEBUG:
+        print(*parts)
+
+
+def verbose(*parts):
+    if level <= VERBOSE:
+        print(*parts)
@@ -1,375 +1,56 @@
 import socket
 import threading
+import time
 from app.redis_store import RedisStore
 from app.config import Config
 import argparse
 import os
-from app.rdb_utils import consume_full_psync_response, try_read_resp_command, execute_commands_from_args
-import time
+import sys
+from app.commands import execute_command
+from app.replication import replicate_handshake, send_getack_if_requested
+from app.event_loop import EventLoopServer
+from app.connection import ThreadedClientConnection
+from app.cron import schedule_cron, start_cron_thread
+from app.rdb_loader import RdbError
+from app.aof import AppendOnlyFile, aof_file_path, load_append_only_file, rewrite_append_only_file_background
+from app.shards import ShardRouter, listen_for_shards, run_shards
+from app.cluster import ClusterRouter, ClusterState
+from app.locking import LockingExecutor, StripedLocks
+from app import log
 
 BUFF_SIZE = 4096
+TCP_BACKLOG = 511
 
-EMPTY_RDB_HEX = (
-    "524544495330303131fa0972656469732d76657205372e322e30fa0a72656469732d62697473"
-    "c040fa056374696d65c26d08bc65fa08757365642d6d656dc2b0c41000fa08616f662d62617365"
-    "c000fff06e3bfec0ff5aa2"
-)
-
-EMPTY_RDB_BYTES = bytes.fromhex(EMPTY_RDB_HEX)
-
-def parse_redis_command(data: bytes): 
-    lines = data.decode().split("\r\n")
-    args = []
-    i = 0
-    while i < len(lines): 
-        if lines[i].startswith("*"):
-            i += 1  # skip array header like *2
-        elif lines[i].startswith("$"):
-            i += 1  # skip to the value (right after $length)
-            if i < len(lines) and lines[i] != "":
-                args.append(lines[i])  # add the actual value
-            i += 1  # advance past the value
-        else:
-            if lines[i] != "":
-                args.append(lines[i])  # fallback in case it's a raw string
-            i += 1
-    return args
-
-def send_empty_rdb(sock: socket): 
-    rdb_len = len(EMPTY_RDB_BYTES)
-    header = f"${rdb_len}\r\n".encode()
-    sock.sendall(header + EMPTY_RDB_BYTES)
-    print("[Master] Sent the EMPTY_RDB_HEX to replica")
-
-def send_getack_to_replica(sock: socket): 
-    payload = (
-        "*3\r\n"
-        "$8\r\nREPLCONF\r\n"
-        "$6\r\nGETACK\r\n"
-        "$1\r\n*\r\n"
-    ).encode()
-    
+def handle_command(client_sock: socket.socket, client_addr, store: RedisStore, config: Config, executor):
+    client = ThreadedClientConnection(client_sock, client_addr, output_limit=config.get_value("client-output-buffer-limit"))
+    parser = client.parser
     try: 
         while True: 
-            sock.sendall(payload)
-            print("[Master] Sent REPLCONF GETACK * to replica socket")
-    except Exception as e: 
-        print(f"[Master] Stopped sending GETACK to replica due to error: {e}")
-
-def propagate_commands_to_replicas(args, store: RedisStore):
-    # if it is not the master server, do not run any logic and return
-    if store.role != "master": 
-        return
-    
-    # construct the RESP array manually
-    resp = f"*{len(args)}\r\n"
-    for arg in args: 
-        resp += f"${len(arg)}\r\n{arg}\r\n"
-    print("[Master] Printing resp:", resp)
-    data = resp.encode()
-    # store the commands in the command_logs
-    store.command_logs.append(data)
-    # to remove non-active sockets
-    disconnected = []
-    print("[Master] Printing the length of replica_sockets", len(store.replica_sockets))
-    for s in store.replica_sockets: 
-        try: 
-            s.sendall(data)
-        except Exception as e: 
-            print("[Master] Failed to send to replica {e}")
-            disconnected.append(s)
-    
-    # add logic to cleanup disconnected sockets
-
-# this function is for the replica server to listen to commands from the master server and take specific actions
-def replicate_command_listener(store: RedisStore): 
-    # this is added into the RedisStore in line 72 in replicate_handshake
-    repl_sock = store.replica_socket
-    buffer = b""
-    while True: 
-        try: 
-            chunk = repl_sock.recv(4096)
+            chunk = client_sock.recv(BUFF_SIZE)
+            if log.level <= log.DEBUG:
+                log.debug("Raw chunk received", chunk)
             if not chunk: 
                 break
-            buffer += chunk
-            while True: 
-                try: 
-                    args, remaining = try_read_resp_command(buffer)
-                    if args is None: 
-                        break
-                    
-                    consumed = len(buffer) - len(remaining)
-                    command = args[0].upper()
-                    if command == "SET": 
-                        key, val = args[1], args[2]
-                        px = None
-                        if len(args) >= 5 and args[3].upper() == "PX":
-                            px = int(args[4])
-                        store.set(key, val, px)
-                        print("[Replica] Set data to the RedisStore sent by master")
-                    elif command == "PING": 
-                        print("[Replica] Received ping from master")
-                    elif (command == "REPLCONF" and len(args) == 3 and args[1].upper() == "GETACK"): 
-                        print("[Replica] received REPLCONF from master, sending payload...")
-                        with store.repl_offset_lock: 
-                            ack_offset = store.repl_offset
-                        payload = (
-                            "*3\r\n"
-                            "$8\r\nREPLCONF\r\n"
-                            "$3\r\nACK\r\n"
-                            f"${len(str(ack_offset))}\r\n{ack_offset}\r\n"
-                        )
-                        repl_sock.sendall(payload.encode())
-                        print(f"[Replica] Sent REPLCONF ACK {ack_offset}")
-                    else: # any other commands, ignore and continue
-                        print(f"[Replica] Ignored command {args}")
-                    
-                    with store.repl_offset_lock: 
-                        store.repl_offset += consumed
-                    buffer = remaining
-                except Exception as e: 
-                    print(f"[Replica] Error during parsing or handling command {e}")
-                    break
-        except Exception as e: 
-            print(f"[Replica] Error reading command: {e}")
-            break
-
-def replicate_handshake(store: RedisStore): 
-    try: 
-        s = socket.create_connection((store.master_host, store.master_port))
-        # store.replica_socket is only present for replica RedisStores
-        store.replica_socket = s
-        
-        # step 1: Send ping
-        s.sendall(b"*1\r\n$4\r\nPING\r\n")
-        response = s.recv(1024)
-        print(f"[Replica] Received from master: {response}")
-        
-        # step 2: send replconf listening-port
-        port_str = str(store.replica_port)
-        replconf_1 = (
-            "*3\r\n"
-            "$8\r\nREPLCONF\r\n"
-            "$14\r\nlistening-port\r\n"
-            f"${len(port_str)}\r\n{port_str}\r\n"
-        )
-        s.sendall(replconf_1.encode())
-        repl_conf1_res = s.recv(1024)
-        print(f"[Replica] Received replconf1 response: {repl_conf1_res}")
-        
-        # step 3: send replconf with capa and psync2
-        replconf_2 = (
-            "*3\r\n"
-            "$8\r\nREPLCONF\r\n"
-            "$4\r\ncapa\r\n"
-            "$6\r\npsync2\r\n"
-        )
-        s.sendall(replconf_2.encode())
-        repl_conf2_res = s.recv(1024)
-        print(f"[Replica] Received replconf2 response: {repl_conf2_res}")
-        
-        # step 4: send psync ? -1
-        psync_command = (
-            "*3\r\n"
-            "$5\r\nPSYNC\r\n"
-            "$1\r\n?\r\n"
-            "$2\r\n-1\r\n"
-        )
-        s.sendall(psync_command.encode())
-        try:
-            psync_response, rdb_header, rdb_data = consume_full_psync_response(s)
-            print("[Replica] Completed PSYNC and RDB sync, socket is now clean")
-        except Exception as e: 
-            print(f"[Replica] Error during PSYNC handling: {e}")
-        
-        print("[Replica] Completed REPLCONF handshake")
-        # logic to setup a background listener to handle propagated commands from master
-        threading.Thread(
-            target=replicate_command_listener,
-            args=(store,),
-            daemon=True,
-        ).start()
-        print("[Replica] Started listener thread for command propagation")
-    except Exception as e: 
-        # even with error, using "with" still closes the connection
-        print(f"[Replica] Connection to master failed: {e}")
-
-def handle_command(client: socket.socket, store: RedisStore, config: Config):
-    client_state = {
-        "multi": False,
-        "queued_commands": []
-    }
-    try: 
-        while True: 
-            chunk = client.recv(BUFF_SIZE)
-            print("Raw chunk received", chunk)
-            if not chunk: 
-                break
-            
-            args = parse_redis_command(chunk)
-            print("Parsed command:", args)
-            
-            command = args[0].upper()
             
-            if command == "PING": 
-                response = f"+PONG\r\n"
-                client.send(response.encode())
-            elif command == "ECHO" and len(args) == 2: 
-                response = f"${len(args[1])}\r\n{args[1]}\r\n"
-                client.send(response.encode())
-            elif command == "GET" and len(args) == 2: 
-                if client_state["multi"]: 
-                    client_state["queued_commands"].append(args)
-                    client.send(b"+QUEUED\r\n")
-                else: 
-                    data = store.get(args[1])
-                    client.send(data)
-            elif command == "XADD": # command for streaming data
-                if len(args) >= 4: 
-                    stream_key = args[1]
-                    entry_id = args[2]
-                    field_values = args[3:]
-                    response = store.xadd(stream_key=stream_key, entry_id=entry_id, fields=field_values)
-                    client.send(response)
-                else: 
-                    client.send(b"-ERR wrong number of arguments for XADD\r\n")
-            elif command == "XRANGE": 
-                if len(args) == 4: 
-                    stream_key = args[1]
-                    start_id = args[2]
-                    end_id = args[3]
-                    response = store.xrange(stream_key=stream_key, start_id=start_id, end_id=end_id)
-                    client.send(response)
-                else: 
-                    client.send(b"-ERR Wrong number of arguments for XRANGE\r\n")
-            elif command == "XREAD": 
-                if len(args) >= 4 and args[1].upper() == "STREAMS":
-                    mid = args.index("streams")
-                    stream_keys = args[mid + 1 : mid + 1 + (len(args) - mid - 1) // 2]
-                    last_ids = args[mid + 1 + len(stream_keys) : ]
-                    
-                    if len(stream_keys) != len(last_ids):
-                        client.send(b"-ERR stream key count doesn't match ID count\r\n")
-                    else:
-                        response = store.xread(stream_keys, last_ids)
-                        client.send(response)
-                else: 
-                    client.send(b"-ERR wrong number of arguments for XREAD\r\n")
-                    
-            elif command == "CONFIG" and len(args) == 3 and args[1].upper() == "GET":
-                param = args[2]
-                value = config.get(param)
-                client.send(value)
-            elif command == "KEYS" and len(args) == 2 and args[1] == "*":
-                keys = store.keys()
-                client.send(keys)
-            elif command == "TYPE" and len(args) == 2: 
-                resp = store.type(args[1])
-                client.send(resp)
-            elif command == "SET": 
-                print(f"[DEBUG] Printing client state inside SET command {client_state}")
-                if len(args) >= 3:
-                    if client_state["multi"]: 
-                        client_state["queued_commands"].append(args)
-                        client.send(b"+QUEUED\r\n")
-                    else: 
-                        k, v = args[1], args[2]
-                        px = None
-                        if len(args) >= 5 and args[3].upper() == "PX": 
-                            # form validation for wrong input
-                            try: 
-                                px = int(args[4])
-                            except ValueError: 
-                                client.send(b"-ERR PX value must be an integer\r\n")
-                                continue
-                        
-                        data = store.set(k, v, px)
-                        client.send(data)
-                        # propagate the command to the replicas of the master
-                        # this command will not be executed by the replicas since there is a condition in the beginning of the func.
-                        propagate_commands_to_replicas(args, store)
-                else: 
-                    client.send(b"-ERR wrong number of arguments for SET\r\n")
-            elif command == "INCR": 
-                try: 
-                    if len(args) != 2: 
-                        client.send(b"-ERR wrong number of arguments for INCR\r\n")
-                        continue
-                    if client_state["multi"]: 
-                        client_state["queued_commands"].append(args)
-                        client.send(b"+QUEUED\r\n")
-                    else: 
-                        key = args[1]
-                        new_val = store.incr(key)
-                        client.send(f":{new_val}\r\n".encode())
-                except ValueError: 
-                    client.send(b"-ERR value is not an integer or out of range\r\n")
-            elif command == "MULTI": 
-                client_state["multi"] = True
-                print(f"[DEBUG] printing client_state: {client_state}")
-                client.send(b"+OK\r\n")
-            elif command == "EXEC": 
-                if not client_state["multi"]: 
-                    client.send(b"-ERR EXEC without MULTI\r\n")
-                    continue
-                
-                responses = []
-                for queued_arg in client_state["queued_commands"]: 
-                    result = execute_commands_from_args(store, queued_arg)
-                    responses.append(result)
-                    # if queued_arg[0].upper() == "SET": 
-                    #     propagate_commands_to_replicas(queued_arg, )
-                
-                resp = f"*{len(responses)}\r\n".encode() + b"".join(responses)
-                client.send(resp)
-                # resetting client_state
-                client_state["multi"] = False
-                client_state["queued_commands"] = []
-            elif command == "DISCARD": 
-                if not client_state["multi"]: 
-                    client.send(b"-ERR DISCARD without MULTI\r\n")
-                else: 
-                    client_state["multi"] = False
-                    client_state["queued_commands"] = []
-                    client.send(b"+OK\r\n")
-            elif command == "INFO" and len(args) == 2 and args[1].upper() == "REPLICATION": 
-                info = store.replication_info()
-                print("INFO payload:", repr(info))
-                client.send(info)
-            elif command == "REPLCONF":
-                if args[1].upper() == "ACK": 
-                    print("[Master] Received ACK from replica, registering socket")
-                else: 
-                    print("[Master/Replica] Received REPLCONF command")
-                    client.send(b"+OK\r\n")
-            elif command == "PSYNC":
-                if len(args) == 3 and args[1] == "?" and args[2] == "-1": 
-                    repl_id = store.master_repl_id
-                    response = f"+FULLRESYNC {repl_id} 0\r\n"
-                    client.send(response.encode())
-                    time.sleep(0.05)
-                    # calling send_empty_rdb because psync command tells the master that the replica doesn't have data. 
-                    # send_empty_rdb is sending an empty file (for this exercise) to fully synchronize
-                    send_empty_rdb(client)
-                    # delay briefly to let replica read RDB before sending other commands
-                    time.sleep(0.1)
-                    # mark this socket as a ready replica
-                    if store.role == "master": 
-                        store.replica_sockets.append(client)
-                        print("[Master] Registered a new replica socket")
-                        print("[Master] Replica fully synced and registered")
-                        
-                        # sync all the previous commands with the current replica
-                        for command in store.command_logs: 
-                            try: 
-                                client.sendall(command)
-                            except Exception as e: 
-                                print("[Master] Failed to replay command to replica: {e}")
-            else: 
-                client.send(b"-ERR unknown command\r\n")
+            # a single read can carry several pipelined commands or only part of one
+            parser.feed(chunk)
+            for args in parser.parse(): 
+                if log.level <= log.DEBUG:
+                    log.debug("Parsed command:", args)
+                executor(client, args)
+            # writes are in the append only file before their replies go out
+            if store.aof is not None:
+                store.aof.flush()
+            if parser.error is not None: 
+                client.send(f"-ERR Protocol error: {parser.error}\r\n".encode())
+                client.close_after_reply = True
+            # replies for everything parsed from this read go out in one write
+            client.flush()
+            if client.close_after_reply: 
+                break
     except Exception as e: 
         print(f"[Thread Error] Exception in client handler: {e}")
-        client.close()
+    client.close()
 
 def main():
     print("Started....")
@@ -378,14 +59,70 @@ def main():
     parser.add_argument("--dbfilename", default="dump.rdb")
     parser.add_argument("--port", type=int, default=6379)
     parser.add_argument("--replicaof", type=str, help="Specify master host and port for replica mode, e.g. 'localhost 6379'")
+    parser.add_argument("--client-output-buffer-limit", default="0", help="Close clients whose pending replies exceed this size (e.g. 64mb), 0 disables the limit")
+    parser.add_argument("--hz", default="10", help="How many times per second background tasks such as active expiry run")
+    parser.add_argument("--rdbchecksum", choices=["yes", "no"], default="yes", help="Verify the checksum of the RDB file when loading it")
+    parser.add_argument("--save", default="", help="Background save triggers as '<seconds> <changes>' pairs, e.g. '3600 1 300 100'")
+    parser.add_argument("--appendonly", choices=["yes", "no"], default="no", help="Log every write to the append only file and replay it on startup")
+    parser.add_argument("--appendfsync", choices=["always", "everysec", "no"], default="everysec", help="When the append only file is fsynced")
+    parser.add_argument("--appendfilename", default="appendonly.aof", help="Name of the append only file inside --dir")
+    parser.add_argument("--repl-backlog-size", default="1mb", help="Size of the replication backlog kept for partial resyncs")
+    parser.add_argument("--io-mode", choices=["eventloop", "threaded"], default="eventloop", help="Serve clients from a single event loop or with one thread per connection")
+    parser.add_argument("--cluster-enabled", choices=["yes", "no"], default="no", help="Serve only the hash slots assigned to this node and redirect clients for the others")
+    parser.add_argument("--cluster-config-file", default="nodes.conf", help="Where this node keeps its view of the cluster, inside --dir")
+    parser.add_argument("--maxmemory", default="0", help="Evict keys once the dataset is estimated to use this much (e.g. 100mb), 0 disables the limit")
+    parser.add_argument("--maxmemory-policy", default="noeviction", help="Which keys go when over maxmemory: noeviction, allkeys-lru, allkeys-lfu, volatile-ttl...")
+    parser.add_argument("--loglevel", choices=list(log.LOG_LEVELS), default="notice", help="debug logs every command and every write sent to replicas")
+    parser.add_argument("--slowlog-log-slower-than", default="10000", help="Log commands slower than this many microseconds to the SLOWLOG, -1 disables it")
+    parser.add_argument("--latency-monitor-threshold", default="0", help="Keep LATENCY samples of events slower than this many milliseconds, 0 disables it")
+    parser.add_argument("--lock-stripes", type=int, default=256, help="Locks guarding the keyspace in threaded mode, 1 is a single global lock")
+    parser.add_argument("--shards", type=int, default=1, help="Split the keyspace over this many worker processes sharing the port")
     parser_args = parser.parse_args()
 
+    if parser_args.shards > 1:
+        if parser_args.replicaof or parser_args.io_mode != "eventloop" or parser_args.cluster_enabled == "yes":
+            raise ValueError("--shards needs --io-mode eventloop and can't be used with --replicaof or --cluster-enabled")
+        run_shards(parser_args.shards, parser_args.port, lambda shard_id: run_server(parser_args, shard_id))
+        return
+    run_server(parser_args)
+
+def shard_file_name(name, shard_id):
+    # every worker has its own dump and log: dump.rdb -> dump-0.rdb
+    if shard_id is None:
+        return name
+    stem, ext = os.path.splitext(name)
+    return f"{stem}-{shard_id}{ext}"
+
+def run_server(parser_args, shard_id=None):
+    # one server; with --shards, one worker owning shard_id's part of the keys
+    dbfilename = shard_file_name(parser_args.dbfilename, shard_id)
     cwd = os.getcwd()
     print(f"Printing cwd {cwd}")
-    rdb_path = os.path.join(cwd, parser_args.dir, parser_args.dbfilename)
+    rdb_path = os.path.join(cwd, parser_args.dir, dbfilename)
     print(f"Loading RDB from: {rdb_path}")
     
-    config = Config(parser_args.dir, parser_args.dbfilename)
+    config = Config(parser_args.dir, dbfilename)
+    config.set("client-output-buffer-limit", parser_args.client_output_buffer_limit)
+    config.set("hz", parser_args.hz)
+    config.set("rdbchecksum", parser_args.rdbchecksum)
+    config.set("repl-backlog-size", parser_args.repl_backlog_size)
+    if config.set("save", parser_args.save) != b"+OK\r\n":
+        raise ValueError("--save must be '<seconds> <changes>' pairs")
+    config.set("appendonly", parser_args.appendonly, startup=True)
+    config.set("appendfsync", parser_args.appendfsync)
+    config.set("appendfilename", shard_file_name(parser_args.appendfilename, shard_id), startup=True)
+    config.set("cluster-enabled", parser_args.cluster_enabled, startup=True)
+    config.set("cluster-config-file", parser_args.cluster_config_file, startup=True)
+    config.set("loglevel", parser_args.loglevel)
+    if config.set("slowlog-log-slower-than", parser_args.slowlog_log_slower_than) != b"+OK\r\n" or config.set("latency-monitor-threshold", parser_args.latency_monitor_threshold) != b"+OK\r\n":
+        raise ValueError("--slowlog-log-slower-than and --latency-monitor-threshold must be integers")
+    log.set_level(parser_args.loglevel)
+    if config.set("maxmemory", parser_args.maxmemory) != b"+OK\r\n" or config.set("maxmemory-policy", parser_args.maxmemory_policy) != b"+OK\r\n":
+        raise ValueError("--maxmemory must be a size and --maxmemory-policy one of the redis policies")
+    aof_path = aof_file_path(config)
+    # with aof enabled the log is the source of truth, the rdb is only used when
+    # there is no log yet
+    replay_aof = parser_args.appendonly == "yes" and os.path.exists(aof_path)
     replica_config = None
     # replica storing master information inside RedisStore if parser_args.replicaof exists
     if parser_args.replicaof: 
@@ -397,20 +134,83 @@ def main():
         print("[REPLICA MASTER]")
         replica_config = {"role": "master"}
     
-    store = RedisStore(rdb_path=rdb_path, replica_config=replica_config)
+    load_start = time.perf_counter()
+    try:
+        store = RedisStore(rdb_path=None if replay_aof else rdb_path, replica_config=replica_config, rdb_checksum=parser_args.rdbchecksum == "yes", repl_backlog_size=max(1, config.get_value("repl-backlog-size")))
+        if replay_aof:
+            load_append_only_file(
+                aof_path, store,
+                lambda conn, args: execute_command(conn, args, store, config),
+                verify_checksum=parser_args.rdbchecksum == "yes",
+            )
+    except RdbError as e:
+        print(f"[RDB] Failed to load {aof_path if replay_aof else rdb_path}: {e}")
+        sys.exit(1)
+    # the dataset is loaded whole, the limit applies from the first command on
+    store.configure_memory(config)
+    store.slowlog.configure(config)
+    store.latency.configure(config)
+    store.latency.add_sample_since("aof-load" if replay_aof else "rdb-load", load_start)
+    if parser_args.appendonly == "yes":
+        store.aof = AppendOnlyFile(aof_path, config)
+        if not replay_aof:
+            # a new log starts from the current dataset (loaded from the rdb)
+            rewrite_append_only_file_background(store, config)
+
+    local_executor = lambda conn, args: execute_command(conn, args, store, config)
+    master_executor = local_executor
+    client_executor = local_executor
+    if parser_args.cluster_enabled == "yes":
+        try:
+            store.cluster = ClusterState(store, config, "127.0.0.1", parser_args.port)
+        except (ValueError, IndexError) as e:
+            print(f"[Cluster] Failed to load {parser_args.cluster_config_file}: {e}")
+            sys.exit(1)
+        store.enable_slot_index()
+        client_executor = ClusterRouter(store.cluster, local_executor).execute
+    if parser_args.io_mode == "threaded":
+        # client threads run side by side, every command holds the locks of its keys
+        store.locks = StripedLocks(max(1, parser_args.lock_stripes))
+        client_executor = LockingExecutor(store, client_executor).execute
+        master_executor = LockingExecutor(store, local_executor).execute
+    server_socket = socket.create_server(("localhost", parser_args.port), backlog=TCP_BACKLOG, reuse_port=True)
+    if parser_args.io_mode == "eventloop": 
+        server = EventLoopServer(server_socket, client_executor, config)
+        if shard_id is not None:
+            # clients may send any key, commands other workers forward to us
+            # only ever carry our own
+            router = ShardRouter(server, shard_id, parser_args.shards, parser_args.port, local_executor)
+            server.executor = router.execute
+            server.listen(listen_for_shards(parser_args.port, shard_id), local_executor)
+        schedule_cron(server, store, config)
+        if store.aof is not None:
+            server.before_sleep.append(store.aof.flush)
+        if store.role == "master":
+            server.before_sleep.append(lambda: send_getack_if_requested(store))
+        else:
+            # the link with the master reads on its own thread, what it applies
+            # runs on the loop like any client's commands
+            threading.Thread(
+                target=replicate_handshake,
+                args=(store, config, master_executor, server.run_threadsafe),
+                daemon=True
+            ).start()
+        server.serve_forever()
+        return
+
+    start_cron_thread(store, config)
     # send PING to master server from slave server
     if replica_config["role"] == "slave": 
         threading.Thread(
             target=replicate_handshake,
-            args=(store,),
+            args=(store, config, master_executor),
             daemon=True
         ).start()
 
-    server_socket = socket.create_server(("localhost", parser_args.port), reuse_port=True)
     while True: 
         # client_sock are the client requests incoming to the server e.g. replica clients
         client_sock, client_addr = server_socket.accept()
-        threading.Thread(target=handle_command, args=(client_sock, store, config)).start()
+        threading.Thread(target=handle_command, args=(client_sock, client_addr, store, config, client_executor)).start()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,63 @@
+import functools
+import re
+
+# compiled patterns are cached, tools tend to scan with the same few patterns
+PATTERN_CACHE_SIZE = 256
+
+
+def _translate(pattern):
+  # redis glob syntax to a regular expression: * and ? wildcards, [abc], [^abc]
+  # and [a-z] classes, and \ to escape the next character
+  out = []
+  i = 0
+  n = len(pattern)
+  while i < n:
+    c = pattern[i]
+    i += 1
+    if c == "*":
+      # runs of * match the same as one
+      while i < n and pattern[i] == "*":
+        i += 1
+      out.append(".*")
+    elif c == "?":
+      out.append(".")
+    elif c == "\\" and i < n:
+      out.append(re.escape(pattern[i]))
+      i += 1
+    elif c == "[":
+      negate = i < n and pattern[i] == "^"
+      if negate:
+        i += 1
+      members = []
+      while i < n and pattern[i] != "]":
+        if pattern[i] == "\\" and i + 1 < n:
+          members.append(re.escape(pattern[i + 1]))
+          i += 2
+        elif i + 2 < n and pattern[i + 1] == "-" and pattern[i + 2] != "]":
+          low, high = sorted((pattern[i], pattern[i + 2]))
+          members.append(f"{re.escape(low)}-{re.escape(high)}")
+          i += 3
+        else:
+          members.append(re.escape(pattern[i]))
+          i += 1
+      # like redis an unterminated class runs to the end of the pattern
+      i += 1
+      if not members:
+        out.append("[^\\s\\S]" if not negate else "[\\s\\S]")
+      else:
+        out.append(("[^" if negate else "[") + "".join(members) + "]")
+    else:
+      out.append(re.escape(c))
+  return "".join(out)
+
+
+@functools.lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_pattern(pattern):
+  # returns a function key -> bool, or None when the pattern matches every key
+  # so callers can skip matching altogether for the common "*". patterns and
+  # keys are bytes: latin-1 maps every byte to one character and back, so the
+  # translation works on characters and the regex matches bytes
+  if pattern.strip(b"*") == b"" and pattern:
+    return None
+  regex = _translate(pattern.decode("latin-1")).encode("latin-1")
+  return re.compile(regex, re.DOTALL).fullmatch
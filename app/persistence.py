@@ -0,0 +1,285 @@
+import os
+import threading
+import time
+
+from app.config import REDIS_VERSION, Config, parse_save_params
+from app.rdb_writer import write_rdb_file
+from app.redis_object import HASH, LIST, SET, STREAM, ZSET, RedisObject
+from app.redis_store import RedisStore
+
+# after a failed background save the triggers wait this long before retrying
+BGSAVE_RETRY_DELAY = 5
+# keys a save running in a thread copies at a time, see KeyspaceSnapshot
+SNAPSHOT_BATCH = 1000
+
+
+def rdb_file_path(config: Config):
+    return os.path.join(config.get_value("dir"), config.get_value("db_file_name"))
+
+
+def rdb_aux_fields(store: RedisStore):
+    return {
+        "redis-ver": REDIS_VERSION,
+        "redis-bits": 64,
+        "ctime": int(time.time()),
+        "aof-base": 0,
+    }
+
+
+def keyspace_items(store: RedisStore):
+    expires = store.expires.deadlines
+    for key, obj in store.data.items():
+        yield key, obj, expires.get(key)
+
+
+def _frozen_copy(obj: RedisObject):
+    # strings are immutable, containers are copied so later writes don't leak in
+    value = obj.value
+    if obj.type == STREAM:
+        return RedisObject(STREAM, value.copy())
+    if obj.type == LIST:
+        return RedisObject(LIST, list(value))
+    if obj.type == SET:
+        return RedisObject(SET, set(value))
+    if obj.type in (ZSET, HASH):
+        return RedisObject(obj.type, dict(value))
+    return RedisObject(obj.type, value)
+
+
+class KeyspaceSnapshot:
+    # copy on write view of the keyspace as it was when a save started, for a
+    # save that runs in a thread next to the server instead of in a forked child.
+    # items() walks the scan index SNAPSHOT_BATCH keys at a time and copies only
+    # the batch at hand. meanwhile the store calls preserve before it changes a
+    # key (RedisStore._before_write): a key the walk hasn't reached yet keeps its
+    # old value here, and the walk writes that one instead of the live one
+    def __init__(self, store: RedisStore):
+        self.store = store
+        self.lock = threading.Lock()
+        # key -> (object, expiry) as of the start, None for keys created since
+        self.saved = {}
+        # keys the walk already copied, later writes to them don't matter
+        self.written = set()
+        self.done = False
+
+    def preserve(self, key):
+        store = self.store
+        with self.lock:
+            if self.done or key in self.written or key in self.saved:
+                return
+            obj = store.data.get(key)
+            self.saved[key] = None if obj is None else (_frozen_copy(obj), store.expires.get(key))
+
+    def preserve_all(self):
+        # before FLUSHALL: the flushed entries are never changed again, they are
+        # kept as they are
+        store = self.store
+        with self.lock:
+            if self.done:
+                return
+            expires = store.expires.deadlines
+            written, saved = self.written, self.saved
+            for key, obj in store.data.items():
+                if key not in written and key not in saved:
+                    saved[key] = (obj, expires.get(key))
+
+    def items(self):
+        # (key, obj, expiry) items for write_snapshot
+        store = self.store
+        data, expires = store.data, store.expires
+        written, saved = self.written, self.saved
+        cursor = 0
+        while True:
+            # the scan returns every key that exists for the whole walk, maybe
+            # more than once. the ones deleted meanwhile are in saved
+            with store.index_lock:
+                cursor, keys = store.keyspace.scan(cursor, SNAPSHOT_BATCH)
+            batch = []
+            with self.lock:
+                for key in keys:
+                    if key in written:
+                        continue
+                    written.add(key)
+                    if key in saved:
+                        entry = saved.pop(key)
+                        if entry is not None:
+                            batch.append((key, *entry))
+                        continue
+                    obj = data.get(key)
+                    if obj is not None:
+                        batch.append((key, _frozen_copy(obj), expires.get(key)))
+            yield from batch
+            if cursor == 0:
+                break
+        # what is left are keys deleted before the walk got to them
+        with self.lock:
+            rest = [(key, *entry) for key, entry in saved.items() if entry is not None]
+        self.release()
+        yield from rest
+
+    def release(self):
+        # the save is over, successful or not: stop collecting old values
+        with self.lock:
+            self.done = True
+            self.saved = {}
+            self.written = set()
+        if self.store.snapshot is self:
+            self.store.snapshot = None
+
+
+def write_snapshot(store: RedisStore, config: Config, path, items, aux=None):
+    return write_rdb_file(
+        path, items, len(store.data), len(store.expires),
+        aux if aux is not None else rdb_aux_fields(store),
+        checksum=config.get_value("rdbchecksum") == "yes",
+    )
+
+
+class BackgroundJob:
+    # a snapshot written next to the server: by a forked child, whose copy on write
+    # view of the keyspace stays frozen at the fork, or by a thread walking a
+    # KeyspaceSnapshot when fork isn't safe. only one runs at a time, BGSAVE and
+    # BGREWRITEAOF share it like in redis
+    def __init__(self, kind, on_done):
+        self.kind = kind
+        self.on_done = on_done
+        self.started = time.time()
+        self.pid = None
+        self.thread = None
+        self.ok = None
+        self.done = False
+        # replication offset the snapshot corresponds to, full resyncs use it
+        self.repl_offset = None
+
+    def poll(self):
+        # None while running, then whether the write succeeded
+        if self.thread is not None:
+            return None if self.thread.is_alive() else bool(self.ok)
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+        except ChildProcessError:
+            # reaped by someone else, the outcome is unknown
+            return False
+        if pid == 0:
+            return None
+        return os.waitstatus_to_exitcode(status) == 0
+
+
+def start_background_job(store: RedisStore, kind, write, on_done):
+    # write(items) produces the file from (key, obj, expiry) items. fork is only
+    # used while this is the process' only thread, locks held by other threads
+    # would stay locked in the child
+    job = BackgroundJob(kind, on_done)
+    job.repl_offset = store.master_repl_offset
+    if hasattr(os, "fork") and threading.active_count() == 1:
+        try:
+            pid = os.fork()
+        except OSError as e:
+            print(f"[RDB] Can't fork for a background save: {e}")
+            return None
+        if pid == 0:
+            # child: no prints, stdout's lock may have been copied mid write
+            code = 0
+            try:
+                write(keyspace_items(store))
+            except BaseException:
+                code = 1
+            os._exit(code)
+        job.pid = pid
+        print(f"[RDB] Background {kind} started by pid {pid}")
+    else:
+        snapshot = KeyspaceSnapshot(store)
+        store.snapshot = snapshot
+
+        def run():
+            try:
+                write(snapshot.items())
+                job.ok = True
+            except OSError as e:
+                print(f"[RDB] Background {kind} failed: {e}")
+                job.ok = False
+            finally:
+                snapshot.release()
+
+        job.thread = threading.Thread(target=run, daemon=True)
+        job.thread.start()
+        print(f"[RDB] Background {kind} started in a thread")
+    store.child_job = job
+    return job
+
+
+def check_background_job(store: RedisStore):
+    # reap a finished background job, called from the server cron
+    job = store.child_job
+    if job is None:
+        return
+    ok = job.poll()
+    if ok is None:
+        return
+    store.child_job = None
+    job.ok = ok
+    job.done = True
+    job.on_done(ok)
+
+
+def rdb_save(store: RedisStore, config: Config):
+    # SAVE: write the snapshot from the calling thread, every client waits. the
+    # threaded server runs it under every stripe, so nothing changes under it
+    if store.child_job is not None:
+        return False
+    start = time.time()
+    try:
+        size = write_snapshot(store, config, rdb_file_path(config), keyspace_items(store))
+    except OSError as e:
+        print(f"[RDB] Failed to save the snapshot: {e}")
+        return False
+    store.dirty = 0
+    store.lastsave = int(time.time())
+    print(f"[RDB] DB saved on disk ({size} bytes in {time.time() - start:.3f}s)")
+    return True
+
+
+def rdb_save_background(store: RedisStore, config: Config):
+    # BGSAVE
+    if store.child_job is not None:
+        return False
+    path = rdb_file_path(config)
+    aux = rdb_aux_fields(store)
+    dirty_before = store.dirty
+
+    def write(items):
+        write_snapshot(store, config, path, items, aux)
+
+    def on_done(ok):
+        store.last_bgsave_ok = ok
+        store.last_bgsave_try = time.time()
+        store.last_bgsave_duration = int(time.time() - job.started)
+        if ok:
+            # writes made while the snapshot was being written are still unsaved
+            store.dirty -= dirty_before
+            store.lastsave = int(job.started)
+            print("[RDB] Background saving terminated with success")
+        else:
+            print("[RDB] Background saving error")
+
+    job = start_background_job(store, "save", write, on_done)
+    if job is None:
+        store.last_bgsave_ok = False
+        store.last_bgsave_try = time.time()
+        return False
+    return True
+
+
+def check_save_triggers(store: RedisStore, config: Config):
+    # "save <seconds> <changes>": snapshot once at least <changes> writes happened
+    # and the last save is <seconds> old
+    if store.child_job is not None or store.dirty == 0:
+        return
+    now = time.time()
+    if not store.last_bgsave_ok and now - store.last_bgsave_try < BGSAVE_RETRY_DELAY:
+        return
+    for seconds, changes in parse_save_params(config.get_value("save")) or []:
+        if store.dirty >= changes and now - store.lastsave > seconds:
+            print(f"[RDB] {changes} changes in {seconds} seconds. Saving...")
+            rdb_save_background(store, config)
+            return
@@ -1,82 +1,581 @@
+import mmap
 import os
-import io
+import struct
 import time
 
-from .rdb_utils import decode_size, read_string
+from .crc64 import crc64
+from .redis_object import HASH, LIST, SET, STREAM, STRING, ZSET, RedisObject, create_string_object
+from .streams import Stream
 
-def load_keys_from_rdb(path: str): 
-  keys = {}
-  
-  if not os.path.exists(path): 
-    print(f"[RDB] File not found {path}")
-    return keys
-  
-  with open(path, "rb") as raw: 
-    f = io.BufferedReader(raw)
-    
-    # Step 1: Verify Redis header
-    magic = f.read(9)
-    if magic != b"REDIS0011":
-      print("[RDB] Unsupported header")
+# oldest and newest rdb versions we understand (redis 2.x up to 7.4)
+MIN_RDB_VERSION = 1
+MAX_RDB_VERSION = 12
+
+# opcodes
+RDB_OPCODE_SLOT_INFO = 0xF4
+RDB_OPCODE_FUNCTION2 = 0xF5
+RDB_OPCODE_FUNCTION_PRE_GA = 0xF6
+RDB_OPCODE_MODULE_AUX = 0xF7
+RDB_OPCODE_IDLE = 0xF8
+RDB_OPCODE_FREQ = 0xF9
+RDB_OPCODE_AUX = 0xFA
+RDB_OPCODE_RESIZEDB = 0xFB
+RDB_OPCODE_EXPIRETIME_MS = 0xFC
+RDB_OPCODE_EXPIRETIME = 0xFD
+RDB_OPCODE_SELECTDB = 0xFE
+RDB_OPCODE_EOF = 0xFF
+
+# object types
+RDB_TYPE_STRING = 0
+RDB_TYPE_LIST = 1
+RDB_TYPE_SET = 2
+RDB_TYPE_ZSET = 3
+RDB_TYPE_HASH = 4
+RDB_TYPE_ZSET_2 = 5
+RDB_TYPE_HASH_ZIPLIST = 13
+RDB_TYPE_LIST_ZIPLIST = 10
+RDB_TYPE_SET_INTSET = 11
+RDB_TYPE_ZSET_ZIPLIST = 12
+RDB_TYPE_LIST_QUICKLIST = 14
+RDB_TYPE_STREAM_LISTPACKS = 15
+RDB_TYPE_HASH_LISTPACK = 16
+RDB_TYPE_ZSET_LISTPACK = 17
+RDB_TYPE_LIST_QUICKLIST_2 = 18
+RDB_TYPE_STREAM_LISTPACKS_2 = 19
+RDB_TYPE_SET_LISTPACK = 20
+RDB_TYPE_STREAM_LISTPACKS_3 = 21
+
+# special string encodings (length prefix 0b11)
+RDB_ENC_INT8 = 0
+RDB_ENC_INT16 = 1
+RDB_ENC_INT32 = 2
+RDB_ENC_LZF = 3
+
+QUICKLIST_NODE_CONTAINER_PLAIN = 1
+
+STREAM_ITEM_FLAG_DELETED = 1
+STREAM_ITEM_FLAG_SAMEFIELDS = 2
+
+
+class RdbError(ValueError):
+  pass
+
+
+def lzf_decompress(data, expected_len):
+  out = bytearray()
+  i = 0
+  n = len(data)
+  while i < n:
+    ctrl = data[i]
+    i += 1
+    if ctrl < 32:
+      # literal run of ctrl + 1 bytes
+      out += data[i:i + ctrl + 1]
+      i += ctrl + 1
+      continue
+    # back reference: length (+2) and distance into what was already written
+    length = ctrl >> 5
+    if length == 7:
+      length += data[i]
+      i += 1
+    ref = len(out) - ((ctrl & 0x1F) << 8) - data[i] - 1
+    i += 1
+    length += 2
+    if ref < 0:
+      raise RdbError("Invalid LZF back reference")
+    if ref + length <= len(out):
+      out += out[ref:ref + length]
+    else:
+      # the reference overlaps the bytes it produces, copy one at a time
+      for k in range(length):
+        out.append(out[ref + k])
+  if len(out) != expected_len:
+    raise RdbError("Invalid LZF compressed string")
+  return bytes(out)
+
+
+def ziplist_entries(blob):
+  # zlbytes(4) zltail(4) zllen(2), then entries of prevlen, encoding and data
+  entries = []
+  pos = 10
+  while blob[pos] != 0xFF:
+    pos += 1 if blob[pos] < 0xFE else 5
+    enc = blob[pos]
+    kind = enc >> 6
+    if kind == 0:
+      length = enc & 0x3F
+      pos += 1
+    elif kind == 1:
+      length = ((enc & 0x3F) << 8) | blob[pos + 1]
+      pos += 2
+    elif kind == 2:
+      length = int.from_bytes(blob[pos + 1:pos + 5], "big")
+      pos += 5
+    else:
+      pos += 1
+      if 0xF1 <= enc <= 0xFD:
+        # 4 bit immediate 0..12
+        entries.append((enc & 0x0F) - 1)
+        continue
+      size = {0xC0: 2, 0xD0: 4, 0xE0: 8, 0xF0: 3, 0xFE: 1}.get(enc)
+      if size is None:
+        raise RdbError(f"Invalid ziplist encoding {enc:#x}")
+      entries.append(int.from_bytes(blob[pos:pos + size], "little", signed=True))
+      pos += size
+      continue
+    entries.append(blob[pos:pos + length])
+    pos += length
+  return entries
+
+
+def listpack_backlen_size(size):
+  if size <= 127:
+    return 1
+  if size < 16383:
+    return 2
+  if size < 2097151:
+    return 3
+  if size < 268435455:
+    return 4
+  return 5
+
+
+def listpack_entries(blob):
+  # total bytes(4) element count(2), then entries of encoding, data and backlen
+  entries = []
+  pos = 6
+  while True:
+    enc = blob[pos]
+    if enc == 0xFF:
+      return entries
+    if enc < 0x80:
+      # 7 bit unsigned
+      entries.append(enc)
+      size = 1
+    elif enc < 0xC0:
+      length = enc & 0x3F
+      entries.append(blob[pos + 1:pos + 1 + length])
+      size = 1 + length
+    elif enc < 0xE0:
+      # 13 bit signed
+      value = ((enc & 0x1F) << 8) | blob[pos + 1]
+      entries.append(value - (1 << 13) if value >= 1 << 12 else value)
+      size = 2
+    elif enc < 0xF0:
+      length = ((enc & 0x0F) << 8) | blob[pos + 1]
+      entries.append(blob[pos + 2:pos + 2 + length])
+      size = 2 + length
+    elif enc == 0xF0:
+      length = int.from_bytes(blob[pos + 1:pos + 5], "little")
+      entries.append(blob[pos + 5:pos + 5 + length])
+      size = 5 + length
+    elif 0xF1 <= enc <= 0xF4:
+      width = (2, 3, 4, 8)[enc - 0xF1]
+      entries.append(int.from_bytes(blob[pos + 1:pos + 1 + width], "little", signed=True))
+      size = 1 + width
+    else:
+      raise RdbError(f"Invalid listpack encoding {enc:#x}")
+    pos += size + listpack_backlen_size(size)
+
+
+def intset_entries(blob):
+  width = int.from_bytes(blob[0:4], "little")
+  count = int.from_bytes(blob[4:8], "little")
+  return [int.from_bytes(blob[8 + i * width:8 + (i + 1) * width], "little", signed=True) for i in range(count)]
+
+
+def _string(value):
+  # elements of the packed encodings are either bytes or ints, strings are kept
+  # as bytes like everywhere else in the keyspace
+  if type(value) is int:
+    return b"%d" % value
+  return value
+
+
+def _pairs(items):
+  it = iter(items)
+  return zip(it, it)
+
+
+class RdbLoader:
+  # parses a whole rdb file from a read only mmap. every read is an index into the
+  # memoryview plus an offset bump, nothing is copied until a string is read.
+  # only db 0 is kept, keys of other databases are parsed and counted since the
+  # server has a single keyspace
+  def __init__(self, path, verify_checksum=True):
+    self.path = path
+    self.verify_checksum = verify_checksum
+    self.buf = None
+    self.pos = 0
+    self.version = None
+    self.aux = {}
+    self.skipped_keys = {}
+    self.expired_on_load = 0
+    # where the rdb ends, an aof with an rdb preamble continues from there
+    self.end_offset = 0
+
+  # ---- primitives ----
+
+  def _read_byte(self):
+    b = self.buf[self.pos]
+    self.pos += 1
+    return b
+
+  def _read_bytes(self, n):
+    end = self.pos + n
+    if end > len(self.buf):
+      raise RdbError("Unexpected end of file")
+    data = bytes(self.buf[self.pos:end])
+    self.pos = end
+    return data
+
+  def _read_uint(self, n, byteorder):
+    return int.from_bytes(self._read_bytes(n), byteorder)
+
+  def _read_length(self):
+    # returns (value, encoded): encoded is True for the special string encodings,
+    # value then says which one
+    b = self._read_byte()
+    kind = b >> 6
+    if kind == 0:
+      return b & 0x3F, False
+    if kind == 1:
+      return ((b & 0x3F) << 8) | self._read_byte(), False
+    if kind == 3:
+      return b & 0x3F, True
+    if b == 0x80:
+      return self._read_uint(4, "big"), False
+    if b == 0x81:
+      return self._read_uint(8, "big"), False
+    raise RdbError(f"Unknown length encoding {b:#x}")
+
+  def _read_len(self):
+    length, encoded = self._read_length()
+    if encoded:
+      raise RdbError("Unexpected string encoding in length")
+    return length
+
+  def _read_raw_string(self):
+    # bytes, or an int for the integer encodings
+    buf = self.buf
+    pos = self.pos
+    b = buf[pos]
+    if b < 0x40:
+      # fast path for the common short string with a 6 bit length
+      end = pos + 1 + b
+      if end > len(buf):
+        raise RdbError("Unexpected end of file")
+      self.pos = end
+      return bytes(buf[pos + 1:end])
+    length, encoded = self._read_length()
+    if not encoded:
+      return self._read_bytes(length)
+    if length == RDB_ENC_INT8:
+      return int.from_bytes(self._read_bytes(1), "little", signed=True)
+    if length == RDB_ENC_INT16:
+      return int.from_bytes(self._read_bytes(2), "little", signed=True)
+    if length == RDB_ENC_INT32:
+      return int.from_bytes(self._read_bytes(4), "little", signed=True)
+    if length == RDB_ENC_LZF:
+      compressed_len = self._read_len()
+      expected_len = self._read_len()
+      return lzf_decompress(self._read_bytes(compressed_len), expected_len)
+    raise RdbError(f"Unknown string encoding {length}")
+
+  def _read_string(self):
+    buf = self.buf
+    pos = self.pos
+    b = buf[pos]
+    if b < 0x40:
+      # copied straight out of the mapped file, no length decoding
+      end = pos + 1 + b
+      if end > len(buf):
+        raise RdbError("Unexpected end of file")
+      self.pos = end
+      return bytes(buf[pos + 1:end])
+    return _string(self._read_raw_string())
+
+  def _read_blob(self):
+    value = self._read_raw_string()
+    return b"%d" % value if type(value) is int else value
+
+  def _read_double(self):
+    # old zset scores: a length byte and the score as text
+    length = self._read_byte()
+    if length == 253:
+      return float("nan")
+    if length == 254:
+      return float("inf")
+    if length == 255:
+      return float("-inf")
+    return float(self._read_bytes(length))
+
+  def _read_binary_double(self):
+    return struct.unpack("<d", self._read_bytes(8))[0]
+
+  # ---- objects ----
+
+  def _read_object(self, rdb_type):
+    if rdb_type == RDB_TYPE_STRING:
+      value = self._read_raw_string()
+      if type(value) is int:
+        return RedisObject(STRING, value)
+      return create_string_object(_string(value))
+
+    if rdb_type == RDB_TYPE_LIST:
+      return RedisObject(LIST, [self._read_string() for _ in range(self._read_len())])
+    if rdb_type == RDB_TYPE_LIST_ZIPLIST:
+      return RedisObject(LIST, [_string(v) for v in ziplist_entries(self._read_blob())])
+    if rdb_type == RDB_TYPE_LIST_QUICKLIST:
+      items = []
+      for _ in range(self._read_len()):
+        items.extend(_string(v) for v in ziplist_entries(self._read_blob()))
+      return RedisObject(LIST, items)
+    if rdb_type == RDB_TYPE_LIST_QUICKLIST_2:
+      items = []
+      for _ in range(self._read_len()):
+        container = self._read_len()
+        blob = self._read_blob()
+        if container == QUICKLIST_NODE_CONTAINER_PLAIN:
+          items.append(_string(blob))
+        else:
+          items.extend(_string(v) for v in listpack_entries(blob))
+      return RedisObject(LIST, items)
+
+    if rdb_type == RDB_TYPE_SET:
+      return RedisObject(SET, {self._read_string() for _ in range(self._read_len())})
+    if rdb_type == RDB_TYPE_SET_INTSET:
+      return RedisObject(SET, {b"%d" % v for v in intset_entries(self._read_blob())})
+    if rdb_type == RDB_TYPE_SET_LISTPACK:
+      return RedisObject(SET, {_string(v) for v in listpack_entries(self._read_blob())})
+
+    if rdb_type in (RDB_TYPE_ZSET, RDB_TYPE_ZSET_2):
+      read_score = self._read_double if rdb_type == RDB_TYPE_ZSET else self._read_binary_double
+      zset = {}
+      for _ in range(self._read_len()):
+        member = self._read_string()
+        zset[member] = read_score()
+      return RedisObject(ZSET, zset)
+    if rdb_type in (RDB_TYPE_ZSET_ZIPLIST, RDB_TYPE_ZSET_LISTPACK):
+      blob = self._read_blob()
+      entries = ziplist_entries(blob) if rdb_type == RDB_TYPE_ZSET_ZIPLIST else listpack_entries(blob)
+      return RedisObject(ZSET, {_string(member): float(_string(score)) for member, score in _pairs(entries)})
+
+    if rdb_type == RDB_TYPE_HASH:
+      hash_value = {}
+      for _ in range(self._read_len()):
+        field = self._read_string()
+        hash_value[field] = self._read_string()
+      return RedisObject(HASH, hash_value)
+    if rdb_type in (RDB_TYPE_HASH_ZIPLIST, RDB_TYPE_HASH_LISTPACK):
+      blob = self._read_blob()
+      entries = ziplist_entries(blob) if rdb_type == RDB_TYPE_HASH_ZIPLIST else listpack_entries(blob)
+      return RedisObject(HASH, {_string(field): _string(value) for field, value in _pairs(entries)})
+
+    if rdb_type in (RDB_TYPE_STREAM_LISTPACKS, RDB_TYPE_STREAM_LISTPACKS_2, RDB_TYPE_STREAM_LISTPACKS_3):
+      return RedisObject(STREAM, self._read_stream(rdb_type))
+
+    raise RdbError(f"Unsupported object type {rdb_type}")
+
+  def _read_stream(self, rdb_type):
+    stream = Stream()
+    for _ in range(self._read_len()):
+      # each node is keyed by its master id (big endian ms and seq), entry ids
+      # inside the listpack are stored as deltas from it
+      node_key = self._read_blob()
+      master_ms = int.from_bytes(node_key[:8], "big")
+      master_seq = int.from_bytes(node_key[8:16], "big")
+      lp = listpack_entries(self._read_blob())
+      count, deleted, num_master = lp[0], lp[1], lp[2]
+      master_fields = [_string(field) for field in lp[3:3 + num_master]]
+      # skip the master entry terminator
+      i = 3 + num_master + 1
+      for _ in range(count + deleted):
+        flags = lp[i]
+        ms = master_ms + lp[i + 1]
+        seq = master_seq + lp[i + 2]
+        i += 3
+        if flags & STREAM_ITEM_FLAG_SAMEFIELDS:
+          values = lp[i:i + num_master]
+          i += num_master
+          fields = []
+          for field, value in zip(master_fields, values):
+            fields.append(field)
+            fields.append(_string(value))
+        else:
+          num_fields = lp[i]
+          fields = [_string(v) for v in lp[i + 1:i + 1 + 2 * num_fields]]
+          i += 1 + 2 * num_fields
+        # skip the lp-count of the entry
+        i += 1
+        if not flags & STREAM_ITEM_FLAG_DELETED:
+          stream.append(ms, seq, fields)
+
+    # length and last id, then the v2 first id, max deleted id and entries added
+    self._read_len()
+    self._read_len()
+    self._read_len()
+    if rdb_type >= RDB_TYPE_STREAM_LISTPACKS_2:
+      for _ in range(5):
+        self._read_len()
+
+    # consumer groups are parsed and dropped, they are not supported here
+    groups = self._read_len()
+    for _ in range(groups):
+      self._read_blob()
+      self._read_len()
+      self._read_len()
+      if rdb_type >= RDB_TYPE_STREAM_LISTPACKS_2:
+        self._read_len()
+      for _ in range(self._read_len()):
+        # raw id and delivery time, then the delivery count
+        self.pos += 16 + 8
+        self._read_len()
+      for _ in range(self._read_len()):
+        self._read_blob()
+        self.pos += 8
+        if rdb_type >= RDB_TYPE_STREAM_LISTPACKS_3:
+          self.pos += 8
+        pending = self._read_len()
+        self.pos += 16 * pending
+    if groups:
+      print(f"[RDB] Dropped {groups} consumer group(s) of a stream")
+    return stream
+
+  # ---- file ----
+
+  def load(self):
+    keys = {}
+    if not os.path.exists(self.path):
+      print(f"[RDB] File not found {self.path}")
       return keys
-    
-    # Step 2: Skip metadata
-    while f.peek(1)[:1] == b'\xFA':
-      print(f.peek(1)) 
-      f.read(1) # skip FA
-      _ = read_string(f) # skip key
-      _ = read_string(f) # skip value
-    
-    # Step 3: Look for DB selector and hash table size
-    while True: 
-      b = f.read(1)
-      if not b: 
-        break
-      
-      if b[0] == 0xFE: # DB selector
-        _ = decode_size(f)
-      elif b[0] == 0xFB: # hash size info
-        _ = decode_size(f)
-        _ = decode_size(f)
+
+    start = time.perf_counter()
+    with open(self.path, "rb") as f:
+      size = os.fstat(f.fileno()).st_size
+      if size < 9:
+        raise RdbError("Short read, the file is truncated")
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        self.buf = memoryview(mapped)
+        try:
+          self._parse(keys)
+          self.end_offset = self.pos
+        except (IndexError, struct.error, ValueError) as e:
+          if isinstance(e, RdbError):
+            raise
+          raise RdbError(f"Corrupt rdb file at offset {self.pos}: {e}")
+        finally:
+          self.buf.release()
+          self.buf = None
+
+    elapsed = time.perf_counter() - start
+    rate = size / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
+    print(f"[RDB] Loaded {len(keys)} keys from {size} bytes in {elapsed:.3f}s ({rate:.1f} MB/s)")
+    if self.expired_on_load:
+      print(f"[RDB] Skipped {self.expired_on_load} already expired keys")
+    for db, count in self.skipped_keys.items():
+      print(f"[RDB] Skipped {count} keys of db {db}, only db 0 is served")
+    return keys
+
+  def _parse(self, keys):
+    magic = self._read_bytes(9)
+    if magic[:5] != b"REDIS" or not magic[5:].isdigit():
+      raise RdbError("Wrong signature trying to load DB from file")
+    self.version = int(magic[5:])
+    if not MIN_RDB_VERSION <= self.version <= MAX_RDB_VERSION:
+      raise RdbError(f"Can't handle RDB format version {self.version}")
+
+    now = int(time.time() * 1000)
+    db = 0
+    expiry = None
+    while True:
+      opcode = self._read_byte()
+
+      if opcode == RDB_OPCODE_EOF:
         break
-    
-    # Step 4: parse key-val entries
-    while True: 
-      expiry = None
-      b = f.read(1)
-      if not b or b[0] == 0xFF: 
-        break # EOF marker
-      
-      # if b[0] in (0xFC, 0xFD): # optional expiry
-      #   skip = 8 if b[0] == 0xFC else 4
-      #   f.read(skip)
-      #   b = f.read(1)
-      
-      # reading expiry time from .rdb file too
-      if b[0] == 0xFC: # expiry in ms (8 bytes, little endian)
-        expiry = int.from_bytes(f.read(8), "little")
-        b = f.read(1)
-      elif b[0] == 0xFD: # expiry in s (4 bytes, little endian)
-        expiry = int.from_bytes(f.read(4), "little") * 1000
-        b = f.read(1)
-      
-      if b and b[0] == 0x00: 
-        key = read_string(f)
-        val = read_string(f)
-        now = int(time.time() * 1000)
-        if expiry is not None and expiry < now: 
-          continue
-        
-        keys[key] = {
-          "value": val,
-          "expiry": expiry, 
-          "type": "string"
-        }
-      else: 
-        print("[RDB] Unknown or unsupported type")
-  
-  return keys
-        
-        
-        
-      
\ No newline at end of file
+      if opcode == RDB_OPCODE_EXPIRETIME_MS:
+        expiry = self._read_uint(8, "little")
+        continue
+      if opcode == RDB_OPCODE_EXPIRETIME:
+        expiry = self._read_uint(4, "little") * 1000
+        continue
+      if opcode == RDB_OPCODE_FREQ:
+        self._read_byte()
+        continue
+      if opcode == RDB_OPCODE_IDLE:
+        self._read_len()
+        continue
+      if opcode == RDB_OPCODE_SELECTDB:
+        db = self._read_len()
+        continue
+      if opcode == RDB_OPCODE_RESIZEDB:
+        self._read_len()
+        self._read_len()
+        continue
+      if opcode == RDB_OPCODE_SLOT_INFO:
+        for _ in range(3):
+          self._read_len()
+        continue
+      if opcode == RDB_OPCODE_AUX:
+        field = self._read_string()
+        self.aux[field] = self._read_string()
+        continue
+      if opcode in (RDB_OPCODE_FUNCTION2, RDB_OPCODE_FUNCTION_PRE_GA):
+        self._read_blob()
+        print("[RDB] Skipping a function library, functions are not supported")
+        continue
+      if opcode == RDB_OPCODE_MODULE_AUX:
+        raise RdbError("Module aux data is not supported")
+
+      # anything else is the type of a key value pair
+      key = self._read_string()
+      if opcode == RDB_TYPE_STRING:
+        # strings are most of a typical dataset, skip the type dispatch
+        value = self._read_raw_string()
+        obj = RedisObject(STRING, value) if type(value) is int else create_string_object(_string(value))
+      else:
+        obj = self._read_object(opcode)
+      key_expiry, expiry = expiry, None
+      if db != 0:
+        self.skipped_keys[db] = self.skipped_keys.get(db, 0) + 1
+      elif key_expiry is not None and key_expiry < now:
+        self.expired_on_load += 1
+      else:
+        keys[key] = (obj, key_expiry)
+
+    # version 5+ ends with the crc64 of everything before it, 0 means disabled
+    if self.version >= 5:
+      end = self.pos
+      expected = self._read_uint(8, "little")
+      if self.verify_checksum and expected != 0:
+        actual = crc64(self.buf[:end])
+        if actual != expected:
+          raise RdbError(f"Wrong RDB checksum expected {expected:#x} got {actual:#x}")
+
+
+def load_keys_from_rdb(path: str, verify_checksum=True):
+  # {key: (RedisObject, expiry in ms or None)} for db 0
+  return RdbLoader(path, verify_checksum).load()
+
+
+def load_object(payload):
+  # the RedisObject of a DUMP payload (see rdb_writer.dump_object)
+  if len(payload) < 11:
+    raise RdbError("DUMP payload version or checksum are wrong")
+  body = payload[:-10]
+  version = int.from_bytes(payload[-10:-8], "little")
+  if version > MAX_RDB_VERSION or crc64(payload[:-8]) != int.from_bytes(payload[-8:], "little"):
+    raise RdbError("DUMP payload version or checksum are wrong")
+  loader = RdbLoader(None)
+  loader.buf = memoryview(body)
+  loader.version = version
+  loader.pos = 1
+  try:
+    obj = loader._read_object(body[0])
+  except (IndexError, struct.error, ValueError) as e:
+    if isinstance(e, RdbError):
+      raise
+    raise RdbError(f"Bad data format: {e}")
+  if loader.pos != len(body):
+    raise RdbError("Bad data format")
+  return obj
@@ -1,94 +1,10 @@
 # app/rdb_utils.py
-import sys
+from app.resp import decode_reply, reply_end
 
-def decode_size(f): 
-  first = f.read(1)
-  if not first: 
-    raise EOFError("Unexpected end of file while decoding size")
-
-  b = first[0]
-  # AND operation keeps the first two digits after 'b' (which is also stored in variable b) and it shifts left 6 times so get rid the of the other bits after 'bxx'
-  prefix = (b & 0b11000000) >> 6
-  
-  if prefix == 0b00: # 6-bit size
-    return b & 0b00111111
-  elif prefix == 0b01: 
-    second = f.read(1)
-    if not second: 
-      raise EOFError("Expected second byte for 14-bit size")
-    return ((b & 0b00111111) << 8) | second[0]
-  elif prefix == 0b10: 
-    full = f.read(4)
-    if len(full) < 4: 
-      raise EOFError("Expected 4 bytes for 32-bit size")
-    return int.from_bytes(full, byteorder="big")
-  else: 
-    print(prefix)
-    # raise ValueError("Unsupported size encoding (starts with 0b11)")
-    print(f"[WARN] Skipping unsupported special string encoding byte: {hex(b)}", file=sys.stderr)
-    return None
-
-
-def read_string(f): 
-  size = decode_size(f)
-  if size: 
-    return f.read(size).decode("utf-8")
-  else: 
-    print(f"[WARN] from read_string")
-
-def read_resp_command(sock):
-    def read_line():
-        line = b""
-        while not line.endswith(b"\r\n"):
-            chunk = sock.recv(1)
-            if not chunk:
-                raise ConnectionError("Socket closed during line read")
-            line += chunk
-        return line
-    
-    header = read_line()
-    if not header: 
-      raise ConnectionError("Socket closed while reading RESP array header")
-    # Read the RESP array header: *<num>\r\n
-    
-    if not header.startswith(b"*"):
-        raise ValueError("Invalid RESP array")
-
-    try:
-        num_args = int(header[1:-2])  # Skip * and \r\n
-    except ValueError:
-        raise ValueError("Invalid RESP array length")
-
-    args = []
-    for _ in range(num_args):
-        # Read bulk string header: $<len>\r\n
-        length_line = read_line()
-        if not length_line.startswith(b"$"):
-            raise ValueError("Invalid bulk string header")
-
-        try:
-            length = int(length_line[1:-2])
-        except ValueError:
-            raise ValueError("Invalid bulk string length")
-
-        # Read the actual content (can be binary-safe)
-        arg = b""
-        while len(arg) < length:
-            part = sock.recv(length - len(arg))
-            if not part:
-                raise ConnectionError("Socket closed during argument read")
-            arg += part
-
-        # Consume the trailing \r\n
-        trailer = sock.recv(2)
-        if trailer != b"\r\n":
-            raise ValueError("Expected CRLF after argument")
-
-        args.append(arg.decode())  # or `.decode("utf-8", errors="replace")`
-
-    return args
-  
-def consume_full_psync_response(sock):
+def consume_psync_response(sock, out):
+    # +CONTINUE carries no payload, +FULLRESYNC is followed by the RDB which is
+    # written to the file object out as it arrives. returns the reply line and
+    # the RDB size (None for a partial resync)
     # Step 1: Read PSYNC response line
     line = b""
     while not line.endswith(b"\r\n"):
@@ -99,8 +15,10 @@ def consume_full_psync_response(sock):
 
     print(f"[Replica] Received PSYNC response {line}")
     
+    if line.startswith(b"+CONTINUE"):
+        return line, None
     if not line.startswith(b"+FULLRESYNC"):
-        raise ValueError("Expected FULLRESYNC")
+        raise ValueError("Expected FULLRESYNC or CONTINUE")
 
     # Step 2: Read the RDB bulk string header: $<len>\r\n
     header = b""
@@ -121,70 +39,33 @@ def consume_full_psync_response(sock):
         raise ValueError(f"Invalid RDB length: {header}")
 
     # Step 3: Read exactly rdb_len bytes of RDB binary data
-    rdb_data = b""
-    while len(rdb_data) < rdb_len:
-        chunk = sock.recv(min(4096, rdb_len - len(rdb_data)))
-        if not chunk:
+    chunk = bytearray(64 * 1024)
+    view = memoryview(chunk)
+    remaining = rdb_len
+    while remaining:
+        n = sock.recv_into(view, min(len(chunk), remaining))
+        if not n:
             raise ConnectionError("Socket closed while receiving RDB data")
-        rdb_data += chunk
-
-    print(f"[Replica] Received RDB data ({len(rdb_data)} bytes)")
-    return line, header, rdb_data
-
-def try_read_resp_command(buffer: bytes): 
-    try:
-        args = []
-        i = 0
-        if not buffer.startswith(b"*"):
-            return None, buffer
-        end = buffer.find(b"\r\n")
+        out.write(view[:n])
+        remaining -= n
+
+    print(f"[Replica] Received RDB data ({rdb_len} bytes)")
+    return line, rdb_len
+
+def read_replies(sock, count):
+    # the next count replies of a server we sent commands to, decoded (see
+    # resp.decode_reply)
+    buf = bytearray()
+    pos = 0
+    replies = []
+    while len(replies) < count:
+        end = reply_end(buf, pos) if pos < len(buf) else -1
         if end == -1:
-            return None, buffer
-        num = int(buffer[1:end])
-        i = end + 2
-        for _ in range(num):
-            if i >= len(buffer) or buffer[i] != ord('$'):
-                return None, buffer
-            end = buffer.find(b"\r\n", i)
-            if end == -1:
-                return None, buffer
-            size = int(buffer[i+1:end])
-            i = end + 2
-            if i + size + 2 > len(buffer):
-                return None, buffer
-            arg = buffer[i:i+size]
-            args.append(arg.decode())
-            i += size + 2
-        return args, buffer[i:]
-    except:
-        return None, buffer
-
-def execute_commands_from_args(store, args): 
-    command = args[0].upper()
-
-    if command == "SET":
-        if len(args) >= 3:
-            k, v = args[1], args[2]
-            px = None
-            if len(args) >= 5 and args[3].upper() == "PX":
-                try:
-                    px = int(args[4])
-                except ValueError:
-                    return b"-ERR PX value must be an integer\r\n"
-            return store.set(k, v, px)
-        return b"-ERR wrong number of arguments for SET\r\n"
-
-    elif command == "GET" and len(args) == 2:
-        return store.get(args[1])
-
-    elif command == "INCR":
-        if len(args) != 2:
-            return b"-ERR wrong number of arguments for INCR\r\n"
-        try:
-            val = store.incr(args[1])
-            return f":{val}\r\n".encode()
-        except ValueError:
-            return b"-ERR value is not an integer or out of range\r\n"
-
-    return b"-ERR unknown or unsupported command in MULTI/EXEC\r\n"
-
+            chunk = sock.recv(64 * 1024)
+            if not chunk:
+                raise ConnectionError("Socket closed while reading a reply")
+            buf += chunk
+            continue
+        replies.append(decode_reply(buf, pos)[0])
+        pos = end
+    return replies
@@ -0,0 +1,222 @@
+import os
+import struct
+import time
+
+from .crc64 import crc64
+from .rdb_loader import (
+  RDB_OPCODE_AUX,
+  RDB_OPCODE_EOF,
+  RDB_OPCODE_EXPIRETIME_MS,
+  RDB_OPCODE_RESIZEDB,
+  RDB_OPCODE_SELECTDB,
+  RDB_TYPE_HASH,
+  RDB_TYPE_LIST,
+  RDB_TYPE_SET,
+  RDB_TYPE_STREAM_LISTPACKS_3,
+  RDB_TYPE_STRING,
+  RDB_TYPE_ZSET_2,
+  listpack_backlen_size,
+)
+from .redis_object import HASH, LIST, SET, STREAM, STRING, ZSET
+
+RDB_VERSION = 11
+# bytes collected before they are checksummed and handed to the file
+WRITE_CHUNK_BYTES = 64 * 1024
+# entries per listpack node of a stream, redis' stream-node-max-entries
+STREAM_NODE_MAX_ENTRIES = 100
+
+
+def encode_length(n):
+  if n < 1 << 6:
+    return bytes((n,))
+  if n < 1 << 14:
+    return bytes((0x40 | (n >> 8), n & 0xFF))
+  if n < 1 << 32:
+    return b"\x80" + n.to_bytes(4, "big")
+  return b"\x81" + n.to_bytes(8, "big")
+
+
+def encode_string(value):
+  # ints that fit in 32 bits use the compact integer encodings
+  if type(value) is int:
+    if -(1 << 7) <= value < 1 << 7:
+      return b"\xc0" + value.to_bytes(1, "little", signed=True)
+    if -(1 << 15) <= value < 1 << 15:
+      return b"\xc1" + value.to_bytes(2, "little", signed=True)
+    if -(1 << 31) <= value < 1 << 31:
+      return b"\xc2" + value.to_bytes(4, "little", signed=True)
+    value = b"%d" % value
+  data = value.encode() if type(value) is str else value
+  return encode_length(len(data)) + data
+
+
+def _listpack_backlen(size):
+  # the entry size written back to front, 7 bits per byte
+  n = listpack_backlen_size(size)
+  groups = [(size >> (7 * i)) & 0x7F for i in reversed(range(n))]
+  return bytes([groups[0]] + [g | 0x80 for g in groups[1:]])
+
+
+def _listpack_entry(value):
+  if type(value) is int:
+    if 0 <= value < 1 << 7:
+      entry = bytes((value,))
+    elif -(1 << 12) <= value < 1 << 12:
+      v = value & 0x1FFF
+      entry = bytes((0xC0 | (v >> 8), v & 0xFF))
+    elif -(1 << 15) <= value < 1 << 15:
+      entry = b"\xf1" + value.to_bytes(2, "little", signed=True)
+    elif -(1 << 23) <= value < 1 << 23:
+      entry = b"\xf2" + value.to_bytes(3, "little", signed=True)
+    elif -(1 << 31) <= value < 1 << 31:
+      entry = b"\xf3" + value.to_bytes(4, "little", signed=True)
+    else:
+      entry = b"\xf4" + value.to_bytes(8, "little", signed=True)
+  else:
+    data = value.encode() if type(value) is str else value
+    if len(data) < 1 << 6:
+      entry = bytes((0x80 | len(data),)) + data
+    elif len(data) < 1 << 12:
+      entry = bytes((0xE0 | (len(data) >> 8), len(data) & 0xFF)) + data
+    else:
+      entry = b"\xf0" + len(data).to_bytes(4, "little") + data
+  return entry + _listpack_backlen(len(entry))
+
+
+def encode_listpack(items):
+  body = b"".join(_listpack_entry(item) for item in items)
+  total = 6 + len(body) + 1
+  count = min(len(items), 0xFFFF)
+  return total.to_bytes(4, "little") + count.to_bytes(2, "little") + body + b"\xff"
+
+
+def encode_stream(stream):
+  # radix tree nodes of up to STREAM_NODE_MAX_ENTRIES entries. every node has a
+  # master entry with the field names of its first entry, later entries with the
+  # same fields only store their values (the SAMEFIELDS flag)
+  count = len(stream)
+  ms_parts, seq_parts, all_fields = stream.ms_parts, stream.seq_parts, stream.fields
+  nodes = []
+  for start in range(0, count, STREAM_NODE_MAX_ENTRIES):
+    end = min(start + STREAM_NODE_MAX_ENTRIES, count)
+    master_ms, master_seq = ms_parts[start], seq_parts[start]
+    master_fields = all_fields[start][0::2]
+    lp = [end - start, 0, len(master_fields)] + master_fields + [0]
+    for i in range(start, end):
+      fields = all_fields[i]
+      ms_diff, seq_diff = ms_parts[i] - master_ms, seq_parts[i] - master_seq
+      if fields[0::2] == master_fields:
+        values = fields[1::2]
+        lp += [2, ms_diff, seq_diff] + values + [3 + len(values)]
+      else:
+        lp += [0, ms_diff, seq_diff, len(fields) // 2] + fields + [4 + len(fields)]
+    node_key = master_ms.to_bytes(8, "big") + master_seq.to_bytes(8, "big")
+    nodes.append(encode_string(node_key) + encode_string(encode_listpack(lp)))
+
+  last_ms, last_seq = stream.last_id()
+  first_ms, first_seq = stream.first_id()
+  parts = [encode_length(len(nodes))] + nodes
+  # length, last id, first id, max deleted id, entries added, no consumer groups
+  for n in (count, last_ms, last_seq, first_ms, first_seq, 0, 0, count, 0):
+    parts.append(encode_length(n))
+  return b"".join(parts)
+
+
+def encode_object(obj):
+  # (rdb type, payload) of a keyspace entry
+  value = obj.value
+  if obj.type == STRING:
+    return RDB_TYPE_STRING, encode_string(value)
+  if obj.type == LIST:
+    return RDB_TYPE_LIST, encode_length(len(value)) + b"".join(encode_string(item) for item in value)
+  if obj.type == SET:
+    return RDB_TYPE_SET, encode_length(len(value)) + b"".join(encode_string(member) for member in value)
+  if obj.type == ZSET:
+    parts = [encode_length(len(value))]
+    for member, score in value.items():
+      parts.append(encode_string(member) + struct.pack("<d", score))
+    return RDB_TYPE_ZSET_2, b"".join(parts)
+  if obj.type == HASH:
+    parts = [encode_length(len(value))]
+    for field, field_value in value.items():
+      parts.append(encode_string(field) + encode_string(field_value))
+    return RDB_TYPE_HASH, b"".join(parts)
+  if obj.type == STREAM:
+    return RDB_TYPE_STREAM_LISTPACKS_3, encode_stream(value)
+  raise ValueError(f"Can't serialize a value of type {obj.type}")
+
+
+def dump_object(obj):
+  # the DUMP payload: the value as stored in an rdb, then the rdb version and a
+  # crc64 of everything before it, so RESTORE can reject a corrupt payload
+  rdb_type, payload = encode_object(obj)
+  data = bytes((rdb_type,)) + payload + RDB_VERSION.to_bytes(2, "little")
+  return data + crc64(data).to_bytes(8, "little")
+
+
+class RdbWriter:
+  # buffers the encoded file and writes it in chunks, checksumming as it goes
+  def __init__(self, f, checksum=True):
+    self.f = f
+    self.checksum = checksum
+    self.crc = 0
+    self.chunks = []
+    self.pending = 0
+    self.written = 0
+
+  def write(self, data):
+    self.chunks.append(data)
+    self.pending += len(data)
+    if self.pending >= WRITE_CHUNK_BYTES:
+      self.flush()
+
+  def flush(self):
+    if not self.chunks:
+      return
+    data = b"".join(self.chunks)
+    self.chunks = []
+    self.pending = 0
+    if self.checksum:
+      self.crc = crc64(data, self.crc)
+    self.f.write(data)
+    self.written += len(data)
+
+  def write_snapshot(self, items, key_count, expires_count, aux):
+    # items yields (key, RedisObject, expiry in ms or None) of db 0
+    self.write(b"REDIS%04d" % RDB_VERSION)
+    for field, value in aux.items():
+      self.write(bytes((RDB_OPCODE_AUX,)) + encode_string(field) + encode_string(value))
+    self.write(bytes((RDB_OPCODE_SELECTDB,)) + encode_length(0))
+    self.write(bytes((RDB_OPCODE_RESIZEDB,)) + encode_length(key_count) + encode_length(expires_count))
+    for key, obj, expiry in items:
+      rdb_type, payload = encode_object(obj)
+      if expiry is not None:
+        self.write(bytes((RDB_OPCODE_EXPIRETIME_MS,)) + expiry.to_bytes(8, "little"))
+      self.write(bytes((rdb_type,)) + encode_string(key) + payload)
+    self.write(bytes((RDB_OPCODE_EOF,)))
+    self.flush()
+    # a zero checksum tells the loader not to verify it
+    self.f.write((self.crc if self.checksum else 0).to_bytes(8, "little"))
+    self.written += 8
+
+
+def write_rdb_file(path, items, key_count, expires_count, aux, checksum=True):
+  # write to a temp file in the same directory and rename it over the old dump,
+  # so a crash mid write never leaves a truncated rdb behind. returns the size
+  directory = os.path.dirname(os.path.abspath(path))
+  os.makedirs(directory, exist_ok=True)
+  tmp_path = os.path.join(directory, f"temp-{os.getpid()}-{time.monotonic_ns()}.rdb")
+  try:
+    with open(tmp_path, "wb") as f:
+      writer = RdbWriter(f, checksum)
+      writer.write_snapshot(items, key_count, expires_count, aux)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+  except BaseException:
+    try:
+      os.unlink(tmp_path)
+    except OSError:
+      pass
+    raise
+  return writer.written
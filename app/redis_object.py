@@ -0,0 +1,71 @@
+# value types, interned so every entry shares the same string object
+STRING = "string"
+LIST = "list"
+SET = "set"
+ZSET = "zset"
+HASH = "hash"
+STREAM = "stream"
+
+# strings up to this many bytes are reported as embstr, like redis
+EMBSTR_SIZE_LIMIT = 44
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+
+class RedisObject:
+  # one keyspace entry: a slotted object with the type tag and the value is a
+  # fraction of the size of the {"type", "value", "expiry"} dict it replaces.
+  # the expiry lives in the store's ExpiryIndex, not here. string values that
+  # are canonical 64 bit integers are kept as python ints (the "int" encoding).
+  # lru is the access metadata eviction looks at, see app/evict.py
+  __slots__ = ("type", "value", "lru")
+
+  def __init__(self, type, value):
+    self.type = type
+    self.value = value
+    self.lru = 0
+
+
+def string_to_int(text):
+  # like redis' string2ll: only canonical integers (b"12", b"-3", not b"012",
+  # b"+1" or b" 1") that fit in a signed 64 bit integer, None otherwise.
+  # bytes.isdigit only accepts ascii digits
+  if not text or len(text) > 20:
+    return None
+  digits = text[1:] if text[0] == 0x2D else text # '-'
+  if not digits.isdigit() or (digits[0] == 0x30 and len(text) > 1): # '0'
+    return None
+  value = int(text)
+  if value < INT64_MIN or value > INT64_MAX:
+    return None
+  return value
+
+
+def create_string_object(value):
+  # values that look like integers are stored as ints so INCR & co don't parse
+  if type(value) is bytes:
+    number = string_to_int(value)
+    if number is not None:
+      return RedisObject(STRING, number)
+  return RedisObject(STRING, value)
+
+
+def string_value(obj: RedisObject):
+  value = obj.value
+  return b"%d" % value if type(value) is int else value
+
+
+def object_encoding(obj: RedisObject):
+  value = obj.value
+  if obj.type == STRING:
+    if type(value) is int:
+      return "int"
+    return "embstr" if len(value) <= EMBSTR_SIZE_LIMIT else "raw"
+  if obj.type == STREAM:
+    return "stream"
+  if obj.type == LIST:
+    return "quicklist"
+  if obj.type == ZSET:
+    return "skiplist"
+  return "hashtable"
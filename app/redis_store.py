@@ -2,16 +2,53 @@ import time
 from .rdb_loader import load_keys_from_rdb
 import secrets
 import threading
-from collections import OrderedDict
+from .backlog import ReplicationBacklog
+from .blocking import BlockingRegistry
+from .evict import EvictionPool, lfu_initial, lfu_touch, lru_clock, object_size, pick_eviction_candidate, stream_entry_size, value_size
+from .expiry import ExpiryIndex
+from .keyspace import KeyspaceIndex
+from .latency import LatencyMonitor
+from .pattern import compile_pattern
+from .redis_object import INT64_MAX, INT64_MIN, STREAM, STRING, RedisObject, create_string_object
+from .slowlog import SlowLog
+from .slots import key_hash_slot
+from .stats import InstantaneousMetric
+from .resp import EMPTY_ARRAY, NULL_BULK, OK, encode_array
+from .streams import MAX_ID_PART, Stream, StreamIdError, format_id, next_id, parse_id, previous_id
+
+WRONGTYPE_ERROR = b"-WRONGTYPE Operation against a key holding the wrong kind of value\r\n"
 
 class RedisStore:
-  def __init__(self, rdb_path=None, replica_config=None):
-    self.data = {
-      "stream_key": {
-        "type": "stream",
-        "entries": OrderedDict()
-      } 
-    }
+  def __init__(self, rdb_path=None, replica_config=None, rdb_checksum=True, repl_backlog_size=1024 * 1024):
+    self.data = {}
+    # the same keys bucketed by hash for SCAN cursors
+    self.keyspace = KeyspaceIndex()
+    # hash slot -> its keys, only kept in cluster mode (enable_slot_index)
+    self.slot_keys = None
+    # guards the indexes every key is in, for the threaded server
+    self.index_lock = threading.Lock()
+    # persistence.KeyspaceSnapshot of a background save running in a thread, it
+    # is handed the old value of every key written while it walks the keyspace
+    self.snapshot = None
+    # estimated size of the dataset (see evict.object_size), kept up to date by
+    # _insert and _delete
+    self.used_memory = 0
+    self.used_memory_peak = 0
+    # maxmemory and its policy, set from the config by configure_memory
+    self.maxmemory = 0
+    self.maxmemory_policy = "noeviction"
+    self.maxmemory_samples = 5
+    # with an lfu policy RedisObject.lru holds an access counter, not a time
+    self.lfu = False
+    self.lfu_log_factor = 10
+    self.lfu_decay_time = 1
+    # seconds, refreshed by the cron so an access doesn't have to read the clock
+    self.lru_clock = lru_clock()
+    self.eviction_pool = EvictionPool()
+    self.stat_evicted_keys = 0
+    self._insert(b"stream_key", RedisObject(STREAM, Stream()))
+    # clients waiting in XREAD BLOCK, woken by xadd on the key they wait for
+    self.blocking = BlockingRegistry()
     self.role = replica_config.get("role", "master")
     self.master_host = replica_config.get("master_host")
     self.master_port = replica_config.get("master_port")
@@ -23,312 +60,583 @@ class RedisStore:
       self.master_repl_offset = 0
       # to store the replica sockets to propagate commands
       self.replica_sockets = []
-      self.command_logs = []
+      # the tail of the replication stream, for replicas that reconnect
+      self.repl_backlog = ReplicationBacklog(repl_backlog_size)
+      # feeding the backlog and the replicas happens in one step under this lock,
+      # so a replica registered by PSYNC never misses or repeats a write
+      self.repl_lock = threading.Lock()
+      # replicas waiting for the rdb of a full resync (replication.WaitingReplica)
+      self.waiting_replicas = []
+      # replica connection -> the last offset it acknowledged with REPLCONF ACK
+      self.replica_ack_offsets = {}
+      # clients parked in WAIT, woken whenever an ack comes in
+      self.ack_waiters = BlockingRegistry()
+      # set by WAIT, one REPLCONF GETACK goes out per event loop iteration
+      self.getack_requested = False
     else:
       self.master_repl_id = None
       self.master_repl_offset = None
       self.repl_offset = 0
       self.repl_offset_lock = threading.Lock()
 
+    # volatile keys and their deadlines, expiry is not stored in the entries
+    self.expires = ExpiryIndex()
+    # keys deleted by expiry that still have to be propagated as DEL, see
+    # expired_keys below
+    self._local = threading.local()
+    self.stat_expired_keys = 0
+    # INFO stats
+    self.stat_numcommands = 0
+    self.stat_total_error_replies = 0
+    self.ops_sec = InstantaneousMetric()
+    # SLOWLOG and LATENCY, configured by main once the config is read
+    self.slowlog = SlowLog()
+    self.latency = LatencyMonitor()
+
+    # persistence: writes since the last successful save, and the running
+    # background save or aof rewrite (persistence.BackgroundJob)
+    self.dirty = 0
+    # set while the append only file is replayed, its commands are already in
+    # the log and were never meant for the replicas
+    self.loading = False
+    self.lastsave = int(time.time())
+    self.child_job = None
+    self.last_bgsave_ok = True
+    self.last_bgsave_try = 0
+    self.last_bgsave_duration = -1
+
+    # append only file, set up by main once the dataset is loaded
+    self.aof = None
+    self.aof_rewrite_scheduled = False
+    self.aof_last_rewrite_ok = True
+
+    # cluster.ClusterState when started with --cluster-enabled
+    self.cluster = None
+
+    # threaded mode: locking.StripedLocks guarding the keys (see app/locking.py)
+    self.locks = None
+
     if rdb_path: # if rdb_path exists, load the data from the file
-      parsed_data = load_keys_from_rdb(rdb_path)
-      self.data.update(parsed_data)
-      print(f"Printing self.data {self.data}")
-
-  def set(self, key, val, px=None):
-    # expiry_time = None
-    # if px is not None:
-    #   expiry_time = self._curr_time_ms() + px
-    # # storing it as a tuple when the val and expiry_time
-    # self.data[key] = (val, expiry_time)
-    # return b"+OK\r\n"
-    expiry_time = None
-    if px is not None: 
-      expiry_time = self._curr_time_ms() + px
-    
-    self.data[key] = {
-      "type": "string",
-      "value": val,
-      "expiry": expiry_time
-    }
-    
-    return b"+OK\r\n"
-  
-  def incr(self, key): 
-    now = self._curr_time_ms()
-    
-    if key not in self.data: 
-      self.set(key, "1")
-      return 1
-    
-    entry = self.data[key]
-    expiry = entry.get("expiry")
-    if expiry is not None and now >= expiry: 
-      del self.data[key]
-      self.set(key, "1")
-      return 1
-    
+      self.load_keys(load_keys_from_rdb(rdb_path, verify_checksum=rdb_checksum))
+
+  @property
+  def expired_keys(self):
+    # per thread, so the thread that expired a key is the one propagating the
+    # DEL, before the write of the command that expired it
+    local = self._local
     try:
-      val = int(entry["value"])
-      val += 1
-    except ValueError:
-      print("inside error block")
-      raise ValueError("NOT INT")
-    
-    self.set(key, str(val), px=expiry - now if expiry else None)
+      return local.expired_keys
+    except AttributeError:
+      local.expired_keys = []
+      return local.expired_keys
+
+  @expired_keys.setter
+  def expired_keys(self, keys):
+    self._local.expired_keys = keys
+
+  def reset_stats(self):
+    # CONFIG RESETSTAT, the per command counters are reset by the caller
+    self.stat_expired_keys = 0
+    self.stat_evicted_keys = 0
+    self.stat_numcommands = 0
+    self.stat_total_error_replies = 0
+    self.ops_sec.reset()
+
+  def enable_slot_index(self):
+    self.slot_keys = {}
+    for key in self.data:
+      self.slot_keys.setdefault(key_hash_slot(key), set()).add(key)
+
+  def flushall(self):
+    if self.snapshot is not None:
+      self.snapshot.preserve_all()
+    self.data.clear()
+    self.keyspace.clear()
+    if self.slot_keys is not None:
+      self.slot_keys.clear()
+    self.expires.clear()
+    self.eviction_pool.clear()
+    self.used_memory = 0
+    self.dirty += 1
+
+  def load_keys(self, parsed_data):
+    # {key: (RedisObject, expiry)} as returned by the rdb loader
+    for key, (obj, expiry) in parsed_data.items():
+      self._insert(key, obj)
+      if expiry is not None:
+        self.expires.set(key, expiry)
+
+  def _lookup(self, key, touch=True):
+    # every read goes through here so expired keys are reclaimed lazily, and
+    # the access is recorded for eviction unless touch is off (OBJECT)
+    entry = self.data.get(key)
+    if entry is None:
+      return None
+    expiry = self.expires.get(key)
+    if expiry is not None and self._curr_time_ms() >= expiry:
+      self._expire_key(key)
+      return None
+    if touch:
+      if self.lfu:
+        entry.lru = lfu_touch(entry.lru, self.lfu_log_factor, self.lfu_decay_time)
+      else:
+        entry.lru = self.lru_clock
+    return entry
+
+  def _before_write(self, key):
+    # called before a key's value or ttl changes
+    snapshot = self.snapshot
+    if snapshot is not None:
+      snapshot.preserve(key)
+
+  def _insert(self, key, obj):
+    self._before_write(key)
+    data = self.data
+    old = data.get(key)
+    obj.lru = lfu_initial() if self.lfu else self.lru_clock
+    with self.index_lock:
+      if old is None:
+        self.keyspace.add(key)
+        if self.slot_keys is not None:
+          self.slot_keys.setdefault(key_hash_slot(key), set()).add(key)
+        self.used_memory += object_size(key, obj)
+      else:
+        self.used_memory += value_size(obj) - value_size(old)
+    data[key] = obj
+
+  def _delete(self, key):
+    self._before_write(key)
+    entry = self.data.pop(key, None)
+    if entry is None:
+      return False
+    self.expires.remove(key)
+    with self.index_lock:
+      self.used_memory -= object_size(key, entry)
+      self.keyspace.remove(key)
+      if self.slot_keys is not None:
+        slot = key_hash_slot(key)
+        keys = self.slot_keys[slot]
+        keys.discard(key)
+        if not keys:
+          del self.slot_keys[slot]
+    return True
+
+  def _is_expired(self, key, now):
+    expiry = self.expires.get(key)
+    return expiry is not None and now >= expiry
+
+  def _expire_key(self, key):
+    self._delete(key)
+    self.stat_expired_keys += 1
+    self.dirty += 1
+    # the master tells replicas (and later the AOF) about expired keys with a DEL
+    if self.role == "master":
+      self.expired_keys.append(key)
+
+  def set(self, key, val, px=None, pxat=None):
+    self._insert(key, create_string_object(val))
+    # SET always discards a previous ttl. px is relative, pxat a unix time in ms
+    if px is not None:
+      pxat = self._curr_time_ms() + px
+    if pxat is not None:
+      self.expires.set(key, pxat)
+    else:
+      self.expires.remove(key)
+
+    return OK
+  
+  def incrby(self, key, increment):
+    # counters are stored as ints, so this is an add and a range check. a string
+    # value that is not a canonical integer was never converted and can't be one
+    entry = self._lookup(key)
+    if entry is None:
+      self._insert(key, RedisObject(STRING, increment))
+      return increment
+    if entry.type != STRING:
+      raise TypeError("WRONGTYPE")
+
+    val = entry.value
+    if type(val) is not int:
+      raise ValueError("value is not an integer or out of range")
+    val += increment
+    if val < INT64_MIN or val > INT64_MAX:
+      raise ValueError("increment or decrement would overflow")
+
+    # the ttl is kept, only the value changes
+    self._before_write(key)
+    entry.value = val
     return val
 
   def get(self, key):
-    if key in self.data: 
-      entry = self.data[key]
-      
-      expiry = entry.get("expiry")
-      if expiry is not None and self._curr_time_ms() >= expiry: 
-        del self.data[key]
-        return b"$-1\r\n"
-      
-      val = entry["value"] 
-      return f"${len(val)}\r\n{val}\r\n".encode()
-    
-    return b"$-1\r\n"
+    entry = self._lookup(key)
+    if entry is None: 
+      return NULL_BULK
+    if entry.type != STRING:
+      return WRONGTYPE_ERROR
+
+    val = entry.value
+    if type(val) is int:
+      val = b"%d" % val
+    return b"$%d\r\n%s\r\n" % (len(val), val)
+
+  def get_if_live(self, key):
+    # GET without lazy expiry, for readers that hold no lock: None when the key
+    # is expired (deleting it is a write) or isn't a string
+    entry = self.data.get(key)
+    if entry is None or entry.type != STRING:
+      return None
+    expiry = self.expires.get(key)
+    if expiry is not None and self._curr_time_ms() >= expiry:
+      return None
+    if self.lfu:
+      entry.lru = lfu_touch(entry.lru, self.lfu_log_factor, self.lfu_decay_time)
+    else:
+      entry.lru = self.lru_clock
+    val = entry.value
+    if type(val) is int:
+      val = b"%d" % val
+    return b"$%d\r\n%s\r\n" % (len(val), val)
+
+  def object(self, key):
+    # the entry itself, for OBJECT ENCODING and friends, which don't count as
+    # an access
+    return self._lookup(key, touch=False)
+
+  def restore(self, key, obj, pxat=None, replace=False, lru=None):
+    # RESTORE: False when the key exists and replace isn't set. lru is the
+    # access metadata from IDLETIME or FREQ
+    if not replace and self._lookup(key) is not None:
+      return False
+    self._delete(key)
+    self._insert(key, obj)
+    if lru is not None:
+      obj.lru = lru
+    if pxat is not None:
+      self.expires.set(key, pxat)
+    return True
 
-  def keys(self):
+  def configure_memory(self, config):
+    # CONFIG SET maxmemory & co take effect here, and at startup
+    policy = config.get_value("maxmemory-policy")
+    lfu = policy.endswith("lfu")
+    if lfu != self.lfu:
+      # every lru slot switches meaning: start everyone over
+      initial = lfu_initial() if lfu else self.lru_clock
+      for entry in self.data.values():
+        entry.lru = initial
+    if policy != self.maxmemory_policy:
+      self.eviction_pool.clear()
+    self.lfu = lfu
+    self.maxmemory = config.get_value("maxmemory")
+    self.maxmemory_policy = policy
+    self.maxmemory_samples = max(1, config.get_value("maxmemory-samples"))
+    self.lfu_log_factor = config.get_value("lfu-log-factor")
+    self.lfu_decay_time = config.get_value("lfu-decay-time")
+
+  def over_maxmemory(self):
+    # replicas leave eviction to their master, its DELs come down the stream
+    return self.maxmemory > 0 and self.used_memory > self.maxmemory and self.role == "master"
+
+  def evict(self):
+    # deletes keys picked by the policy until the dataset fits in maxmemory.
+    # False when it still doesn't: noeviction, or no key left to pick
+    if self.maxmemory_policy == "noeviction":
+      return not self.over_maxmemory()
+    start = time.perf_counter()
+    try:
+      while self.over_maxmemory():
+        key = pick_eviction_candidate(self, self.maxmemory_policy, self.maxmemory_samples)
+        if key is None:
+          return False
+        self._delete(key)
+        self.stat_evicted_keys += 1
+        self.dirty += 1
+        # like an expired key, the aof and the replicas get a DEL
+        self.expired_keys.append(key)
+      return True
+    finally:
+      self.latency.add_sample_since("eviction-cycle", start)
+
+  def keys_in_slot(self, slot, count=None):
+    keys = self.slot_keys.get(slot, ())
+    if count is None:
+      return list(keys)
+    return [key for key, _ in zip(keys, range(count))]
+
+  def delete(self, keys):
+    deleted = 0
+    for key in keys:
+      if self._lookup(key) is not None and self._delete(key):
+        deleted += 1
+    return deleted
+
+  def keys(self, pattern=b"*"):
     now = self._curr_time_ms()
+    match = compile_pattern(pattern)
     valid_keys = []
     expired_keys = []
 
-    for key, entry in self.data.items(): 
-      # skipping over non-string types
-      if entry.get("type") != "string": 
-        continue 
+    # every type, like SCAN
+    for key in self.data: 
+      if match is not None and not match(key):
+        continue
       
-      expiry = entry.get("expiry")
-      if expiry is not None and now >= expiry: 
+      if self._is_expired(key, now):
         expired_keys.append(key)
       else: 
         valid_keys.append(key)
       
+    start = time.perf_counter()
     for key in expired_keys:
-      del self.data[key]
+      self._expire_key(key)
+    self.latency.add_sample_since("keys-lazy-expire", start)
       
-    return self._encode_resp_list(valid_keys)
+    return encode_array(valid_keys)
+
+  def scan(self, cursor, count=10, pattern=None, type_name=None):
+    # one step of an incremental walk over the keyspace, returns the next cursor
+    # and the keys found. expired keys met on the way are deleted, not returned
+    cursor, found = self.keyspace.scan(cursor, count)
+    match = compile_pattern(pattern) if pattern is not None else None
+    now = self._curr_time_ms()
+    data = self.data
+    keys = []
+    for key in found:
+      if self._is_expired(key, now):
+        self._expire_key(key)
+        continue
+      if match is not None and not match(key):
+        continue
+      if type_name is not None and data[key].type != type_name:
+        continue
+      keys.append(key)
+    return cursor, keys
 
   def type(self, key):
-    if key in self.data: 
-      entry = self.data[key]
-      expiry = entry.get("expiry")
-      if expiry is not None and self._curr_time_ms() >= expiry:
-        del self.data[key]
-        # return none if key is expired
-        return b"+none\r\n"
-      
-      # return type
-      return f"+{entry['type']}\r\n".encode()
+    entry = self._lookup(key)
+    if entry is None: 
+      # return none for type if the key is not found or expired
+      return b"+none\r\n"
     
-    # return none for type if the key is not found
-    return b"+none\r\n"
-  
+    # return type
+    return f"+{entry.type}\r\n".encode()
+
+  # ---- ttl ----
+
+  def pttl(self, key):
+    # -2 if the key doesn't exist, -1 if it has no ttl
+    if self._lookup(key) is None:
+      return -2
+    expiry = self.expires.get(key)
+    if expiry is None:
+      return -1
+    return max(0, expiry - self._curr_time_ms())
+
+  def expire_at(self, key, when_ms, condition=None):
+    # condition is one of NX, XX, GT, LT like EXPIRE. returns 1 if the ttl was set
+    if self._lookup(key) is None:
+      return 0
+    current = self.expires.get(key)
+    if condition == b"NX" and current is not None:
+      return 0
+    if condition == b"XX" and current is None:
+      return 0
+    # a key without ttl counts as an infinite ttl for GT and LT
+    if condition == b"GT" and (current is None or when_ms <= current):
+      return 0
+    if condition == b"LT" and current is not None and when_ms >= current:
+      return 0
+
+    if when_ms <= self._curr_time_ms():
+      # a deadline in the past deletes the key right away
+      self._delete(key)
+      if self.role == "master":
+        self.expired_keys.append(key)
+      return 1
+    self._before_write(key)
+    self.expires.set(key, when_ms)
+    return 1
+
+  def persist(self, key):
+    if self._lookup(key) is None:
+      return 0
+    self._before_write(key)
+    return 1 if self.expires.remove(key) else 0
+
+  def active_expire_cycle(self, budget_ms):
+    # delete keys whose deadline passed without anyone reading them. the expiry
+    # heap hands out due keys in deadline order, so unlike redis' random sampling
+    # no time is spent looking at keys that are not expired yet
+    start = time.perf_counter()
+    deadline = start + budget_ms / 1000
+    expired, _ = self.expires.pop_due(self._curr_time_ms(), deadline, self._expire_key)
+    self.latency.add_sample_since("expire-cycle", start)
+    return expired
+
   def xadd(self, stream_key, entry_id, fields):
-    try: 
-      if stream_key not in self.data: 
-          self.data[stream_key] = {
-            "type": "stream",
-            "entries": OrderedDict()
-          }
-        
-      stream_obj = self.data[stream_key]
-      if stream_obj["type"] != "stream":
-        return b"-ERR key exists but is not a stream\r\n"
-        
-      entries = stream_obj["entries"]
-      
-      if entry_id == "*": 
+    stream_obj = self._lookup(stream_key)
+    if stream_obj is not None and stream_obj.type != STREAM:
+      return WRONGTYPE_ERROR
+    stream = stream_obj.value if stream_obj is not None else None
+    last_ms, last_seq = stream.last_id() if stream else (0, 0)
+
+    try:
+      if entry_id == b"*":
         ms_part = self._curr_time_ms()
         seq_part = 0
-        if entries: 
-          last_id = next(reversed(entries))
-          last_ms, last_seq = map(int, last_id.split("-"))
-          if ms_part < last_ms: 
-            ms_part = last_ms
-            seq_part = last_seq + 1
-          elif ms_part == last_ms: 
-            seq_part = last_seq + 1
-        
-        final_id = f"{ms_part}-{seq_part}"
-      else: 
-        if "-" not in entry_id: 
-          return b"-ERR Invalid entry ID format\r\n"
-        
-        ms_raw, seq_raw = entry_id.split("-")
-        ms_part = int(ms_raw)
-        
-        if ms_part < 0: 
-          return b"-ERR The ID specified in XADD must be greater than 0-0\r\n"
-        
-        if seq_raw == "*": 
-          # setting the default if seq_part is not found in the existing_id
-          if ms_part == 0: 
-            seq_part = 1
-          else: 
-            seq_part = 0
-          
-          for existing_id in reversed(entries): 
-            last_ms, last_seq = map(int, existing_id.split("-"))
-            if last_ms == ms_part:
-              seq_part = last_seq + 1
-              break
+        # the clock can go backwards, ids can't
+        if ms_part <= last_ms:
+          ms_part = last_ms
+          seq_part = last_seq + 1
+      elif entry_id.endswith(b"-*"):
+        ms_part, _ = parse_id(entry_id[:-2])
+        if stream and ms_part == last_ms:
+          seq_part = last_seq + 1
         else:
-          seq_part = int(seq_raw)
-          if ms_part == 0 and seq_part == 0:
-            return b"-ERR The ID specified in XADD must be greater than 0-0\r\n"
-        
-        final_id = f"{ms_part}-{seq_part}"
-        
-        # Validate: final_id must be strictly greater than last entry
-        if entries: 
-          last_id = next(reversed(entries))
-          last_ms, last_seq = map(int, last_id.split("-"))
-          
-          if ms_part < last_ms or (ms_part == last_ms and seq_part <= last_seq):
-            return b"-ERR The ID specified in XADD is equal or smaller than the target stream top item\r\n"
-        
-      entry_data = {}
-      # for loop to increment by 2 since it has key,val
-      for i in range(0, len(fields), 2): 
-        field = fields[i]
-        value = fields[i+1]
-        entry_data[field] = value
-      
-      # insert entry into stream
-      stream_obj["entries"][final_id] = entry_data
-      # return the entry ID as bulk string
-      print(stream_obj)
-      return f"${len(final_id)}\r\n{final_id}\r\n".encode()
-    except Exception as e:
-      print(f"[Redis Store XADD] Error {e}")
-      return b"-ERR Error with XADD"
-  
-  def xrange(self, stream_key, start_id, end_id): 
-    if stream_key not in self.data or self.data[stream_key]["type"] != "stream":
-      return b"$-1\r\n"  # stream does not exist
-    
-    entries = self.data[stream_key]["entries"]
-    result = []
-    
-    # normalize start and end
-    if "-" not in start_id:
-      start_id += "-0"
-     
-    if end_id == "+": 
-      end_id = "9999999999999-999999"
-    elif "-" not in end_id: 
-      end_id += "-999999"
-    
-    for entry_id, fields in entries.items(): 
-      if start_id <= entry_id <= end_id: 
-        field_list = []
-        for k, v in fields.items(): 
-          field_list.append(k)
-          field_list.append(v)
-        
-        result.append([entry_id, field_list])
-    
-    return self._encode_resp_list_of_lists(result)
-    
-      
-  
+          # 0-0 is not a valid id, so the first sequence for ms 0 is 1
+          seq_part = 1 if ms_part == 0 else 0
+      else:
+        ms_part, seq_part = parse_id(entry_id)
+        if ms_part == 0 and seq_part == 0:
+          return b"-ERR The ID specified in XADD must be greater than 0-0\r\n"
+    except StreamIdError as e:
+      return f"-ERR {e}\r\n".encode()
+
+    # validate: the new id must be strictly greater than the last entry
+    if stream and (ms_part, seq_part) <= (last_ms, last_seq):
+      return b"-ERR The ID specified in XADD is equal or smaller than the target stream top item\r\n"
+
+    # the stream is only created once the id is known to be valid
+    if stream is None:
+      stream = Stream()
+      self._insert(stream_key, RedisObject(STREAM, stream))
+    self._before_write(stream_key)
+    stream.append(ms_part, seq_part, list(fields))
+    with self.index_lock:
+      self.used_memory += stream_entry_size(fields)
+    self.blocking.signal(stream_key)
+
+    # return the entry ID as bulk string
+    final_id = format_id(ms_part, seq_part)
+    return b"$%d\r\n%s\r\n" % (len(final_id), final_id)
+
+  def stream_last_id(self, stream_key):
+    # what "$" means for XREAD: the last id at the time of the call
+    stream = self._stream_for_read(stream_key)
+    return format_id(*stream.last_id()) if stream is not None else b"0-0"
+
+  def _stream_for_read(self, stream_key):
+    entry = self._lookup(stream_key)
+    if entry is None or entry.type != STREAM:
+      return None
+    return entry.value
+
+  def xrange(self, stream_key, start_id, end_id, count=None):
+    entry = self._lookup(stream_key)
+    if entry is not None and entry.type != STREAM:
+      return WRONGTYPE_ERROR
+
+    # normalize start and end, "(" makes a bound exclusive
+    try:
+      if start_id == b"-":
+        start = (0, 0)
+      elif start_id.startswith(b"("):
+        start = next_id(parse_id(start_id[1:], 0))
+      else:
+        start = parse_id(start_id, 0)
+
+      if end_id == b"+":
+        end = (MAX_ID_PART, MAX_ID_PART)
+      elif end_id.startswith(b"("):
+        end = previous_id(parse_id(end_id[1:], MAX_ID_PART))
+      else:
+        end = parse_id(end_id, MAX_ID_PART)
+    except StreamIdError as e:
+      return f"-ERR {e}\r\n".encode()
+
+    if entry is None or start is None or end is None or count == 0:
+      return EMPTY_ARRAY
+    started = time.perf_counter()
+    result = entry.value.range(start, end, count)
+    reply = self._encode_resp_list_of_lists(result)
+    self.latency.add_sample_since("xrange-reply", started)
+    return reply
+
   def replication_info(self):
+    # lines for the replication section of INFO
     lines = [
         f"role:{self.role}",
-        f"master_repl_offset:{self.master_repl_offset}",
+        f"master_repl_offset:{self.master_repl_offset if self.role == 'master' else self.repl_offset}",
         f"master_replid:{self.master_repl_id}",
     ]
-    payload = "\r\n".join(lines)  # do NOT add a final \r\n manually
-    full_payload = f"${len(payload)}\r\n{payload}\r\n"
-    return full_payload.encode()
+    if self.role == "master":
+      backlog = self.repl_backlog
+      lines += [
+          f"connected_slaves:{len(self.replica_sockets)}",
+          "repl_backlog_active:1",
+          f"repl_backlog_size:{backlog.size}",
+          f"repl_backlog_first_byte_offset:{backlog.first_byte_offset()}",
+          f"repl_backlog_histlen:{backlog.histlen}",
+      ]
+    else:
+      lines.append(f"slave_repl_offset:{self.repl_offset}")
+    return lines
   
-  def xread(self, stream_keys, last_ids): 
-    # if stream_key not in self.data or self.data[stream_key]["type"] != "stream": 
-    #   return b"$-1\r\n"
-    
-    # entries = self.data[stream_key]["entries"]
-    # result = []
-    # found = False
-    # for entry_id, fields in entries.items(): 
-    #   if not found: 
-    #     if entry_id > last_id: 
-    #       found = True
-    #     else: 
-    #       continue
-      
-    #   if found: 
-    #     field_list = []
-    #     for k, v in fields.items(): 
-    #       field_list.append(k)
-    #       field_list.append(v)
-    #     result.append([entry_id, field_list])
-    
-    # outer = [[stream_key, result]]
-    # return self._encode_xread_response(outer)
-    result = []
-    
-    for stream_key, last_id in zip(stream_keys, last_ids): 
-      if stream_key not in self.data or self.data[stream_key]["type"] != "stream":
-            continue
-
-      entries = self.data[stream_key]["entries"]
-      matched_entries = []
-
-      for entry_id, fields in entries.items():
-          if entry_id > last_id:
-              field_list = []
-              for k, v in fields.items():
-                  field_list.append(k)
-                  field_list.append(v)
-              matched_entries.append([entry_id, field_list])
+  def xread(self, stream_keys, last_ids, count=None):
+    # ids are validated up front so a bad one doesn't produce a partial reply
+    positions = []
+    try:
+      for stream_key, last_id in zip(stream_keys, last_ids):
+        if last_id == b"$":
+          # "$" means entries added from now on, a non blocking read has none
+          positions.append(None)
+        else:
+          positions.append(parse_id(last_id, 0))
+    except StreamIdError as e:
+      return f"-ERR {e}\r\n".encode()
 
+    result = []
+    for stream_key, last in zip(stream_keys, positions):
+      stream = self._stream_for_read(stream_key)
+      if stream is None or last is None:
+        continue
+      matched_entries = stream.after(last, count)
       if matched_entries:
-          result.append([stream_key, matched_entries])
+        result.append([stream_key, matched_entries])
 
     if not result:
-      return b"$-1\r\n"
+      return NULL_BULK
 
     return self._encode_xread_response(result)
-      
-    
+
   def _encode_resp_list(self, items):
-    resp = f"*{len(items)}\r\n"
+    parts = [b"*%d\r\n" % len(items)]
     for item in items:
-      resp += f"${len(item)}\r\n{item}\r\n"
-    return resp.encode()
-  
-  def _encode_resp_list_of_lists(self, data): 
-    # data looks like this: [[entry_id, [key1, val1. key2, val2]]]
-    # parsed accordingly
-    resp = f"*{len(data)}\r\n"
-    for entry_id, fields in data: 
-      resp += "*2\r\n"
-      resp += f"${len(entry_id)}\r\n{entry_id}\r\n"
-      resp += f"*{len(fields)}\r\n"
+      parts.append(b"$%d\r\n%s\r\n" % (len(item), item))
+    return b"".join(parts)
+
+  def _encode_entries(self, parts, entries):
+    # [[entry_id, [key1, val1, key2, val2]], ...] appended to parts. ids and
+    # fields are bytes, every piece goes into one join at the end
+    parts.append(b"*%d\r\n" % len(entries))
+    for entry_id, fields in entries:
+      parts.append(b"*2\r\n$%d\r\n%s\r\n*%d\r\n" % (len(entry_id), entry_id, len(fields)))
       for val in fields:
-          resp += f"${len(val)}\r\n{val}\r\n"
-    
-    return resp.encode()
-  
-  def _encode_xread_response(self, data): 
+        parts.append(b"$%d\r\n%s\r\n" % (len(val), val))
+
+  def _encode_resp_list_of_lists(self, data):
+    # data looks like this: [[entry_id, [key1, val1. key2, val2]]]
+    parts = []
+    self._encode_entries(parts, data)
+    return b"".join(parts)
+
+  def _encode_xread_response(self, data):
     # Format: [[stream_key, [[entry_id, [k1, v1, k2, v2]], ...]]]
-    resp = f"*{len(data)}\r\n"
+    parts = [b"*%d\r\n" % len(data)]
     for stream_key, entries in data:
-        resp += "*2\r\n"
-        resp += f"${len(stream_key)}\r\n{stream_key}\r\n"
-        resp += f"*{len(entries)}\r\n"
-        for entry_id, field_values in entries:
-            resp += "*2\r\n"
-            resp += f"${len(entry_id)}\r\n{entry_id}\r\n"
-            resp += f"*{len(field_values)}\r\n"
-            for val in field_values:
-                resp += f"${len(val)}\r\n{val}\r\n"
-    return resp.encode()
-  
+      parts.append(b"*2\r\n$%d\r\n%s\r\n" % (len(stream_key), stream_key))
+      self._encode_entries(parts, entries)
+    return b"".join(parts)
+
   def _curr_time_ms(self):
     return int(time.time() * 1000)
\ No newline at end of file
@@ -0,0 +1,342 @@
+import mmap
+import os
+import socket
+import time
+from app import log
+from app.config import Config, parse_output_buffer_limit
+from app.persistence import rdb_file_path, rdb_save_background
+from app.rdb_loader import load_keys_from_rdb
+from app.redis_store import RedisStore
+from app.aof import ReplayClient
+from app.rdb_utils import consume_psync_response
+from app.resp import RespParser, encode_command, to_text
+
+# seconds a replica waits before reconnecting to its master
+REPLICA_RECONNECT_DELAY = 1
+
+class WaitingReplica: 
+    # a replica between PSYNC and the end of its full resync. job is the BGSAVE
+    # whose snapshot it gets (None until one can be used), writes propagated
+    # after that snapshot was taken are buffered and follow the rdb
+    def __init__(self, conn): 
+        self.conn = conn
+        self.job = None
+        self.buffer = bytearray()
+
+def setup_replica_connection(conn, config: Config): 
+    # replica links get the replica output buffer limits, and in threaded mode
+    # a writer thread so propagation only ever queues
+    conn.set_output_limits(*parse_output_buffer_limit(config.get_value("replica-output-buffer-limit")))
+    if conn.loop is None: 
+        conn.start_async_writer()
+
+def full_resync(client, store: RedisStore, config: Config): 
+    # the replica is answered with +FULLRESYNC once a snapshot for it is under
+    # way. several replicas syncing at the same time share one BGSAVE
+    with store.repl_lock: 
+        store.waiting_replicas.append(WaitingReplica(client))
+    start_replica_syncs(store, config)
+
+def _attach(store: RedisStore, waiting: WaitingReplica, job): 
+    # called with repl_lock held. the snapshot is usable when the writes made
+    # since it was taken are still in the backlog
+    offset = job.repl_offset
+    if offset is None or not store.repl_backlog.covers(offset + 1): 
+        return False
+    waiting.conn.send(f"+FULLRESYNC {store.master_repl_id} {offset}\r\n".encode())
+    waiting.buffer = bytearray(store.repl_backlog.read_from(offset + 1))
+    waiting.job = job
+    return True
+
+def start_replica_syncs(store: RedisStore, config: Config): 
+    if not any(waiting.job is None for waiting in store.waiting_replicas): 
+        return
+    job = store.child_job
+    if job is None: 
+        if not rdb_save_background(store, config): 
+            return
+        job = store.child_job
+    elif job.kind != "save": 
+        # an aof rewrite is running, the sync starts once it is done
+        return
+    with store.repl_lock: 
+        for waiting in store.waiting_replicas: 
+            if waiting.job is None and not waiting.conn.closed: 
+                try: 
+                    if _attach(store, waiting, job): 
+                        print(f"[Master] Full resync of a replica from the BGSAVE at offset {job.repl_offset}")
+                except ConnectionError: 
+                    pass
+
+def _deliver(store: RedisStore, waiting: WaitingReplica, snapshot): 
+    # called with repl_lock held: the rdb, then the writes made since the
+    # snapshot, then the replica goes online and gets writes as they happen
+    conn = waiting.conn
+    conn.send(f"${len(snapshot)}\r\n".encode())
+    conn.send_payload(snapshot)
+    conn.send(bytes(waiting.buffer))
+    store.replica_sockets.append(conn)
+
+def check_replica_syncs(store: RedisStore, config: Config): 
+    # runs from the server cron after finished background jobs were reaped
+    if not store.waiting_replicas: 
+        return
+    finished = [waiting for waiting in store.waiting_replicas if waiting.job is not None and waiting.job.done]
+    if finished: 
+        snapshot = None
+        if any(waiting.job.ok for waiting in finished): 
+            # mapped rather than read, the pages go from the page cache to the
+            # sockets. the mapping outlives a later save replacing the file
+            with open(rdb_file_path(config), "rb") as f: 
+                snapshot = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        with store.repl_lock: 
+            for waiting in finished: 
+                store.waiting_replicas.remove(waiting)
+                try: 
+                    if not waiting.job.ok: 
+                        raise ConnectionError("the BGSAVE for the full resync failed")
+                    start = time.perf_counter()
+                    _deliver(store, waiting, snapshot)
+                    store.latency.add_sample_since("full-sync", start)
+                    print(f"[Master] Sent a {len(snapshot)} bytes RDB and {len(waiting.buffer)} buffered bytes to a replica")
+                except ConnectionError as e: 
+                    print(f"[Master] Full resync of a replica failed: {e}")
+                    waiting.conn.drop()
+    with store.repl_lock: 
+        store.waiting_replicas = [
+            waiting for waiting in store.waiting_replicas
+            if not waiting.conn.closed and not waiting.conn.close_after_reply
+        ]
+    start_replica_syncs(store, config)
+
+def record_replica_ack(conn, offset, store: RedisStore): 
+    store.replica_ack_offsets[conn] = offset
+    store.ack_waiters.signal("ack")
+
+def count_acked_replicas(store: RedisStore, offset): 
+    acks = store.replica_ack_offsets
+    return sum(1 for s in store.replica_sockets if acks.get(s, 0) >= offset)
+
+def send_getack_if_requested(store: RedisStore): 
+    # GETACK travels in the replication stream like any write, so the offsets the
+    # replicas report stay comparable with master_repl_offset. however many
+    # clients asked, one goes out per call
+    if not store.getack_requested: 
+        return
+    store.getack_requested = False
+    if store.replica_sockets: 
+        propagate_commands_to_replicas(["REPLCONF", "GETACK", "*"], store)
+
+def propagate_commands_to_replicas(args, store: RedisStore):
+    # if it is not the master server, do not run any logic and return
+    if store.role != "master": 
+        return
+    
+    data = encode_command(args)
+    if log.level <= log.DEBUG:
+        log.debug("[Master] Printing resp:", data)
+    with store.repl_lock:
+        # the backlog advances the replication offset even with no replica
+        # connected, a replica that comes back later picks up from there
+        store.repl_backlog.feed(data)
+        store.master_repl_offset = store.repl_backlog.offset
+        for waiting in store.waiting_replicas: 
+            if waiting.job is not None and not waiting.conn.close_after_reply: 
+                waiting.buffer += data
+                limit = waiting.conn.output_limit
+                if limit and len(waiting.buffer) > limit: 
+                    print(f"[Master] Writes buffered for a syncing replica exceed {limit} bytes, dropping it")
+                    waiting.conn.drop()
+        # to remove non-active sockets
+        disconnected = []
+        for s in store.replica_sockets: 
+            if s.close_after_reply: 
+                # dropped for lagging past its output buffer limits
+                disconnected.append(s)
+                continue
+            try: 
+                s.sendall(data)
+            except Exception as e: 
+                print(f"[Master] Failed to send to replica {e}")
+                disconnected.append(s)
+        for s in disconnected:
+            store.replica_sockets.remove(s)
+            store.replica_ack_offsets.pop(s, None)
+
+def propagate_write(args, store: RedisStore):
+    # every write that changed the dataset goes to the append only file and to
+    # the replicas, in the same RESP form. nothing is propagated while the log
+    # itself is being replayed
+    if store.loading:
+        return
+    if store.aof is not None:
+        store.aof.feed(args)
+    propagate_commands_to_replicas(args, store)
+
+def propagate_expired_keys(store: RedisStore):
+    # keys the master expired (lazily or in the active cycle) are deleted on the
+    # replicas with an explicit DEL, replicas never expire keys on their own clock
+    if not store.expired_keys:
+        return
+    expired = store.expired_keys
+    store.expired_keys = []
+    for key in expired:
+        propagate_write(["DEL", key], store)
+
+# replica side: apply the master's stream. commands run through the command
+# table like any client's, every complete command of a read is applied in one go
+# and repl_offset is advanced once per read
+REPLICA_READ_SIZE = 64 * 1024
+
+def replicate_command_listener(store: RedisStore, executor, run=None): 
+    # run(fn, *args) runs fn where the dataset may change and waits for it: on
+    # the event loop thread in event loop mode. None in threaded mode, where the
+    # executor takes the locks of every command itself
+    repl_sock = store.replica_socket
+    parser = RespParser()
+    master = ReplayClient()
+    with store.repl_offset_lock: 
+        base_offset = store.repl_offset
+
+    def apply(batch): 
+        for args in batch: 
+            try: 
+                executor(master, args)
+            except Exception as e: 
+                print(f"[Replica] Error applying {to_text(args[0])} from master: {e}")
+
+    def apply_batch(batch): 
+        if not batch: 
+            return
+        if run is not None: 
+            run(apply, batch)
+        else: 
+            apply(batch)
+
+    while True: 
+        chunk = repl_sock.recv(REPLICA_READ_SIZE)
+        if not chunk: 
+            break
+        parser.feed(chunk)
+        applied = parser.processed
+        batch = []
+        for args, end in parser.parse(with_offsets=True): 
+            command = args[0].upper()
+            if command == b"REPLCONF" and len(args) >= 2 and args[1].upper() == b"GETACK": 
+                # the ack covers everything before the GETACK itself
+                apply_batch(batch)
+                batch = []
+                with store.repl_offset_lock: 
+                    store.repl_offset = base_offset + applied
+                repl_sock.sendall(encode_command(["REPLCONF", "ACK", str(base_offset + applied)]))
+            elif command != b"PING": 
+                batch.append(args)
+            applied = end
+        apply_batch(batch)
+        with store.repl_offset_lock: 
+            store.repl_offset = base_offset + parser.processed
+        if parser.error is not None: 
+            print(f"[Replica] Protocol error in the master's stream: {parser.error}")
+            break
+
+def replicate_handshake(store: RedisStore, config: Config, executor, run=None): 
+    # runs for the replica's lifetime: sync with the master and apply its stream,
+    # and when the link drops reconnect and ask to continue where it stopped.
+    # executor(client, args) runs a command from the master, see
+    # replicate_command_listener for run
+    while True: 
+        try: 
+            sync_with_master(store, config, run)
+            replicate_command_listener(store, executor, run)
+        except Exception as e: 
+            print(f"[Replica] Connection to master failed: {e}")
+        if store.replica_socket is not None: 
+            store.replica_socket.close()
+            store.replica_socket = None
+        print(f"[Replica] Link with master lost, reconnecting in {REPLICA_RECONNECT_DELAY}s")
+        time.sleep(REPLICA_RECONNECT_DELAY)
+
+def sync_with_master(store: RedisStore, config: Config, run=None): 
+    s = socket.create_connection((store.master_host, store.master_port))
+    # store.replica_socket is only present for replica RedisStores
+    store.replica_socket = s
+    
+    # step 1: Send ping
+    s.sendall(b"*1\r\n$4\r\nPING\r\n")
+    response = s.recv(1024)
+    print(f"[Replica] Received from master: {response}")
+    
+    # step 2: send replconf listening-port
+    port_str = str(store.replica_port)
+    replconf_1 = (
+        "*3\r\n"
+        "$8\r\nREPLCONF\r\n"
+        "$14\r\nlistening-port\r\n"
+        f"${len(port_str)}\r\n{port_str}\r\n"
+    )
+    s.sendall(replconf_1.encode())
+    repl_conf1_res = s.recv(1024)
+    print(f"[Replica] Received replconf1 response: {repl_conf1_res}")
+    
+    # step 3: send replconf with capa and psync2
+    replconf_2 = (
+        "*3\r\n"
+        "$8\r\nREPLCONF\r\n"
+        "$4\r\ncapa\r\n"
+        "$6\r\npsync2\r\n"
+    )
+    s.sendall(replconf_2.encode())
+    repl_conf2_res = s.recv(1024)
+    print(f"[Replica] Received replconf2 response: {repl_conf2_res}")
+    
+    # step 4: send psync, "? -1" the first time. after a disconnect ask for the
+    # byte after the last one applied, the master continues from its backlog
+    # if it still has it
+    if store.master_repl_id is None: 
+        psync_command = encode_command(["PSYNC", "?", "-1"])
+    else: 
+        with store.repl_offset_lock: 
+            next_offset = store.repl_offset + 1
+        psync_command = encode_command(["PSYNC", store.master_repl_id, str(next_offset)])
+    s.sendall(psync_command)
+    # the rdb goes to a temp file next to our own dump, which it then replaces
+    rdb_path = rdb_file_path(config)
+    os.makedirs(os.path.dirname(os.path.abspath(rdb_path)), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(os.path.abspath(rdb_path)), f"temp-{os.getpid()}.sync.rdb")
+    try: 
+        with open(tmp_path, "wb") as f: 
+            psync_response, rdb_len = consume_psync_response(s, f)
+        parts = psync_response.decode().split()
+        if rdb_len is None: 
+            print(f"[Replica] Partial resync accepted, continuing from offset {store.repl_offset}")
+        else: 
+            # +FULLRESYNC <replid> <offset>: the dataset is replaced by the snapshot
+            start = time.perf_counter()
+            parsed = load_keys_from_rdb(tmp_path)
+
+            def replace_dataset():
+                store.flushall()
+                store.load_keys(parsed)
+
+            if run is not None:
+                run(replace_dataset)
+            elif store.locks is not None:
+                # threaded mode, the clients' threads are reading the dataset
+                with store.locks.exclusive():
+                    replace_dataset()
+            else:
+                replace_dataset()
+            store.latency.add_sample_since("rdb-load", start)
+            os.replace(tmp_path, rdb_path)
+            store.master_repl_id = parts[1]
+            with store.repl_offset_lock: 
+                store.repl_offset = int(parts[2])
+            if store.aof is not None: 
+                # the log describes the old dataset, rewrite it from the new one
+                store.aof_rewrite_scheduled = True
+            print(f"[Replica] Loaded {len(parsed)} keys from the master's RDB, socket is now clean")
+    finally: 
+        if os.path.exists(tmp_path): 
+            os.unlink(tmp_path)
+    
+    print("[Replica] Completed REPLCONF handshake")
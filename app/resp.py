@@ -0,0 +1,242 @@
+CRLF = b"\r\n"
+
+# shared replies, built once instead of per command
+OK = b"+OK\r\n"
+PONG = b"+PONG\r\n"
+QUEUED = b"+QUEUED\r\n"
+NULL_BULK = b"$-1\r\n"
+NULL_ARRAY = b"*-1\r\n"
+EMPTY_ARRAY = b"*0\r\n"
+
+SHARED_INTEGERS = 10000
+_INTEGER_REPLIES = [f":{i}\r\n".encode() for i in range(SHARED_INTEGERS)]
+
+# same limits redis uses to protect itself from garbage on the wire
+MAX_INLINE_SIZE = 64 * 1024
+MAX_MULTIBULK_LEN = 1024 * 1024
+MAX_BULK_LEN = 512 * 1024 * 1024
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def encode_integer(value: int):
+    if 0 <= value < SHARED_INTEGERS:
+        return _INTEGER_REPLIES[value]
+    return f":{value}\r\n".encode()
+
+
+def encode_simple(value: str):
+    return f"+{value}\r\n".encode()
+
+
+def encode_error(message: str):
+    return f"-{message}\r\n".encode()
+
+
+def encode_bulk(value):
+    # keys and values are bytes and go out as they are, str is for the text the
+    # server makes up itself (INFO, CONFIG, ids...)
+    data = value if type(value) is bytes else value.encode()
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+def encode_array(items):
+    # array of bulk strings, bytes or str like encode_bulk
+    parts = [b"*%d\r\n" % len(items)]
+    for item in items:
+        data = item if type(item) is bytes else item.encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+def to_text(value):
+    # an argument as str, for error messages and settings. arguments are bytes
+    # and may not be utf-8, what doesn't decode is replaced
+    return value.decode("utf-8", "replace") if type(value) is bytes else value
+
+
+def encode_command(args):
+    # a command as a client would send it, used for propagation to replicas
+    return encode_array(args)
+
+
+def reply_end(buf, pos):
+    # end of the RESP reply starting at pos, -1 while it is incomplete. used on
+    # replies from other servers (shards, MIGRATE targets)
+    end = buf.find(b"\r\n", pos)
+    if end == -1:
+        return -1
+    kind = buf[pos]
+    if kind == 0x24: # '$'
+        size = int(buf[pos + 1:end])
+        if size < 0:
+            return end + 2
+        end += 2 + size + 2
+        return end if end <= len(buf) else -1
+    if kind == 0x2A: # '*'
+        count = int(buf[pos + 1:end])
+        pos = end + 2
+        for _ in range(max(count, 0)):
+            pos = reply_end(buf, pos)
+            if pos == -1:
+                return -1
+        return pos
+    return end + 2
+
+
+def decode_reply(data, pos=0):
+    # (value, end) of a RESP reply: bytes for bulk strings, str for simple
+    # strings, int, list, None for nil and an Exception for errors
+    end = data.find(b"\r\n", pos)
+    kind, line = data[pos], data[pos + 1:end]
+    if kind == 0x24: # '$'
+        size = int(line)
+        if size < 0:
+            return None, end + 2
+        return bytes(data[end + 2:end + 2 + size]), end + 4 + size
+    if kind == 0x2A: # '*'
+        count = int(line)
+        if count < 0:
+            return None, end + 2
+        items, pos = [], end + 2
+        for _ in range(count):
+            item, pos = decode_reply(data, pos)
+            items.append(item)
+        return items, pos
+    if kind == 0x3A: # ':'
+        return int(line), end + 2
+    if kind == 0x2D: # '-'
+        return Exception(line.decode()), end + 2
+    return line.decode(), end + 2
+
+
+class RespParser:
+    # incremental parser for client requests, one instance per connection.
+    # bytes are appended to a single bytearray with feed() and parse() pulls every
+    # complete command out of it. a command that is only partially received keeps
+    # its progress (args read so far, pending bulk length) so the next read
+    # resumes where we stopped instead of rescanning the frame from the start.
+    # a malformed request stops parsing and is reported through self.error, the
+    # commands in front of it are still returned
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pos = 0
+        self.error = None
+        # stream offset just past the last complete command, and how many bytes
+        # were dropped from the front of buffer so far
+        self.processed = 0
+        self._discarded = 0
+        self._args = None
+        self._remaining = 0
+        self._bulk_len = -1
+
+    def feed(self, data: bytes):
+        self.buffer += data
+
+    def pending_bytes(self):
+        return len(self.buffer) - self.pos
+
+    def parse(self, with_offsets=False):
+        # with_offsets yields (args, stream offset just past the command) pairs
+        commands = []
+        if self.error is not None:
+            return commands
+        view = memoryview(self.buffer)
+        try:
+            while True:
+                args = self._parse_one(view)
+                if args is None:
+                    break
+                self.processed = self._discarded + self.pos
+                if args:
+                    commands.append((args, self.processed) if with_offsets else args)
+        except ProtocolError as e:
+            self.error = e
+        finally:
+            # the view must be released before the bytearray can be resized
+            view.release()
+            if self.pos:
+                self._discarded += self.pos
+                del self.buffer[:self.pos]
+                self.pos = 0
+        return commands
+
+    def _parse_one(self, view):
+        buf = self.buffer
+        pos = self.pos
+        size = len(buf)
+
+        if self._args is None:
+            if pos >= size:
+                return None
+            if buf[pos] != 0x2A: # '*'
+                return self._parse_inline()
+
+            end = buf.find(CRLF, pos)
+            if end == -1:
+                if size - pos > MAX_INLINE_SIZE:
+                    raise ProtocolError("too big mbulk count string")
+                return None
+            try:
+                count = int(buf[pos + 1:end])
+            except ValueError:
+                raise ProtocolError("invalid multibulk length")
+            if count > MAX_MULTIBULK_LEN:
+                raise ProtocolError("invalid multibulk length")
+            pos = end + 2
+            if count <= 0:
+                # "*0" and "*-1" are valid and simply ignored
+                self.pos = pos
+                return []
+            self._args = []
+            self._remaining = count
+
+        args = self._args
+        while self._remaining:
+            if self._bulk_len < 0:
+                if pos >= size:
+                    break
+                if buf[pos] != 0x24: # '$'
+                    raise ProtocolError(f"expected '$', got '{chr(buf[pos])}'")
+                end = buf.find(CRLF, pos)
+                if end == -1:
+                    if size - pos > MAX_INLINE_SIZE:
+                        raise ProtocolError("too big bulk count string")
+                    break
+                try:
+                    bulk_len = int(buf[pos + 1:end])
+                except ValueError:
+                    raise ProtocolError("invalid bulk length")
+                if bulk_len < 0 or bulk_len > MAX_BULK_LEN:
+                    raise ProtocolError("invalid bulk length")
+                self._bulk_len = bulk_len
+                pos = end + 2
+
+            bulk_len = self._bulk_len
+            if pos + bulk_len + 2 > size:
+                break
+            # arguments stay bytes from the socket to the store and back, one
+            # copy out of the buffer and no decoding
+            args.append(bytes(view[pos:pos + bulk_len]))
+            pos += bulk_len + 2
+            self._bulk_len = -1
+            self._remaining -= 1
+
+        self.pos = pos
+        if self._remaining:
+            return None
+        self._args = None
+        return args
+
+    def _parse_inline(self):
+        buf = self.buffer
+        end = buf.find(b"\n", self.pos)
+        if end == -1:
+            if len(buf) - self.pos > MAX_INLINE_SIZE:
+                raise ProtocolError("too big inline request")
+            return None
+        line = bytes(buf[self.pos:end])
+        self.pos = end + 1
+        return line.split()
@@ -0,0 +1,413 @@
+import os
+import selectors
+import signal
+import socket
+import sys
+import tempfile
+import traceback
+from collections import deque
+
+from app.aof import ReplayClient
+from app.blocking import BlockingRegistry
+from app.commands import COMMAND_TABLE, TRANSACTION_COMMANDS, command_keys
+from app.resp import NULL_BULK, decode_reply, encode_bulk, encode_command, encode_error, encode_integer, reply_end
+from app.slots import SLOT_COUNT, key_hash_slot
+
+# --shards N: N worker processes, each a full event loop server owning a range of
+# the hash slots in its own RedisStore. every worker accepts clients on the same
+# port (SO_REUSEPORT lets the kernel spread connections), runs the commands for
+# its own keys and forwards the others over a unix socket to the owning worker.
+# commands on keys of several workers are scattered and their replies gathered
+
+LINK_READ_SIZE = 64 * 1024
+CROSSSLOT_ERROR = b"-CROSSSLOT Keys in request don't hash to the same slot\r\n"
+
+
+def shard_socket_dir(port):
+    return os.path.join(tempfile.gettempdir(), f"redis-shards-{port}")
+
+
+def shard_socket_path(port, shard_id):
+    return os.path.join(shard_socket_dir(port), f"shard-{shard_id}.sock")
+
+
+def shard_of(key, nshards):
+    # contiguous slot ranges, the same split redis-cli uses for a fresh cluster
+    return key_hash_slot(key) * nshards // SLOT_COUNT
+
+
+def encode_bulk_list(items):
+    # an array of bulk strings (bytes) and nils
+    parts = [b"*%d\r\n" % len(items)]
+    for item in items:
+        parts.append(NULL_BULK if item is None else b"$%d\r\n%s\r\n" % (len(item), item))
+    return b"".join(parts)
+
+
+class ShardLink:
+    # a connection to another worker's unix socket, driven by the event loop.
+    # requests are written in order and their replies come back in the same
+    # order, each completes the callback queued with its request
+    def __init__(self, loop, path):
+        self.loop = loop
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.sock.setblocking(False)
+        self.out = bytearray()
+        self.inbuf = bytearray()
+        # (number of replies, callback(replies)) per request
+        self.pending = deque()
+        self.want_write = False
+        self.closed = False
+        loop.selector.register(self.sock, selectors.EVENT_READ, self._on_event)
+
+    def request(self, data, count, callback):
+        self.pending.append((count, callback))
+        self.out += data
+        self._write()
+
+    def _write(self):
+        try:
+            sent = self.sock.send(self.out)
+            del self.out[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            self._fail(e)
+            return
+        want_write = bool(self.out)
+        if want_write != self.want_write:
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if want_write else 0)
+            self.loop.selector.modify(self.sock, events, self._on_event)
+            self.want_write = want_write
+
+    def _on_event(self, sock, mask):
+        if mask & selectors.EVENT_WRITE:
+            self._write()
+        if mask & selectors.EVENT_READ and not self.closed:
+            self._read()
+
+    def _read(self):
+        try:
+            chunk = self.sock.recv(LINK_READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._fail(e)
+            return
+        if not chunk:
+            self._fail(ConnectionError("closed by the other shard"))
+            return
+        buf = self.inbuf
+        buf += chunk
+        pos = 0
+        while self.pending:
+            count, callback = self.pending[0]
+            replies, end = [], pos
+            for _ in range(count):
+                end = reply_end(buf, end)
+                if end == -1:
+                    break
+                replies.append(end)
+            if end == -1:
+                break
+            self.pending.popleft()
+            starts = [pos] + replies[:-1]
+            callback([bytes(buf[s:e]) for s, e in zip(starts, replies)])
+            pos = end
+        del buf[:pos]
+
+    def _fail(self, error):
+        print(f"[Shards] Link to another shard failed: {error}")
+        self.close()
+        error_reply = encode_error(f"ERR shard unavailable: {error}")
+        while self.pending:
+            count, callback = self.pending.popleft()
+            callback([error_reply] * count)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.loop.selector.unregister(self.sock)
+        except (KeyError, ValueError):
+            pass
+        self.sock.close()
+
+
+class CaptureClient(ReplayClient):
+    # runs a command locally and keeps its reply instead of sending it
+    def __init__(self):
+        super().__init__()
+        self.data = bytearray()
+
+    def send(self, data: bytes):
+        self.data += data
+
+
+class PendingReply:
+    # what a client forwarding a command waits for
+    __slots__ = ("reply",)
+
+    def __init__(self):
+        self.reply = None
+
+
+class ShardRouter:
+    # the executor of client connections in a shard worker
+    def __init__(self, loop, shard_id, nshards, port, local):
+        self.loop = loop
+        self.shard_id = shard_id
+        self.nshards = nshards
+        self.port = port
+        # local(conn, args) runs a command against this worker's store
+        self.local = local
+        # one shared link per shard, replies arrive in request order
+        self.links = {}
+        # clients waiting for a forwarded reply, keyed by their PendingReply
+        self.waiting = BlockingRegistry()
+
+    def _link(self, shard_id, dedicated=False):
+        link = None if dedicated else self.links.get(shard_id)
+        if link is None or link.closed:
+            link = ShardLink(self.loop, shard_socket_path(self.port, shard_id))
+            if not dedicated:
+                self.links[shard_id] = link
+        return link
+
+    def _run_local(self, args):
+        client = CaptureClient()
+        self.local(client, args)
+        return bytes(client.data)
+
+    def _wait(self, conn, pending: PendingReply):
+        # park the client like a blocking command until the reply is in. its
+        # pipelined commands stay queued, so replies keep their order
+        if pending.reply is not None:
+            conn.send(pending.reply)
+            return
+        conn.block(self.waiting, [pending], 0, lambda: pending.reply, None)
+
+    def _complete(self, pending: PendingReply, reply):
+        pending.reply = reply
+        self.waiting.signal(pending)
+
+    def _forward(self, conn, shard_id, commands, dedicated=False):
+        # commands go out back to back, the client gets the last reply
+        pending = PendingReply()
+        data = b"".join(encode_command(args) for args in commands)
+        try:
+            link = self._link(shard_id, dedicated)
+        except OSError as e:
+            conn.send(encode_error(f"ERR shard {shard_id} unavailable: {e}"))
+            return
+
+        def done(replies):
+            if dedicated:
+                link.close()
+            self._complete(pending, replies[-1])
+
+        link.request(data, len(commands), done)
+        self._wait(conn, pending)
+
+    def _gather(self, conn, requests, combine):
+        # requests: [(shard id, args)], combine(replies) builds the client reply
+        # from the replies in the same order. local requests run right away
+        pending = PendingReply()
+        replies = [None] * len(requests)
+        remaining = [len(requests)]
+
+        def collect(index, reply):
+            replies[index] = reply
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                self._complete(pending, combine(replies))
+
+        for index, (shard_id, args) in enumerate(requests):
+            if shard_id == self.shard_id:
+                collect(index, self._run_local(args))
+                continue
+            try:
+                link = self._link(shard_id)
+            except OSError as e:
+                collect(index, encode_error(f"ERR shard {shard_id} unavailable: {e}"))
+                continue
+            link.request(encode_command(args), 1, lambda result, index=index: collect(index, result[0]))
+        self._wait(conn, pending)
+
+    def execute(self, conn, args):
+        cmd = COMMAND_TABLE.get(args[0].upper())
+        state = conn.client_state
+        if cmd is None or (cmd.arity > 0 and len(args) != cmd.arity) or len(args) < -cmd.arity:
+            # errors come from the command table
+            self.local(conn, args)
+            return
+        name = cmd.name
+        if state["in_exec"]:
+            self.local(conn, args)
+            return
+        if name == "EXEC" and state["multi"] and not state["exec_abort"]:
+            self._exec(conn, args)
+            return
+        if state["multi"] or name in TRANSACTION_COMMANDS:
+            # queued here, routed as a whole by EXEC
+            self.local(conn, args)
+            return
+        if name == "KEYS":
+            self._keys(conn, args)
+            return
+        if name == "SCAN":
+            self._scan(conn, args)
+            return
+
+        keys = command_keys(cmd, args)
+        if not keys:
+            self.local(conn, args)
+            return
+        owners = {shard_of(key, self.nshards) for key in keys}
+        if len(owners) == 1:
+            owner = owners.pop()
+            if owner == self.shard_id:
+                self.local(conn, args)
+            else:
+                blocking = name == "XREAD" and any(arg.upper() == b"BLOCK" for arg in args)
+                self._forward(conn, owner, [args], dedicated=blocking)
+            return
+        if name in ("DEL", "MGET"):
+            self._multi_key(conn, name, keys)
+            return
+        conn.send(CROSSSLOT_ERROR)
+
+    def _exec(self, conn, args):
+        # the whole transaction runs on the one worker owning all of its keys
+        state = conn.client_state
+        queued = [queued_args for _, queued_args in state["queued_commands"]]
+        owners = set()
+        for cmd, queued_args in state["queued_commands"]:
+            owners.update(shard_of(key, self.nshards) for key in command_keys(cmd, queued_args))
+        if owners <= {self.shard_id}:
+            self.local(conn, args)
+            return
+        state["multi"] = False
+        state["queued_commands"] = []
+        if len(owners) > 1:
+            conn.send(CROSSSLOT_ERROR)
+            return
+        self._forward(conn, owners.pop(), [["MULTI"]] + queued + [["EXEC"]])
+
+    def _multi_key(self, conn, name, keys):
+        by_shard = {}
+        for key in keys:
+            by_shard.setdefault(shard_of(key, self.nshards), []).append(key)
+        requests = [(shard_id, [name.encode()] + shard_keys) for shard_id, shard_keys in by_shard.items()]
+
+        def combine(replies):
+            decoded = [decode_reply(reply)[0] for reply in replies]
+            for value in decoded:
+                if isinstance(value, Exception):
+                    return encode_error(str(value))
+            if name == "DEL":
+                return encode_integer(sum(decoded))
+            # MGET: values back in the order the keys were asked for
+            values = {}
+            for (_, shard_args), shard_values in zip(requests, decoded):
+                values.update(zip(shard_args[1:], shard_values))
+            return encode_bulk_list([values[key] for key in keys])
+
+        self._gather(conn, requests, combine)
+
+    def _owned(self, keys, shard_id):
+        # a worker may hold keys it doesn't own (loaded from an old dump), only
+        # the owner's copy counts
+        return [key for key in keys if shard_of(key, self.nshards) == shard_id]
+
+    def _keys(self, conn, args):
+        requests = [(shard_id, args) for shard_id in range(self.nshards)]
+
+        def combine(replies):
+            keys = []
+            for shard_id, reply in enumerate(replies):
+                value = decode_reply(reply)[0]
+                if isinstance(value, Exception):
+                    return encode_error(str(value))
+                keys += self._owned(value, shard_id)
+            return encode_bulk_list(keys)
+
+        self._gather(conn, requests, combine)
+
+    def _scan(self, conn, args):
+        # the cursor walks the workers one after the other: its low part is the
+        # worker, the rest that worker's own cursor
+        try:
+            cursor = int(args[1])
+        except ValueError:
+            cursor = -1
+        if cursor < 0:
+            conn.send(b"-ERR invalid cursor\r\n")
+            return
+        shard_id, local_cursor = cursor % self.nshards, cursor // self.nshards
+
+        def combine(replies):
+            value = decode_reply(replies[0])[0]
+            if isinstance(value, Exception):
+                return encode_error(str(value))
+            next_local, keys = int(value[0]), self._owned(value[1], shard_id)
+            if next_local:
+                next_cursor = next_local * self.nshards + shard_id
+            elif shard_id + 1 < self.nshards:
+                next_cursor = shard_id + 1
+            else:
+                next_cursor = 0
+            return b"*2\r\n" + encode_bulk(b"%d" % next_cursor) + encode_bulk_list(keys)
+
+        self._gather(conn, [(shard_id, [b"SCAN", b"%d" % local_cursor] + args[2:])], combine)
+
+
+def run_shards(nshards, port, serve_shard):
+    # the launcher: fork one worker per shard and wait. a worker that exits takes
+    # the others down with it, SIGTERM/SIGINT are passed on to the workers
+    os.makedirs(shard_socket_dir(port), exist_ok=True)
+    # or the workers print whatever is still buffered again
+    sys.stdout.flush()
+    workers = {}
+    for shard_id in range(nshards):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                serve_shard(shard_id)
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            os._exit(code)
+        workers[pid] = shard_id
+    print(f"[Shards] Started {nshards} workers: {sorted(workers)}")
+
+    def stop(signum, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    pid, status = os.wait()
+    print(f"[Shards] Worker {workers.pop(pid)} exited with status {os.waitstatus_to_exitcode(status)}, stopping")
+    stop(signal.SIGTERM, None)
+
+
+def listen_for_shards(port, shard_id):
+    path = shard_socket_path(port, shard_id)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(128)
+    return sock
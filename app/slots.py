@@ -0,0 +1,36 @@
+# keys map to one of 16384 hash slots like in redis cluster: crc16 (xmodem) of
+# the key, or of the part between the first "{" and the next "}" when that part
+# is not empty, so "{user1}.name" and "{user1}.age" share a slot
+SLOT_COUNT = 16384
+
+
+def _make_table():
+  table = []
+  for i in range(256):
+    crc = i << 8
+    for _ in range(8):
+      crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+    table.append(crc)
+  return table
+
+
+CRC16_TABLE = _make_table()
+
+
+def crc16(data):
+  # CRC16("123456789") == 0x31c3
+  crc = 0
+  table = CRC16_TABLE
+  for b in data:
+    crc = ((crc << 8) & 0xFFFF) ^ table[((crc >> 8) ^ b) & 0xFF]
+  return crc
+
+
+def key_hash_slot(data):
+  # data is the key, bytes like every key in the store
+  start = data.find(b"{")
+  if start != -1:
+    end = data.find(b"}", start + 1)
+    if end > start + 1:
+      data = data[start + 1:end]
+  return crc16(data) & (SLOT_COUNT - 1)
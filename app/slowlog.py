@@ -0,0 +1,73 @@
+import itertools
+import time
+from collections import deque
+
+# like redis: at most this many arguments and this many bytes of each are kept,
+# the rest is summarized
+SLOWLOG_ENTRY_MAX_ARGC = 32
+SLOWLOG_ENTRY_MAX_STRING = 128
+
+
+def client_address(client):
+    # "ip:port" of a tcp client, "" for unix sockets, the aof and the master link
+    addr = getattr(client, "addr", None)
+    if isinstance(addr, tuple) and len(addr) >= 2:
+        return f"{addr[0]}:{addr[1]}"
+    return ""
+
+
+def trimmed_args(args):
+    kept = list(args[:SLOWLOG_ENTRY_MAX_ARGC])
+    if len(args) > SLOWLOG_ENTRY_MAX_ARGC:
+        kept[-1] = b"... (%d more arguments)" % (len(args) - SLOWLOG_ENTRY_MAX_ARGC + 1)
+    for i, arg in enumerate(kept):
+        if len(arg) > SLOWLOG_ENTRY_MAX_STRING:
+            kept[i] = b"%s... (%d more bytes)" % (arg[:SLOWLOG_ENTRY_MAX_STRING], len(arg) - SLOWLOG_ENTRY_MAX_STRING)
+    return kept
+
+
+class SlowLogEntry:
+    __slots__ = ("id", "time", "duration_us", "args", "client_addr")
+
+    def __init__(self, entry_id, duration_us, args, client_addr):
+        self.id = entry_id
+        self.time = int(time.time())
+        self.duration_us = duration_us
+        self.args = args
+        self.client_addr = client_addr
+
+
+class SlowLog:
+    # the commands that ran for longer than slowlog-log-slower-than, newest
+    # first. the deque drops the oldest entry once slowlog-max-len is reached
+    def __init__(self, slower_than_us=10000, max_len=128):
+        self.entries = deque(maxlen=max_len)
+        # next() on a count is atomic, threaded clients get distinct ids
+        self.ids = itertools.count()
+        self.threshold_ns = float("inf")
+        self.enabled = False
+        self.set_threshold(slower_than_us)
+
+    def set_threshold(self, slower_than_us):
+        # negative turns the log off, 0 logs every command
+        self.threshold_ns = float("inf") if slower_than_us < 0 else slower_than_us * 1000
+        self.enabled = slower_than_us >= 0
+
+    def configure(self, config):
+        self.set_threshold(config.get_value("slowlog-log-slower-than"))
+        max_len = max(0, config.get_value("slowlog-max-len"))
+        if max_len != self.entries.maxlen:
+            self.entries = deque(self.entries, maxlen=max_len)
+
+    def add(self, client, args, duration_ns):
+        entry = SlowLogEntry(next(self.ids), duration_ns // 1000, trimmed_args(args), client_address(client))
+        self.entries.appendleft(entry)
+
+    def get(self, count):
+        # the newest count entries, all of them for a negative count
+        if count < 0:
+            return list(self.entries)
+        return list(itertools.islice(self.entries, count))
+
+    def reset(self):
+        self.entries.clear()
@@ -0,0 +1,96 @@
+# ---- latency histograms ----
+#
+# a log bucketed histogram of durations in nanoseconds: below 16ns every value
+# has its own bucket, above that every power of two is split in 8 buckets, so a
+# percentile is off by at most 1/8 and recording is a bit_length and an add. the
+# whole range up to ~36 minutes fits in 312 counters
+
+SUB_BUCKET_BITS = 3
+MAX_EXPONENT = 37
+HISTOGRAM_SIZE = (MAX_EXPONENT + 2) << SUB_BUCKET_BITS
+
+# the percentiles INFO latencystats reports, like redis' default
+# latency-tracking-info-percentiles
+LATENCY_PERCENTILES = (50.0, 99.0, 99.9)
+
+
+def bucket_index(ns):
+    exponent = ns.bit_length() - SUB_BUCKET_BITS - 1
+    if exponent <= 0:
+        return ns
+    if exponent > MAX_EXPONENT:
+        return HISTOGRAM_SIZE - 1
+    return (exponent << SUB_BUCKET_BITS) + (ns >> exponent)
+
+
+def bucket_value(index):
+    # the middle of the values that land in bucket index
+    exponent = (index >> SUB_BUCKET_BITS) - 1
+    if exponent <= 0:
+        return index
+    low = (index - (exponent << SUB_BUCKET_BITS)) << exponent
+    return low + (1 << (exponent - 1))
+
+
+class LatencyHistogram:
+    __slots__ = ("counts", "total")
+
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_SIZE
+        self.total = 0
+
+    def record(self, ns):
+        self.counts[bucket_index(ns)] += 1
+        self.total += 1
+
+    def percentile(self, p):
+        # in nanoseconds, 0 with nothing recorded
+        if not self.total:
+            return 0
+        rank = max(1, -(-self.total * p // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return bucket_value(index)
+        return bucket_value(HISTOGRAM_SIZE - 1)
+
+    def reset(self):
+        self.counts = [0] * HISTOGRAM_SIZE
+        self.total = 0
+
+
+def format_percentile(p):
+    # 50.0 -> "p50", 99.9 -> "p99.9"
+    return f"p{p:g}"
+
+
+# ---- instantaneous metrics ----
+
+INSTANTANEOUS_SAMPLES = 16
+
+
+class InstantaneousMetric:
+    # a per second rate averaged over the last samples, like redis'
+    # trackInstantaneousMetric. the cron feeds it the running total
+    __slots__ = ("samples", "index", "last_value", "last_time")
+
+    def __init__(self):
+        self.samples = [0.0] * INSTANTANEOUS_SAMPLES
+        self.index = 0
+        self.last_value = None
+        self.last_time = 0.0
+
+    def track(self, value, now):
+        if self.last_value is not None and now > self.last_time:
+            self.samples[self.index] = (value - self.last_value) / (now - self.last_time)
+            self.index = (self.index + 1) % INSTANTANEOUS_SAMPLES
+        self.last_value = value
+        self.last_time = now
+
+    def value(self):
+        return int(sum(self.samples) / INSTANTANEOUS_SAMPLES)
+
+    def reset(self):
+        self.samples = [0.0] * INSTANTANEOUS_SAMPLES
+        self.index = 0
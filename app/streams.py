@@ -0,0 +1,132 @@
+from array import array
+
+MAX_ID_PART = (1 << 64) - 1
+
+
+class StreamIdError(ValueError):
+  pass
+
+
+def parse_id(text, missing_seq=0):
+  # b"ms-seq" or just b"ms" (seq then defaults to missing_seq), returns (ms, seq)
+  ms_raw, sep, seq_raw = text.partition(b"-")
+  try:
+    ms = int(ms_raw)
+    seq = int(seq_raw) if sep else missing_seq
+  except ValueError:
+    raise StreamIdError("Invalid stream ID specified as stream command argument")
+  if not (0 <= ms <= MAX_ID_PART and 0 <= seq <= MAX_ID_PART):
+    raise StreamIdError("Invalid stream ID specified as stream command argument")
+  return ms, seq
+
+
+def format_id(ms, seq):
+  return b"%d-%d" % (ms, seq)
+
+
+def next_id(stream_id):
+  # smallest id greater than stream_id, None if there is none
+  ms, seq = stream_id
+  if seq < MAX_ID_PART:
+    return ms, seq + 1
+  if ms < MAX_ID_PART:
+    return ms + 1, 0
+  return None
+
+
+def previous_id(stream_id):
+  # largest id smaller than stream_id, None if there is none
+  ms, seq = stream_id
+  if seq > 0:
+    return ms, seq - 1
+  if ms > 0:
+    return ms - 1, MAX_ID_PART
+  return None
+
+
+class Stream:
+  # entries are kept sorted by id in append-only arrays: ms_parts/seq_parts hold the
+  # two integer halves of every id (16 bytes per entry instead of a python str key)
+  # and fields holds the flat [field, value, ...] list of the entry at the same index.
+  # ids only ever grow, so lookups are a binary search and appends are O(1)
+  __slots__ = ("ms_parts", "seq_parts", "fields")
+
+  def __init__(self):
+    self.ms_parts = array("Q")
+    self.seq_parts = array("Q")
+    self.fields = []
+
+  def __len__(self):
+    return len(self.fields)
+
+  def copy(self):
+    # entries are never changed once appended, so copying the containers is enough
+    clone = Stream()
+    clone.ms_parts = array("Q", self.ms_parts)
+    clone.seq_parts = array("Q", self.seq_parts)
+    clone.fields = list(self.fields)
+    return clone
+
+  def last_id(self):
+    if not self.fields:
+      return 0, 0
+    return self.ms_parts[-1], self.seq_parts[-1]
+
+  def first_id(self):
+    if not self.fields:
+      return 0, 0
+    return self.ms_parts[0], self.seq_parts[0]
+
+  def append(self, ms, seq, fields):
+    # callers validate that (ms, seq) is greater than last_id()
+    self.ms_parts.append(ms)
+    self.seq_parts.append(seq)
+    self.fields.append(fields)
+
+  def _bisect_left(self, ms, seq):
+    # index of the first entry with id >= (ms, seq)
+    ms_parts, seq_parts = self.ms_parts, self.seq_parts
+    lo, hi = 0, len(ms_parts)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      mid_ms = ms_parts[mid]
+      if mid_ms < ms or (mid_ms == ms and seq_parts[mid] < seq):
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def _bisect_right(self, ms, seq):
+    # index of the first entry with id > (ms, seq)
+    ms_parts, seq_parts = self.ms_parts, self.seq_parts
+    lo, hi = 0, len(ms_parts)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      mid_ms = ms_parts[mid]
+      if mid_ms < ms or (mid_ms == ms and seq_parts[mid] <= seq):
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def _slice(self, lo, hi, count=None):
+    if count is not None:
+      hi = min(hi, lo + count)
+    ms_parts, seq_parts, fields = self.ms_parts, self.seq_parts, self.fields
+    return [(format_id(ms_parts[i], seq_parts[i]), fields[i]) for i in range(lo, hi)]
+
+  def range(self, start, end, count=None):
+    # entries with start <= id <= end, O(log n + k)
+    if start > end:
+      return []
+    lo = self._bisect_left(*start)
+    hi = self._bisect_right(*end)
+    return self._slice(lo, hi, count)
+
+  def after(self, last, count=None):
+    # entries with id > last. reading from the tail is the common case for
+    # consumers, so an id at or past the end returns without searching
+    if not self.fields or last >= self.last_id():
+      return []
+    lo = self._bisect_right(*last)
+    return self._slice(lo, len(self.fields), count)
@@ -0,0 +1,202 @@
+# contention benchmark of the threaded server: the same workloads against a
+# single global lock (--lock-stripes 1) and striped locks, one request at a time
+# per client process.
+#
+# - incr: INCRs on random keys, INCRs on one hot key shared by all clients and
+#   GETs. at the end the counters are checked against the number of INCRs the
+#   clients saw acknowledged, a lost update shows up there.
+# - ttl: SET PX, plain SET and DEL on random keys of a keyspace of volatile
+#   keys, so ttls are set and removed on every stripe side by side while the
+#   expiry index rebuilds its heap.
+#
+# a connection the server drops mid workload is counted and reopened
+#
+#   python benchmarks/lock_contention.py --clients 8 --duration 5 --stripes 1,256 --workloads incr,ttl
+import argparse
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def encode(*args):
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        data = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+class Connection:
+    def __init__(self, port):
+        self.sock = socket.create_connection(("localhost", port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buf = b""
+
+    def _line(self):
+        while b"\r\n" not in self.buf:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("server closed the connection")
+            self.buf += chunk
+        line, self.buf = self.buf.split(b"\r\n", 1)
+        return line
+
+    def call(self, *args):
+        # good enough for integer, status and bulk replies
+        self.sock.sendall(encode(*args))
+        line = self._line()
+        if line[:1] == b"-":
+            raise RuntimeError(line[1:].decode())
+        if line[:1] == b"$":
+            size = int(line[1:])
+            if size < 0:
+                return None
+            while len(self.buf) < size + 2:
+                self.buf += self.sock.recv(65536)
+            value, self.buf = self.buf[:size], self.buf[size + 2:]
+            return value
+        if line[:1] == b":":
+            return int(line[1:])
+        return line[1:]
+
+
+def incr_request(conn, rng, keys, incrs):
+    roll = rng.random()
+    if roll < 0.4:
+        key = f"key:{rng.randrange(keys)}"
+        conn.call("INCR", key)
+        incrs[key] = incrs.get(key, 0) + 1
+    elif roll < 0.5:
+        conn.call("INCR", "hot")
+        incrs["hot"] = incrs.get("hot", 0) + 1
+    else:
+        conn.call("GET", f"key:{rng.randrange(keys)}")
+
+
+def ttl_request(conn, rng, keys, incrs):
+    key = f"ttl:{rng.randrange(keys)}"
+    roll = rng.random()
+    if roll < 0.5:
+        # long enough that nothing expires during the run
+        conn.call("SET", key, "v", "PX", 600000)
+    elif roll < 0.8:
+        conn.call("SET", key, "v")
+    else:
+        conn.call("DEL", key)
+
+
+WORKLOADS = {"incr": incr_request, "ttl": ttl_request}
+
+
+def client(port, workload, keys, duration, seed, results):
+    rng = random.Random(seed)
+    request = WORKLOADS[workload]
+    conn = Connection(port)
+    incrs = {}
+    ops = 0
+    dropped = 0
+    latencies = []
+    deadline = time.perf_counter() + duration
+    while True:
+        start = time.perf_counter()
+        if start >= deadline:
+            break
+        try:
+            request(conn, rng, keys, incrs)
+        except ConnectionError:
+            # the reply of that request is lost, an incr it made isn't counted
+            dropped += 1
+            conn = Connection(port)
+            continue
+        ops += 1
+        latencies.append(time.perf_counter() - start)
+    results.put((ops, incrs, latencies, dropped))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def run(stripes, workload, args):
+    workdir = tempfile.mkdtemp(prefix="lock-bench-")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "app.main", "--io-mode", "threaded", "--port", str(args.port),
+         "--dir", workdir, "--lock-stripes", str(stripes)],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(100):
+            if server.poll() is not None:
+                raise SystemExit(f"the server exited with status {server.returncode}")
+            try:
+                Connection(args.port).call("PING")
+                break
+            except OSError:
+                time.sleep(0.05)
+        keys = args.keys if workload == "incr" else args.ttl_keys
+        if workload == "ttl":
+            # start from a keyspace where every key has a ttl
+            conn = Connection(args.port)
+            for i in range(keys):
+                conn.call("SET", f"ttl:{i}", "v", "PX", 600000)
+        results = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(target=client, args=(args.port, workload, keys, args.duration, seed, results))
+            for seed in range(args.clients)
+        ]
+        for worker in workers:
+            worker.start()
+        outcomes = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+
+        expected = {}
+        for _, incrs, _, _ in outcomes:
+            for key, count in incrs.items():
+                expected[key] = expected.get(key, 0) + count
+        conn = Connection(args.port)
+        lost = 0
+        for key, count in expected.items():
+            value = int(conn.call("GET", key) or 0)
+            lost += count - value
+        ops = sum(outcome[0] for outcome in outcomes)
+        latencies = [latency for outcome in outcomes for latency in outcome[2]]
+        dropped = sum(outcome[3] for outcome in outcomes)
+        print(
+            f"{workload:<5} stripes={stripes:<5} ops/s={ops / args.duration:>9.0f} "
+            f"p50={percentile(latencies, 0.5) * 1000:.3f}ms p99={percentile(latencies, 0.99) * 1000:.3f}ms "
+            f"lost incrs={lost} dropped connections={dropped}"
+        )
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--keys", type=int, default=1000)
+    parser.add_argument("--ttl-keys", type=int, default=20000, help="volatile keys of the ttl workload")
+    parser.add_argument("--port", type=int, default=7600)
+    parser.add_argument("--stripes", default="1,256", help="comma separated stripe counts to compare")
+    parser.add_argument("--workloads", default="incr,ttl", help=f"comma separated workloads among {', '.join(WORKLOADS)}")
+    args = parser.parse_args()
+    print(f"{args.clients} clients, {args.duration}s per run, {args.keys} keys, {args.ttl_keys} ttl keys")
+    for workload in args.workloads.split(","):
+        if workload not in WORKLOADS:
+            raise SystemExit(f"unknown workload {workload}")
+        for stripes in args.stripes.split(","):
+            run(int(stripes), workload, args)
+
+
+if __name__ == "__main__":
+    main()
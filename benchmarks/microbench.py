@@ -0,0 +1,200 @@
+# microbenchmarks of the hot paths that don't need a socket: request parsing,
+# rdb loading and reply encoding. each case reports the best of --repeat timings
+# per operation, so runs on different commits can be compared
+#
+#   python benchmarks/microbench.py
+#   python benchmarks/microbench.py --filter rdb --keys 200000 --json micro.json
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app.persistence import keyspace_items, rdb_aux_fields  # noqa: E402
+from app.rdb_loader import load_keys_from_rdb  # noqa: E402
+from app.rdb_writer import write_rdb_file  # noqa: E402
+from app.redis_store import RedisStore  # noqa: E402
+from app.resp import RespParser, encode_command  # noqa: E402
+
+
+def parse_redis_command(data):
+    # legacy baseline: the threaded server's original parser, which split a whole
+    # read on \r\n and so lost pipelined commands and frames split across reads.
+    # the server doesn't use it anymore, it is kept here to compare RespParser with
+    lines = data.split(b"\r\n")
+    args = []
+    i = 0
+    while i < len(lines):
+        if lines[i].startswith(b"*"):
+            i += 1
+        elif lines[i].startswith(b"$"):
+            i += 1
+            if i < len(lines) and lines[i] != b"":
+                args.append(lines[i])
+            i += 1
+        else:
+            if lines[i] != b"":
+                args.append(lines[i])
+            i += 1
+    return args
+
+
+def pipeline_bytes(count, value_size):
+    return b"".join(encode_command(["SET", f"key:{i}", "x" * value_size]) for i in range(count))
+
+
+def bench_parse_redis_command(opts):
+    # the legacy parser above, one SET per call
+    data = encode_command(["SET", "key:1", "x" * opts["value_size"]])
+    return lambda: parse_redis_command(data), 1
+
+
+def bench_resp_parser(opts):
+    # what the servers read with now: a read carrying a whole pipeline
+    data = pipeline_bytes(opts["pipeline"], opts["value_size"])
+
+    def run():
+        parser = RespParser()
+        parser.feed(data)
+        for _ in parser.parse():
+            pass
+    return run, opts["pipeline"]
+
+
+def bench_resp_parser_split(opts):
+    # the same pipeline arriving a few bytes at a time
+    data = pipeline_bytes(opts["pipeline"], opts["value_size"])
+    chunks = [data[i:i + 7] for i in range(0, len(data), 7)]
+
+    def run():
+        parser = RespParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+            for _ in parser.parse():
+                pass
+    return run, opts["pipeline"]
+
+
+def generated_store(opts):
+    # strings, counters, keys with a ttl and streams, like a cache with some queues.
+    # keys and values are bytes, as they come out of the parser
+    store = RedisStore(replica_config={"role": "master"})
+    future = int(time.time() * 1000) + 3600 * 1000
+    value = b"x" * opts["value_size"]
+    for i in range(opts["keys"]):
+        kind = i % 10
+        if kind < 6:
+            store.set(b"key:%d" % i, value)
+        elif kind < 8:
+            store.set(b"counter:%d" % i, b"%d" % i)
+        elif kind == 8:
+            store.set(b"session:%d" % i, value, pxat=future)
+        elif i % 100 == 9:
+            for n in range(opts["stream_length"]):
+                store.xadd(b"stream:%d" % i, b"*", [b"field", value, b"n", b"%d" % n])
+    return store
+
+
+def bench_load_keys_from_rdb(opts):
+    store = generated_store(opts)
+    path = os.path.join(tempfile.mkdtemp(prefix="microbench-"), "dump.rdb")
+    write_rdb_file(path, keyspace_items(store), len(store.data), len(store.expires), rdb_aux_fields(store))
+    return lambda: load_keys_from_rdb(path), len(store.data)
+
+
+def bench_encode_resp_list(opts):
+    store = RedisStore(replica_config={"role": "master"})
+    items = [b"key:%d" % i for i in range(100)]
+    return lambda: store._encode_resp_list(items), 1
+
+
+def stream_entries(opts, count):
+    value = b"x" * opts["value_size"]
+    return [(b"%d-0" % (1700000000000 + i), [b"field", value, b"n", b"%d" % i]) for i in range(count)]
+
+
+def bench_encode_resp_list_of_lists(opts):
+    # an XRANGE reply of 100 entries
+    store = RedisStore(replica_config={"role": "master"})
+    entries = stream_entries(opts, 100)
+    return lambda: store._encode_resp_list_of_lists(entries), 1
+
+
+def bench_encode_xread_response(opts):
+    # an XREAD reply of 10 entries from each of 4 streams
+    store = RedisStore(replica_config={"role": "master"})
+    data = [(b"stream:%d" % s, stream_entries(opts, 10)) for s in range(4)]
+    return lambda: store._encode_xread_response(data), 1
+
+
+# name -> setup(opts) returning (function to time, operations per call)
+BENCHMARKS = {
+    "parse_redis_command": bench_parse_redis_command,
+    "resp_parser": bench_resp_parser,
+    "resp_parser_split": bench_resp_parser_split,
+    "load_keys_from_rdb": bench_load_keys_from_rdb,
+    "encode_resp_list": bench_encode_resp_list,
+    "encode_resp_list_of_lists": bench_encode_resp_list_of_lists,
+    "encode_xread_response": bench_encode_xread_response,
+}
+
+
+def measure(func, min_seconds, repeat):
+    # calls per timing so each takes about min_seconds, then the best ns per call
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_seconds / 0.2))
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the parsing, loading and encoding hot paths")
+    parser.add_argument("--filter", default="", help="only run the benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-seconds", type=float, default=0.2, help="length of one timing")
+    parser.add_argument("--keys", type=int, default=50000, help="keys in the generated rdb file")
+    parser.add_argument("--stream-length", type=int, default=100, help="entries of each stream in the rdb file")
+    parser.add_argument("--pipeline", type=int, default=100, help="commands per read for the parser benchmarks")
+    parser.add_argument("--value-size", type=int, default=16)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+    opts = dict(keys=args.keys, stream_length=args.stream_length, pipeline=args.pipeline, value_size=args.value_size)
+
+    # the server prints while it works, the numbers go to the real stdout
+    real_stdout = sys.stdout
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+        sys.stdout = open(os.devnull, "w")
+        try:
+            func, ops = setup(opts)
+            ns = measure(func, args.min_seconds, max(1, args.repeat))
+        finally:
+            sys.stdout.close()
+            sys.stdout = real_stdout
+        results[name] = {"ns_per_call": round(ns, 1), "ops_per_call": ops, "ns_per_op": round(ns / ops, 1)}
+        print(f"{name:<28} {ns / ops:>12.1f} ns/op  ({ops} per call, {ns / 1e6:.3f} ms per call)")
+
+    if args.json:
+        report = dict(commit=git_commit(), timestamp=int(time.time()), python=platform.python_version(), options=opts, results=results)
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+# load generator in the spirit of redis-benchmark: client processes drive the
+# server over tcp, each keeping `pipeline` requests in flight, and every request
+# of a batch is charged the time the whole batch took (like redis-benchmark).
+# tests run one after the other, or as a single weighted mix:
+#
+#   python benchmarks/redis_benchmark.py --tests get,set,incr --clients 8 --pipeline 16
+#   python benchmarks/redis_benchmark.py --mix get=80,set=15,xadd=5 --duration 10 --json run.json
+#   python benchmarks/redis_benchmark.py --start-server --server-args "--io-mode threaded" --json new.json --compare old.json
+#
+# --json writes the results with the commit they were measured on, --compare
+# prints the change against an earlier file
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app.resp import reply_end  # noqa: E402
+from app.stats import LATENCY_PERCENTILES, LatencyHistogram, format_percentile  # noqa: E402
+
+TESTS = ("get", "set", "incr", "xadd", "xrange", "xread", "multi")
+# random commands pregenerated per client and test, cycled through while running
+COMMAND_POOL = 4096
+
+
+def encode(*args):
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+def make_command(test, rng, opts, value):
+    # (request bytes, replies it gets)
+    key = rng.randrange(opts["keyspace"])
+    stream = f"stream:{key % opts['streams']}"
+    if test == "get":
+        return encode("GET", f"key:{key}"), 1
+    if test == "set":
+        return encode("SET", f"key:{key}", value), 1
+    if test == "incr":
+        return encode("INCR", f"counter:{key}"), 1
+    if test == "xadd":
+        return encode("XADD", stream, "*", "field", value), 1
+    if test == "xrange":
+        return encode("XRANGE", stream, "-", "+", "COUNT", 10), 1
+    if test == "xread":
+        return encode("XREAD", "COUNT", 10, "STREAMS", stream, "0-0"), 1
+    if test == "multi":
+        return encode("MULTI") + encode("SET", f"key:{key}", value) + encode("INCR", f"counter:{key}") + encode("EXEC"), 4
+    raise ValueError(f"unknown test {test}")
+
+
+class Connection:
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buf = bytearray()
+
+    def roundtrip(self, data, replies):
+        # sends data and reads that many replies, returns how many were errors
+        self.sock.sendall(data)
+        buf = self.buf
+        pos = 0
+        errors = 0
+        while replies:
+            end = reply_end(buf, pos) if pos < len(buf) else -1
+            if end == -1:
+                chunk = self.sock.recv(1 << 16)
+                if not chunk:
+                    raise ConnectionError("server closed the connection")
+                buf += chunk
+                continue
+            if buf[pos] == 0x2D: # '-'
+                errors += 1
+            pos = end
+            replies -= 1
+        del buf[:pos]
+        return errors
+
+
+def client(opts, test, seed, quota, results):
+    rng = random.Random(seed)
+    value = b"x" * opts["data_size"]
+    names = list(opts["mix"]) if test == "mix" else [test]
+    weights = [opts["mix"][name] for name in names] if test == "mix" else None
+    pool = []
+    for _ in range(COMMAND_POOL):
+        name = rng.choices(names, weights)[0] if weights else names[0]
+        data, replies = make_command(name, rng, opts, value)
+        pool.append((name, data, replies))
+
+    conn = Connection(opts["host"], opts["port"])
+    histograms = {name: LatencyHistogram() for name in names}
+    errors = 0
+    done = 0
+    pipeline = opts["pipeline"]
+    deadline = time.perf_counter() + opts["duration"] if opts["duration"] else None
+    i = 0
+    started = time.perf_counter()
+    while True:
+        if deadline is not None:
+            if time.perf_counter() >= deadline:
+                break
+            size = pipeline
+        else:
+            size = min(pipeline, quota - done)
+            if size <= 0:
+                break
+        batch = [pool[(i + n) % COMMAND_POOL] for n in range(size)]
+        i += size
+        data = b"".join(command[1] for command in batch)
+        replies = sum(command[2] for command in batch)
+        start = time.perf_counter_ns()
+        errors += conn.roundtrip(data, replies)
+        elapsed = time.perf_counter_ns() - start
+        for name, _, _ in batch:
+            histograms[name].record(elapsed)
+        done += size
+    seconds = time.perf_counter() - started
+    results.put((done, errors, seconds, {name: h.counts for name, h in histograms.items()}))
+
+
+def merge(histograms):
+    merged = LatencyHistogram()
+    for counts in histograms:
+        merged.counts = [a + b for a, b in zip(merged.counts, counts)]
+    merged.total = sum(merged.counts)
+    return merged
+
+
+def latency_fields(histogram):
+    return {f"{format_percentile(p)}_ms": round(histogram.percentile(p) / 1e6, 3) for p in LATENCY_PERCENTILES}
+
+
+def run_test(test, opts):
+    results = multiprocessing.Queue()
+    clients = opts["clients"]
+    quotas = [opts["requests"] // clients + (1 if n < opts["requests"] % clients else 0) for n in range(clients)]
+    workers = [
+        multiprocessing.Process(target=client, args=(opts, test, seed, quotas[seed], results))
+        for seed in range(clients)
+    ]
+    for worker in workers:
+        worker.start()
+    outcomes = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    requests = sum(outcome[0] for outcome in outcomes)
+    errors = sum(outcome[1] for outcome in outcomes)
+    # the clients run side by side, the slowest one is the run's length
+    seconds = max(outcome[2] for outcome in outcomes)
+    per_command = {}
+    for name in outcomes[0][3]:
+        histogram = merge(outcome[3][name] for outcome in outcomes)
+        if histogram.total:
+            per_command[name] = dict(requests=histogram.total, **latency_fields(histogram))
+    overall = merge(counts for outcome in outcomes for counts in outcome[3].values())
+    return dict(
+        requests=requests,
+        errors=errors,
+        seconds=round(seconds, 3),
+        ops_per_sec=round(requests / seconds, 1) if seconds else 0.0,
+        **latency_fields(overall),
+        commands=per_command,
+    )
+
+
+def populate(opts, tests):
+    # the reads need something to read
+    conn = Connection(opts["host"], opts["port"])
+    value = b"x" * opts["data_size"]
+    batch = 1000
+    if {"get", "mix"} & set(tests):
+        for start in range(0, opts["keyspace"], batch):
+            keys = range(start, min(start + batch, opts["keyspace"]))
+            conn.roundtrip(b"".join(encode("SET", f"key:{key}", value) for key in keys), len(keys))
+    if {"xrange", "xread", "mix"} & set(tests):
+        commands = [encode("XADD", f"stream:{s}", "*", "field", value) for s in range(opts["streams"]) for _ in range(opts["stream_length"])]
+        for start in range(0, len(commands), batch):
+            chunk = commands[start:start + batch]
+            conn.roundtrip(b"".join(chunk), len(chunk))
+
+
+def start_server(opts, server_args):
+    workdir = tempfile.mkdtemp(prefix="redis-bench-")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "app.main", "--port", str(opts["port"]), "--dir", workdir] + server_args.split(),
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        if server.poll() is not None:
+            raise SystemExit(f"the server exited with status {server.returncode}")
+        try:
+            Connection(opts["host"], opts["port"]).roundtrip(encode("PING"), 1)
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.terminate()
+    raise SystemExit("the server didn't come up")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_mix(text):
+    # "get=80,set=20" -> {"get": 80.0, "set": 20.0}
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip().lower()
+        if name not in TESTS:
+            raise SystemExit(f"unknown command in --mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def print_result(test, result):
+    latencies = " ".join(f"{key[:-3]}={value:.3f}ms" for key, value in result.items() if key.endswith("_ms"))
+    errors = f" errors={result['errors']}" if result["errors"] else ""
+    print(f"{test.upper():<8} {result['ops_per_sec']:>11.1f} ops/s  {latencies}{errors}")
+    if test == "mix":
+        for name, command in result["commands"].items():
+            latencies = " ".join(f"{key[:-3]}={value:.3f}ms" for key, value in command.items() if key.endswith("_ms"))
+            print(f"  {name:<8} {command['requests']:>9} requests  {latencies}")
+
+
+def print_comparison(results, path):
+    with open(path) as f:
+        before = json.load(f)
+    print(f"\nagainst {path} ({(before.get('commit') or 'unknown commit')[:12]})")
+    for test, result in results.items():
+        old = before.get("results", {}).get(test)
+        if old is None or not old["ops_per_sec"]:
+            continue
+        change = (result["ops_per_sec"] / old["ops_per_sec"] - 1) * 100
+        p99 = format_percentile(99.0) + "_ms"
+        print(f"{test.upper():<8} ops/s {change:+6.1f}%  p99 {old[p99]:.3f}ms -> {result[p99]:.3f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the server over tcp, like redis-benchmark")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--clients", type=int, default=8, help="client processes, each with its own connection")
+    parser.add_argument("--requests", type=int, default=50000, help="requests per test, split over the clients")
+    parser.add_argument("--duration", type=float, default=0, help="seconds per test instead of a request count")
+    parser.add_argument("--pipeline", type=int, default=1, help="requests each client keeps in flight")
+    parser.add_argument("--keyspace", type=int, default=10000, help="keys the commands pick from at random")
+    parser.add_argument("--data-size", type=int, default=3, help="bytes of SET and XADD values")
+    parser.add_argument("--streams", type=int, default=100, help="streams XADD, XRANGE and XREAD pick from")
+    parser.add_argument("--stream-length", type=int, default=100, help="entries added to each stream before the reads")
+    parser.add_argument("--tests", default=",".join(TESTS), help=f"comma separated, run one after the other: {','.join(TESTS)}")
+    parser.add_argument("--mix", help="run a single weighted mix instead, e.g. get=80,set=20")
+    parser.add_argument("--no-populate", action="store_true", help="don't fill the keys and streams the reads use")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="print the change against the results of an earlier --json")
+    parser.add_argument("--start-server", action="store_true", help="start a server from this checkout on --port for the run")
+    parser.add_argument("--server-args", default="", help="extra arguments for --start-server")
+    args = parser.parse_args()
+
+    opts = dict(
+        host=args.host, port=args.port, clients=max(1, args.clients), requests=args.requests,
+        duration=args.duration, pipeline=max(1, args.pipeline), keyspace=max(1, args.keyspace),
+        data_size=args.data_size, streams=max(1, args.streams), stream_length=args.stream_length,
+        mix=parse_mix(args.mix) if args.mix else None,
+    )
+    tests = ["mix"] if args.mix else [test.strip().lower() for test in args.tests.split(",") if test.strip()]
+    for test in tests:
+        if test != "mix" and test not in TESTS:
+            raise SystemExit(f"unknown test: {test}")
+
+    server = start_server(opts, args.server_args) if args.start_server else None
+    try:
+        if not args.no_populate:
+            populate(opts, tests)
+        amount = f"{opts['duration']}s" if opts["duration"] else f"{opts['requests']} requests"
+        print(f"{opts['clients']} clients, pipeline {opts['pipeline']}, {amount} per test, {opts['keyspace']} keys, {opts['data_size']} byte values")
+        results = {}
+        for test in tests:
+            results[test] = run_test(test, opts)
+            print_result(test, results[test])
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        report = dict(
+            commit=git_commit(),
+            timestamp=int(time.time()),
+            python=platform.python_version(),
+            server_args=args.server_args if args.start_server else None,
+            options={key: value for key, value in opts.items() if key not in ("host",)},
+            results=results,
+        )
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        print_comparison(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import random
+
+from app.crc64 import POLY, crc64
+
+
+def reference_crc64(data, crc=0):
+    # bit at a time, no tables
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = (crc >> 1) ^ POLY if crc & 1 else crc >> 1
+    return crc
+
+
+def test_known_vector():
+    assert crc64(b"123456789") == 0xE9C6D914C4B8D9CA
+
+
+def test_empty_input():
+    assert crc64(b"") == 0
+
+
+def test_matches_the_bitwise_crc_at_every_alignment():
+    # the slicing by 8 path takes whole words, the tail goes byte by byte
+    rng = random.Random(0)
+    data = bytes(rng.getrandbits(8) for _ in range(100))
+    for length in range(len(data)):
+        assert crc64(data[:length]) == reference_crc64(data[:length])
+
+
+def test_incremental():
+    data = b"the quick brown fox jumps over the lazy dog" * 3
+    for split in (0, 1, 7, 8, 9, len(data)):
+        assert crc64(data[split:], crc64(data[:split])) == crc64(data)
+
+
+def test_accepts_any_buffer():
+    data = b"123456789"
+    assert crc64(bytearray(data)) == crc64(memoryview(data)) == crc64(data)
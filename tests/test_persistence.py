@@ -0,0 +1,150 @@
+import time
+
+from app import persistence
+from app.persistence import KeyspaceSnapshot
+from app.rdb_loader import load_keys_from_rdb
+from app.rdb_writer import write_rdb_file
+from app.redis_object import HASH, LIST, SET, STREAM, STRING, ZSET, RedisObject
+from app.redis_store import RedisStore
+from app.streams import Stream
+
+
+def comparable(obj):
+    # a value that compares equal for equal objects, whatever their containers
+    if obj.type == STREAM:
+        stream = obj.value
+        return obj.type, list(zip(stream.ms_parts, stream.seq_parts, stream.fields))
+    if obj.type == LIST:
+        return obj.type, list(obj.value)
+    if obj.type in (SET, ZSET, HASH):
+        return obj.type, obj.value if obj.type != SET else set(obj.value)
+    return obj.type, obj.value
+
+
+def test_rdb_round_trip(tmp_path):
+    future = int(time.time() * 1000) + 3_600_000
+    stream = Stream()
+    for i in range(250):
+        # more entries than fit in one listpack node
+        stream.append(1_700_000_000_000 + i // 3, i % 3, [b"field", b"%d" % i, b"other", b"x" * (i % 7)])
+    items = [
+        (b"short", RedisObject(STRING, b"hello"), None),
+        (b"empty", RedisObject(STRING, b""), None),
+        (b"long", RedisObject(STRING, b"0123456789" * 2000), future),
+        (b"binary", RedisObject(STRING, bytes(range(256))), None),
+        (b"int8", RedisObject(STRING, -5), None),
+        (b"int16", RedisObject(STRING, 30000), None),
+        (b"int32", RedisObject(STRING, -2_000_000_000), future + 1),
+        (b"int64", RedisObject(STRING, 9_000_000_000_000_000_000), None),
+        (b"list", RedisObject(LIST, [b"a", b"b", b"12", b"a", b"x" * 100]), None),
+        (b"set", RedisObject(SET, {b"m1", b"m2", b"42"}), future + 2),
+        (b"zset", RedisObject(ZSET, {b"a": 1.0, b"b": -2.5, b"c": 1e300, b"d": float("inf")}), None),
+        (b"hash", RedisObject(HASH, {b"f1": b"v1", b"f2": b"", b"n": b"7"}), None),
+        (b"stream", RedisObject(STREAM, stream), future + 3),
+        (b"empty-stream", RedisObject(STREAM, Stream()), None),
+    ]
+    path = str(tmp_path / "dump.rdb")
+    expires = sum(1 for _, _, expiry in items if expiry is not None)
+    write_rdb_file(path, items, len(items), expires, {"redis-ver": "7.2.0", "redis-bits": 64})
+
+    loaded = load_keys_from_rdb(path)
+    assert set(loaded) == {key for key, _, _ in items}
+    for key, obj, expiry in items:
+        loaded_obj, loaded_expiry = loaded[key]
+        assert comparable(loaded_obj) == comparable(obj), key
+        assert loaded_expiry == expiry, key
+
+
+def test_rdb_round_trip_without_checksum(tmp_path):
+    path = str(tmp_path / "dump.rdb")
+    write_rdb_file(path, [(b"k", RedisObject(STRING, b"v"), None)], 1, 0, {}, checksum=False)
+    assert comparable(load_keys_from_rdb(path)[b"k"][0]) == (STRING, b"v")
+
+
+def dataset(store):
+    expires = store.expires.deadlines
+    return {key: (comparable(obj), expires.get(key)) for key, obj in store.data.items()}
+
+
+def test_keyspace_snapshot_is_the_dataset_as_of_the_start(monkeypatch):
+    # small batches, so the walk is interleaved with the writes below
+    monkeypatch.setattr(persistence, "SNAPSHOT_BATCH", 10)
+    store = RedisStore(replica_config={})
+    future = int(time.time() * 1000) + 3_600_000
+    for i in range(500):
+        store.set(b"k%d" % i, b"v%d" % i)
+    for i in range(0, 500, 5):
+        store.expire_at(b"k%d" % i, future + i)
+    for i in range(100):
+        store.incrby(b"counter%d" % i, i)
+        store.xadd(b"s%d" % i, b"1-1", [b"f", b"v"])
+    expected = dataset(store)
+
+    snapshot = KeyspaceSnapshot(store)
+    store.snapshot = snapshot
+    items = snapshot.items()
+    written = {}
+
+    def take(count):
+        for key, obj, expiry in items:
+            assert key not in written, key
+            written[key] = (comparable(obj), expiry)
+            count -= 1
+            if count == 0:
+                return
+
+    # stops in the middle of a batch, some of the keys changed below were
+    # already picked by the walk but not handed out yet
+    take(55)
+    # changes in place, replaced values, ttls and deletes, on keys the walk
+    # already wrote and on keys it hasn't reached yet
+    for i in range(100):
+        store.incrby(b"counter%d" % i, 5)
+        store.xadd(b"s%d" % i, b"2-1", [b"g", b"w"])
+    for i in range(0, 500, 2):
+        store.set(b"k%d" % i, b"changed")
+    for i in range(1, 500, 10):
+        store.persist(b"k%d" % (i - 1))
+        store.expire_at(b"k%d" % i, future)
+    store.delete([b"k%d" % i for i in range(3, 500, 7)])
+    # enough new keys that the scan index grows during the walk
+    for i in range(5000):
+        store.set(b"new%d" % i, b"x")
+    take(103)
+    store.flushall()
+    for i in range(0, 500, 3):
+        store.set(b"k%d" % i, b"after flush")
+    store.set(b"late", b"x")
+    take(-1)
+
+    assert written == expected
+    assert store.snapshot is None
+    # the store keeps working without the snapshot
+    store.set(b"k1", b"again")
+    assert store.data[b"k1"].value == b"again"
+
+
+def test_keyspace_snapshot_without_writes(monkeypatch):
+    monkeypatch.setattr(persistence, "SNAPSHOT_BATCH", 7)
+    store = RedisStore(replica_config={})
+    for i in range(300):
+        store.set(b"k%d" % i, b"%d" % i, pxat=int(time.time() * 1000) + 60_000 if i % 2 else None)
+    expected = dataset(store)
+    snapshot = KeyspaceSnapshot(store)
+    store.snapshot = snapshot
+    written = [(key, (comparable(obj), expiry)) for key, obj, expiry in snapshot.items()]
+    assert len(written) == len(expected)
+    assert dict(written) == expected
+
+
+def test_released_snapshot_stops_collecting(monkeypatch):
+    store = RedisStore(replica_config={})
+    store.set(b"k", b"v")
+    snapshot = KeyspaceSnapshot(store)
+    store.snapshot = snapshot
+    # a save that failed half way
+    snapshot.release()
+    assert store.snapshot is None
+    store.set(b"k", b"w")
+    snapshot.preserve(b"k")
+    assert snapshot.saved == {}
@@ -0,0 +1,119 @@
+import pytest
+
+from app.crc64 import crc64
+from app.rdb_loader import RdbError, load_keys_from_rdb, lzf_decompress
+from app.rdb_writer import write_rdb_file
+from app.redis_object import STRING, RedisObject
+
+
+def rdb_file(tmp_path, body, checksum=True):
+    # a version 11 rdb with db 0 selected, body is the key value pairs
+    data = b"REDIS0011" + b"\xfe\x00" + body + b"\xff"
+    data += (crc64(data) if checksum else 0).to_bytes(8, "little")
+    path = tmp_path / "dump.rdb"
+    path.write_bytes(data)
+    return str(path)
+
+
+def string_pair(key, encoded_value):
+    # RDB_TYPE_STRING, the key as a plain string and the value as given
+    return b"\x00" + bytes((len(key),)) + key + encoded_value
+
+
+@pytest.mark.parametrize("encoded, value", [
+    (b"\xc0\x7f", 127),
+    (b"\xc0\x80", -128),
+    (b"\xc1\x39\x30", 12345),
+    (b"\xc1\x00\x80", -32768),
+    (b"\xc2\x15\xcd\x5b\x07", 123456789),
+    (b"\xc2\xff\xff\xff\xff", -1),
+])
+def test_integer_encoded_strings(tmp_path, encoded, value):
+    keys = load_keys_from_rdb(rdb_file(tmp_path, string_pair(b"n", encoded)))
+    obj, expiry = keys[b"n"]
+    assert obj.type == STRING
+    assert obj.value == value
+    assert expiry is None
+
+
+def test_integer_encoded_key(tmp_path):
+    keys = load_keys_from_rdb(rdb_file(tmp_path, b"\x00\xc1\x39\x30\x01v"))
+    assert keys[b"12345"][0].value == b"v"
+
+
+# "abcabcabcabc": a literal run of "abc" (ctrl 2), then a back reference of
+# 7 + 0 + 2 = 9 bytes at distance 2 + 1 = 3, which overlaps what it produces
+LZF_ABC = b"\x02abc\xe0\x00\x02"
+
+
+def test_lzf_decompress():
+    assert lzf_decompress(LZF_ABC, 12) == b"abcabcabcabc"
+    # a short back reference: "xyzxyz", 1 + 2 = 3 bytes at distance 3
+    assert lzf_decompress(b"\x02xyz\x20\x02", 6) == b"xyzxyz"
+    # only literals
+    assert lzf_decompress(b"\x04hello", 5) == b"hello"
+
+
+def test_lzf_rejects_bad_input():
+    with pytest.raises(RdbError):
+        lzf_decompress(LZF_ABC, 13)
+    with pytest.raises(RdbError):
+        # a back reference before the start of the output
+        lzf_decompress(b"\x00a\x20\x05", 4)
+
+
+def test_lzf_encoded_string(tmp_path):
+    encoded = b"\xc3" + bytes((len(LZF_ABC), 12)) + LZF_ABC
+    keys = load_keys_from_rdb(rdb_file(tmp_path, string_pair(b"s", encoded)))
+    assert keys[b"s"][0].value == b"abcabcabcabc"
+
+
+def test_lzf_encoded_integer_string_becomes_an_int(tmp_path):
+    # "121212": a literal "12" and a back reference of 2 + 2 = 4 bytes at distance 2
+    compressed = b"\x0112\x40\x01"
+    encoded = b"\xc3" + bytes((len(compressed), 6)) + compressed
+    keys = load_keys_from_rdb(rdb_file(tmp_path, string_pair(b"s", encoded)))
+    assert keys[b"s"][0].value == 121212
+
+
+def write_dump(tmp_path):
+    path = str(tmp_path / "dump.rdb")
+    items = [(b"k", RedisObject(STRING, b"value"), None), (b"n", RedisObject(STRING, 7), None)]
+    write_rdb_file(path, items, 2, 0, {"redis-ver": "7.2.0"})
+    return path
+
+
+def test_corrupted_trailer(tmp_path):
+    path = write_dump(tmp_path)
+    with open(path, "r+b") as f:
+        f.seek(-1, 2)
+        last = f.read(1)
+        f.seek(-1, 2)
+        f.write(bytes((last[0] ^ 0xFF,)))
+    with pytest.raises(RdbError, match="checksum"):
+        load_keys_from_rdb(path)
+    # rdbchecksum no skips the verification
+    assert load_keys_from_rdb(path, verify_checksum=False)[b"k"][0].value == b"value"
+
+
+def test_corrupted_body(tmp_path):
+    path = write_dump(tmp_path)
+    data = bytearray(open(path, "rb").read())
+    position = data.index(b"value")
+    data[position] ^= 0x01
+    open(path, "wb").write(bytes(data))
+    with pytest.raises(RdbError, match="checksum"):
+        load_keys_from_rdb(path)
+
+
+def test_zero_checksum_is_not_verified(tmp_path):
+    keys = load_keys_from_rdb(rdb_file(tmp_path, string_pair(b"k", b"\x01v"), checksum=False))
+    assert keys[b"k"][0].value == b"v"
+
+
+def test_truncated_file(tmp_path):
+    path = write_dump(tmp_path)
+    data = open(path, "rb").read()
+    open(path, "wb").write(data[:-12])
+    with pytest.raises(RdbError):
+        load_keys_from_rdb(path)